@@ -30,6 +30,7 @@ from cirq import (
 
 from cirq.circuits import (
     Circuit,
+    CompactCircuit,
     DropEmptyMoments,
     DropNegligible,
     ExpandComposite,
@@ -112,11 +113,14 @@ from cirq.ops import (
     HGate,
     InterchangeableQubitsGate,
     inverse,
+    is_parameterized,
     ISWAP,
     ISwapGate,
     KnownMatrix,
     measure,
     measure_each,
+    measurement_invert_mask,
+    measurement_keys,
     MeasurementGate,
     NamedQubit,
     OP_TREE,
@@ -128,6 +132,8 @@ from cirq.ops import (
     ParameterizableEffect,
     PhaseableEffect,
     QubitId,
+    resolve_and_decompose,
+    resolve_operation,
     Rot11Gate,
     RotXGate,
     RotYGate,
@@ -163,6 +169,7 @@ from cirq.study import (
     Sweep,
     Sweepable,
     TrialResult,
+    to_resolvers,
 )
 
 from cirq.study.visualize import (
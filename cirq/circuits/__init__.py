@@ -20,6 +20,9 @@ from cirq.circuits.text_diagram_drawer import (
 from cirq.circuits.circuit import (
     Circuit,
 )
+from cirq.circuits.compact_circuit import (
+    CompactCircuit,
+)
 from cirq.circuits.drop_empty_moments import (
     DropEmptyMoments,
 )
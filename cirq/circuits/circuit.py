@@ -19,8 +19,10 @@ Operations. Each Operation is a Gate that acts on some Qubits, for a given
 Moment the Operations must all act on distinct Qubits.
 """
 
+import bisect
+import collections
 from typing import (
-    Any, Dict, FrozenSet, Callable, Generator, Iterable, Iterator,
+    Any, Dict, FrozenSet, Callable, Generator, Iterable, Iterator, List,
     Optional, Sequence, Union, TYPE_CHECKING,
 )
 
@@ -70,6 +72,12 @@ class Circuit(object):
         circuit * k is a new Circuit made up of the moments in circuit repeated
             k times.
 
+    The circuit keeps an index of the moments operating on each qubit, so
+    that finding the next or previous moment touching some qubits does not
+    scan the moments in between. The index is kept up to date by the methods
+    for mutation, and rebuilt after the list of moments is assigned or
+    changed in place.
+
     Attributes:
         moments: A list of the Moments of the circuit.
     """
@@ -82,22 +90,68 @@ class Circuit(object):
         """
         self.moments = list(moments)
 
+    @property
+    def moments(self) -> List[Moment]:
+        return self._moments
+
+    @moments.setter
+    def moments(self, moments: Iterable[Moment]) -> None:
+        self._moments = _MomentList(moments)
+
+    def _index(self) -> '_OccupancyIndex':
+        """Returns the index of the moments operating on each qubit."""
+        if self._moments.occupancy is None:
+            self._moments.occupancy = _OccupancyIndex(self._moments)
+        return self._moments.occupancy
+
     @staticmethod
     def from_ops(*operations: ops.OP_TREE,
                  strategy: InsertStrategy = InsertStrategy.NEW_THEN_INLINE
                  ) -> 'Circuit':
         """Creates an empty circuit and appends the given operations.
 
+        The result is the same as appending the operations one by one, but
+        the operations are placed in a single pass that tracks the last
+        moment operating on each qubit, and each moment is created once.
+
         Args:
             operations: The operations to append to the new circuit.
             strategy: How to append the operations.
 
         Returns:
             The constructed circuit containing the operations.
+
+        Raises:
+            ValueError: Unrecognized append strategy.
         """
-        result = Circuit()
-        result.append(operations, strategy)
-        return result
+        moment_ops = []  # type: List[List[ops.Operation]]
+        last_moments = {}  # type: Dict[QubitId, int]
+        for op in ops.flatten_op_tree(operations):
+            end = len(moment_ops)
+            if (strategy is InsertStrategy.NEW or
+                    strategy is InsertStrategy.NEW_THEN_INLINE):
+                p = end
+            elif strategy is InsertStrategy.INLINE:
+                p = end if end == 0 or any(
+                    last_moments.get(q) == end - 1 for q in op.qubits
+                ) else end - 1
+            elif strategy is InsertStrategy.EARLIEST:
+                p = 0
+                for q in op.qubits:
+                    if q in last_moments:
+                        p = max(p, last_moments[q] + 1)
+            else:
+                raise ValueError(
+                    'Unrecognized append strategy: {}'.format(strategy))
+
+            if p == end:
+                moment_ops.append([])
+            moment_ops[p].append(op)
+            for q in op.qubits:
+                last_moments[q] = p
+            if strategy is InsertStrategy.NEW_THEN_INLINE:
+                strategy = InsertStrategy.INLINE
+        return Circuit(Moment(operations) for operations in moment_ops)
 
     def __copy__(self):
         return type(self)(self.moments)
@@ -119,10 +173,10 @@ class Circuit(object):
             raise TypeError(
                 '__getitem__ called with key not of type slice or int.')
 
-    def __iadd__(self, other):
+    def __iadd__(self, other):  # type: ignore
         if not isinstance(other, type(self)):
             return NotImplemented
-        self.moments += other.moments
+        self._moments += other.moments
         return self
 
     def __add__(self, other):
@@ -133,7 +187,7 @@ class Circuit(object):
     def __imul__(self, repetitions: int):
         if not isinstance(repetitions, int):
             return NotImplemented
-        self.moments *= repetitions
+        self._moments *= repetitions
         return self
 
     def __mul__(self, repetitions: int):
@@ -175,14 +229,6 @@ class Circuit(object):
                 + self.to_text_diagram()
                 + '</pre>')
 
-    def _first_moment_operating_on(self, qubits: Iterable[ops.QubitId],
-                                   indices: Iterable[int]) -> Optional[int]:
-        qubits = frozenset(qubits)
-        for m in indices:
-            if self._has_op_at(m, qubits):
-                return m
-        return None
-
     def next_moment_operating_on(self,
                                  qubits: Iterable[ops.QubitId],
                                  start_moment_index: int = 0,
@@ -210,9 +256,8 @@ class Circuit(object):
         else:
             max_distance = min(max_distance, max_circuit_distance)
 
-        return self._first_moment_operating_on(
-            qubits,
-            range(start_moment_index, start_moment_index + max_distance))
+        return self._index().next_moment_index(
+            qubits, start_moment_index, start_moment_index + max_distance)
 
     def prev_moment_operating_on(
             self,
@@ -254,9 +299,8 @@ class Circuit(object):
         if max_distance <= 0:
             return None
 
-        return self._first_moment_operating_on(qubits,
-                                               (end_moment_index - k - 1
-                                                for k in range(max_distance)))
+        return self._index().prev_moment_index(
+            qubits, end_moment_index - max_distance, end_moment_index)
 
     def operation_at(self,
                      qubit: ops.QubitId,
@@ -274,10 +318,7 @@ class Circuit(object):
         """
         if not 0 <= moment_index < len(self.moments):
             return None
-        for op in self.moments[moment_index].operations:
-            if qubit in op.qubits:
-                return op
-        return None
+        return self.moments[moment_index].operation_at(qubit)
 
     def findall_operations(self, predicate: Callable[[ops.Operation], bool]):
         """Find the locations of all operations that satisfy a given condition.
@@ -324,7 +365,7 @@ class Circuit(object):
 
         if (strategy is InsertStrategy.NEW or
                 strategy is InsertStrategy.NEW_THEN_INLINE):
-            self.moments.insert(splitter_index, Moment())
+            self._insert_moment(splitter_index, Moment())
             return splitter_index
 
         if strategy is InsertStrategy.INLINE:
@@ -345,6 +386,17 @@ class Circuit(object):
 
         raise ValueError('Unrecognized append strategy: {}'.format(strategy))
 
+    def _insert_moment(self, index: int, moment: Moment) -> None:
+        # Resolve the index as list.insert does.
+        if index < 0:
+            index = max(0, index + len(self.moments))
+        index = min(index, len(self.moments))
+        occupancy = self._index()
+        if index < len(self.moments):
+            occupancy.shift_moments(index)
+        self._moments.insert_moment(index, moment)
+        occupancy.add(moment.qubits, index)
+
     def _has_op_at(self, moment_index, qubits):
         return (0 <= moment_index < len(self.moments) and
                 self.moments[moment_index].operates_on(qubits))
@@ -370,18 +422,21 @@ class Circuit(object):
             ValueError: Bad insertion strategy.
         """
         if isinstance(moment_or_operation_tree, Moment):
-            self.moments.insert(index, moment_or_operation_tree)
+            self._insert_moment(index, moment_or_operation_tree)
             return index + 1
 
         if not 0 <= index <= len(self.moments):
             raise IndexError('Insert index out of range: {}'.format(index))
 
+        occupancy = self._index()
         k = index
         for op in ops.flatten_op_tree(moment_or_operation_tree):
             p = self._pick_or_create_inserted_op_moment_index(k, op, strategy)
             while p >= len(self.moments):
-                self.moments.append(Moment())
-            self.moments[p] = self.moments[p].with_operation(op)
+                self._moments.insert_moment(len(self.moments), Moment())
+            self._moments.replace_moment(p,
+                                         self.moments[p].with_operation(op))
+            occupancy.add(op.qubits, p)
             k = max(k, p + 1)
             if strategy is InsertStrategy.NEW_THEN_INLINE:
                 strategy = InsertStrategy.INLINE
@@ -413,15 +468,18 @@ class Circuit(object):
                 start, end))
 
         operations = list(ops.flatten_op_tree(operations))
+        occupancy = self._index()
         i = start
         op_index = 0
         while op_index < len(operations):
             op = operations[op_index]
-            while i < end and self.moments[i].operates_on(op.qubits):
+            while i < end and self._has_op_at(i, op.qubits):
                 i += 1
             if i >= end:
                 break
-            self.moments[i] = self.moments[i].with_operation(op)
+            self._moments.replace_moment(i,
+                                         self.moments[i].with_operation(op))
+            occupancy.add(op.qubits, i)
             op_index += 1
 
         if op_index >= len(operations):
@@ -452,10 +510,13 @@ class Circuit(object):
                 within.
         """
         qubits = frozenset(qubits)
+        occupancy = self._index()
         for k in moment_indices:
             if 0 <= k < len(self.moments):
-                self.moments[k] = self.moments[k].without_operations_touching(
-                    qubits)
+                moment = self.moments[k]
+                self._moments.replace_moment(
+                    k, moment.without_operations_touching(qubits))
+                occupancy.remove(moment.qubits - self.moments[k].qubits, k)
 
     def all_qubits(self) -> FrozenSet[QubitId]:
         """Returns the qubits acted upon by Operations in this circuit."""
@@ -597,6 +658,135 @@ class Circuit(object):
         return diagram
 
 
+class _MomentList(list):
+    """The moments of a circuit, along with the index of their qubits.
+
+    Changing the list in place drops the index, which is then rebuilt from
+    the moments when it is next needed. The circuit's methods for mutation
+    use replace_moment and insert_moment instead, and update the index
+    themselves.
+
+    Attributes:
+        occupancy: The index of the moments operating on each qubit, or None
+            if it has to be rebuilt.
+    """
+
+    occupancy = None  # type: Optional[_OccupancyIndex]
+
+    def replace_moment(self, index: int, moment: Moment) -> None:
+        super().__setitem__(index, moment)
+
+    def insert_moment(self, index: int, moment: Moment) -> None:
+        super().insert(index, moment)
+
+    def __setitem__(self, key, value):
+        self.occupancy = None
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.occupancy = None
+        super().__delitem__(key)
+
+    def __iadd__(self, other):  # type: ignore
+        self.occupancy = None
+        return super().__iadd__(other)
+
+    def __imul__(self, other):  # type: ignore
+        self.occupancy = None
+        return super().__imul__(other)
+
+    def append(self, moment):
+        self.occupancy = None
+        super().append(moment)
+
+    def extend(self, moments):
+        self.occupancy = None
+        super().extend(moments)
+
+    def insert(self, index, moment):
+        self.occupancy = None
+        super().insert(index, moment)
+
+    def pop(self, *args):
+        self.occupancy = None
+        return super().pop(*args)
+
+    def remove(self, moment):
+        self.occupancy = None
+        super().remove(moment)
+
+    def clear(self):
+        self.occupancy = None
+        super().clear()
+
+    def reverse(self):
+        self.occupancy = None
+        super().reverse()
+
+    def sort(self, *args, **kwargs):
+        self.occupancy = None
+        super().sort(*args, **kwargs)
+
+
+class _OccupancyIndex:
+    """The indices of the moments operating on each qubit of a circuit.
+
+    For each qubit, the indices of the moments with an operation on the qubit
+    are kept in a sorted list, so that moments are found by bisection.
+    """
+
+    def __init__(self, moments: Sequence[Moment]) -> None:
+        self._moment_indices = collections.defaultdict(
+            list)  # type: Dict[QubitId, List[int]]
+        for i, moment in enumerate(moments):
+            for q in moment.qubits:
+                self._moment_indices[q].append(i)
+
+    def next_moment_index(self,
+                          qubits: Iterable[QubitId],
+                          start: int,
+                          end: int) -> Optional[int]:
+        """Returns the first moment in [start, end) touching the qubits."""
+        best = None  # type: Optional[int]
+        for q in qubits:
+            indices = self._moment_indices.get(q, [])
+            i = bisect.bisect_left(indices, start)
+            if i < len(indices) and indices[i] < end and (
+                    best is None or indices[i] < best):
+                best = indices[i]
+        return best
+
+    def prev_moment_index(self,
+                          qubits: Iterable[QubitId],
+                          start: int,
+                          end: int) -> Optional[int]:
+        """Returns the last moment in [start, end) touching the qubits."""
+        best = None  # type: Optional[int]
+        for q in qubits:
+            indices = self._moment_indices.get(q, [])
+            i = bisect.bisect_left(indices, end) - 1
+            if i >= 0 and indices[i] >= start and (
+                    best is None or indices[i] > best):
+                best = indices[i]
+        return best
+
+    def add(self, qubits: Iterable[QubitId], moment_index: int) -> None:
+        for q in qubits:
+            bisect.insort_left(self._moment_indices[q], moment_index)
+
+    def remove(self, qubits: Iterable[QubitId], moment_index: int) -> None:
+        for q in qubits:
+            indices = self._moment_indices[q]
+            del indices[bisect.bisect_left(indices, moment_index)]
+
+    def shift_moments(self, moment_index: int) -> None:
+        """Moves the moments from the given index on one moment later."""
+        for indices in self._moment_indices.values():
+            i = bisect.bisect_left(indices, moment_index)
+            if i < len(indices):
+                indices[i:] = [m + 1 for m in indices[i:]]
+
+
 def _get_operation_text_diagram_info_with_fallback(
         op: ops.Operation,
         args: ops.TextDiagramInfoArgs,
@@ -735,7 +925,9 @@ def _operations_to_unitary_matrix(iter_ops: Iterable[ops.Operation],
                                   ignore_terminal_measurements: bool,
                                   ext: Extensions) -> np.ndarray:
     # Precondition is that circuit has only terminal measurements.
-    total = np.eye(1 << len(qubit_map))
+    qubit_count = len(qubit_map)
+    total = np.eye(1 << qubit_count).reshape((2,) * qubit_count +
+                                             (1 << qubit_count,))
     for op in iter_ops:
         meas_gate = ext.try_cast(ops.MeasurementGate, op.gate)
         if meas_gate is not None:
@@ -744,35 +936,52 @@ def _operations_to_unitary_matrix(iter_ops: Iterable[ops.Operation],
                     'Terminal measurement operation but not ignoring these '
                     'measurements: {!r}'.format(op))
             continue  # coverage: ignore
-        mat = _operation_to_unitary_matrix(op, qubit_map, ext)
-        total = np.matmul(mat, total)
-    return total
+        total = _apply_operation(op, total, qubit_map, ext)
+    return total.reshape((1 << qubit_count, 1 << qubit_count))
 
 
 def _operation_to_unitary_matrix(op: ops.Operation,
                                  qubit_map: Dict[QubitId, int],
                                  ext: Extensions) -> np.ndarray:
+    qubit_count = len(qubit_map)
+    identity = np.eye(1 << qubit_count, dtype=np.complex128)
+    result = _apply_operation(
+        op,
+        identity.reshape((2,) * qubit_count + (1 << qubit_count,)),
+        qubit_map,
+        ext)
+    return result.reshape((1 << qubit_count, 1 << qubit_count))
+
+
+def _apply_operation(op: ops.Operation,
+                     target: np.ndarray,
+                     qubit_map: Dict[QubitId, int],
+                     ext: Extensions) -> np.ndarray:
+    """Left multiplies a matrix, reshaped into a tensor, by an operation.
+
+    Args:
+        op: The operation to apply.
+        target: The matrix with its rows split into one axis of length 2 per
+            qubit, the first qubit of the qubit map being the most significant.
+        qubit_map: The axis of each qubit.
+        ext: The extensions to use when casting the operation to KnownMatrix.
+
+    Returns:
+        The product as a tensor of the same shape as target. It may share
+        memory with target, or not be contiguous.
+    """
     known_matrix_gate = ext.try_cast(ops.KnownMatrix, op)
     if known_matrix_gate is None:
         raise TypeError(
             'Operation without a known matrix: {!r}'.format(op))
-    sub_mat = known_matrix_gate.matrix()
-    qubit_count = len(qubit_map)
-    bit_locs = [qubit_count - qubit_map[q] - 1 for q in op.qubits][::-1]
-    over_mask = ~sum(1 << b for b in bit_locs)
-
-    result = np.zeros(shape=(1 << qubit_count, 1 << qubit_count),
-                      dtype=np.complex128)
-    for i in range(1 << qubit_count):
-        sub_i = sum(_moved_bit(i, b, k) for k, b in enumerate(bit_locs))
-        over_i = i & over_mask
-
-        for sub_j in range(sub_mat.shape[1]):
-            j = sum(_moved_bit(sub_j, k, b) for k, b in enumerate(bit_locs))
-            result[i, over_i | j] = sub_mat[sub_i, sub_j]
-
-    return result
-
-
-def _moved_bit(val: int, at: int, to: int) -> int:
-    return ((val >> at) & 1) << to
+    axes = [qubit_map[q] for q in op.qubits]
+    k = len(axes)
+    # Contracting arrays of different dtypes does not use BLAS.
+    sub_tensor = np.asarray(known_matrix_gate.matrix(),
+                            dtype=np.complex128).reshape((2,) * (2 * k))
+    target = np.asarray(target, dtype=np.complex128)
+    # The new row axes of the product come first, and are moved back into
+    # the place of the axes they were contracted with.
+    result = np.tensordot(sub_tensor, target, axes=(list(range(k, 2 * k)),
+                                                    axes))
+    return np.moveaxis(result, list(range(k)), axes)
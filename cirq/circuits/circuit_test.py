@@ -726,6 +726,36 @@ def test_from_ops():
     ])
 
 
+@pytest.mark.parametrize('strategy', [
+    InsertStrategy.NEW,
+    InsertStrategy.INLINE,
+    InsertStrategy.EARLIEST,
+    InsertStrategy.NEW_THEN_INLINE,
+])
+def test_from_ops_matches_append(strategy):
+    qubits = cirq.LineQubit.range(4)
+    gates = [cirq.X, cirq.Y, cirq.Z, cirq.H]
+    prng = np.random.RandomState(1234)
+    operations = []
+    for _ in range(100):
+        if prng.randint(2):
+            q = qubits[prng.randint(len(qubits))]
+            operations.append(gates[prng.randint(len(gates))](q))
+        else:
+            a, b = prng.choice(len(qubits), 2, replace=False)
+            operations.append(cirq.CZ(qubits[a], qubits[b]))
+
+    expected = Circuit()
+    expected.append(operations, strategy)
+    assert Circuit.from_ops(operations, strategy=strategy) == expected
+
+
+def test_from_ops_bad_strategy():
+    with pytest.raises(ValueError):
+        Circuit.from_ops(cirq.X(cirq.NamedQubit('a')), strategy='bad')
+    assert Circuit.from_ops(strategy='bad') == Circuit()
+
+
 def test_to_text_diagram_teleportation_to_diagram():
     ali = cirq.NamedQubit('(0, 0)')
     bob = cirq.NamedQubit('(0, 1)')
@@ -1091,6 +1121,25 @@ def test_operation_to_unitary_matrix():
         atol=1e-8)
 
 
+def test_operation_to_unitary_matrix_permuted_qubits():
+    ex = Extensions()
+    a, b, c, d = cirq.LineQubit.range(4)
+    qubit_map = {a: 0, b: 1, c: 2, d: 3}
+
+    # CCX with its control on d and target on b equals SWAP(b, d) CCX SWAP.
+    swap = _operation_to_unitary_matrix(cirq.SWAP(b, d), qubit_map, ex)
+    ccx = _operation_to_unitary_matrix(cirq.CCX(c, b, d), qubit_map, ex)
+    np.testing.assert_allclose(
+        _operation_to_unitary_matrix(cirq.CCX(c, d, b), qubit_map, ex),
+        swap.dot(ccx).dot(swap))
+    np.testing.assert_allclose(
+        ccx,
+        np.kron(np.eye(2),
+                np.kron(np.diag([1, 1, 1, 0]), np.eye(2)) +
+                np.kron(np.diag([0, 0, 0, 1]), cirq.X.matrix())),
+        atol=1e-8)
+
+
 def test_circuit_to_unitary_matrix():
     # Single qubit gates.
     a = cirq.NamedQubit('a')
@@ -1290,3 +1339,108 @@ def test_insert_moments():
     c.insert(0, m2)
     assert c.moments == [m2, m0, m1]
     assert c.moments[0] is m2
+
+
+def _assert_occupancy_index_matches_moments(c, qubits):
+    for i in range(-1, len(c) + 2):
+        for q in qubits:
+            expected = None
+            if 0 <= i < len(c):
+                expected = next((op for op in c.moments[i].operations
+                                 if q in op.qubits), None)
+            assert c.operation_at(q, i) is expected
+        for k in range(1, len(qubits) + 1):
+            touched = qubits[:k]
+            later = [j for j in range(max(i, 0), len(c))
+                     if c.moments[j].operates_on(touched)]
+            earlier = [j for j in range(min(i, len(c)))
+                       if c.moments[j].operates_on(touched)]
+            assert c.next_moment_operating_on(
+                touched, max(i, 0)) == (later[0] if later else None)
+            assert c.prev_moment_operating_on(
+                touched, max(i, 0)) == (earlier[-1] if earlier else None)
+
+
+def test_occupancy_index_stays_consistent():
+    a, b, c = cirq.LineQubit.range(3)
+    qubits = [a, b, c]
+
+    circuit = Circuit.from_ops(cirq.H(a), cirq.CNOT(a, b), cirq.X(c))
+    _assert_occupancy_index_matches_moments(circuit, qubits)
+
+    circuit.insert(1, cirq.CZ(b, c), strategy=InsertStrategy.NEW)
+    _assert_occupancy_index_matches_moments(circuit, qubits)
+
+    circuit.insert(0, Moment([cirq.Z(a)]))
+    _assert_occupancy_index_matches_moments(circuit, qubits)
+
+    circuit.append([cirq.Y(a), cirq.Y(c)], strategy=InsertStrategy.EARLIEST)
+    _assert_occupancy_index_matches_moments(circuit, qubits)
+
+    circuit.insert_into_range([cirq.X(b), cirq.X(b), cirq.X(b)], 0, 2)
+    _assert_occupancy_index_matches_moments(circuit, qubits)
+
+    circuit.clear_operations_touching([b], range(len(circuit)))
+    _assert_occupancy_index_matches_moments(circuit, qubits)
+
+    circuit += Circuit.from_ops(cirq.CZ(a, c))
+    _assert_occupancy_index_matches_moments(circuit, qubits)
+
+    circuit *= 2
+    _assert_occupancy_index_matches_moments(circuit, qubits)
+
+    circuit.moments = circuit.moments[::-1]
+    _assert_occupancy_index_matches_moments(circuit, qubits)
+
+    circuit.insert(-1, Moment([cirq.X(b)]))
+    _assert_occupancy_index_matches_moments(circuit, qubits)
+
+
+def _assert_occupancy_index_is_fresh(c, qubits):
+    fresh = Circuit(list(c.moments))
+    for i in range(len(c) + 2):
+        for k in range(1, len(qubits) + 1):
+            touched = qubits[:k]
+            assert (c.next_moment_operating_on(touched, i) ==
+                    fresh.next_moment_operating_on(touched, i))
+            assert (c.prev_moment_operating_on(touched, i) ==
+                    fresh.prev_moment_operating_on(touched, i))
+            assert [c.operation_at(q, i) for q in touched] == [
+                fresh.operation_at(q, i) for q in touched]
+
+
+def test_occupancy_index_after_moments_changed_in_place():
+    a, b, c = cirq.LineQubit.range(3)
+    qubits = [a, b, c]
+    circuit = Circuit.from_ops(cirq.H(a), cirq.CNOT(a, b), cirq.X(c))
+    _assert_occupancy_index_is_fresh(circuit, qubits)
+
+    circuit.moments.append(Moment([cirq.X(b)]))
+    _assert_occupancy_index_is_fresh(circuit, qubits)
+
+    circuit.moments[0] = Moment([cirq.Y(b)])
+    _assert_occupancy_index_is_fresh(circuit, qubits)
+
+    del circuit.moments[1]
+    _assert_occupancy_index_is_fresh(circuit, qubits)
+
+    circuit.moments.insert(0, Moment([cirq.CZ(a, c)]))
+    _assert_occupancy_index_is_fresh(circuit, qubits)
+
+    circuit.moments.extend([Moment(), Moment([cirq.Z(c)])])
+    _assert_occupancy_index_is_fresh(circuit, qubits)
+
+    circuit.moments[1:3] = [Moment([cirq.Z(a)])]
+    _assert_occupancy_index_is_fresh(circuit, qubits)
+
+    circuit.moments.pop()
+    _assert_occupancy_index_is_fresh(circuit, qubits)
+
+    circuit.moments.reverse()
+    _assert_occupancy_index_is_fresh(circuit, qubits)
+
+    circuit.moments += [Moment([cirq.X(a)])]
+    _assert_occupancy_index_is_fresh(circuit, qubits)
+
+    circuit.moments.clear()
+    _assert_occupancy_index_is_fresh(circuit, qubits)
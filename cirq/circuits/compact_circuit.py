@@ -0,0 +1,286 @@
+# Copyright 2018 The Cirq Developers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An array backed form of a circuit for circuits with very many gates."""
+
+import array
+from typing import (FrozenSet, Iterable, Iterator, List, Optional, Sequence,
+                    Tuple, Union)
+from typing import Dict  # pylint: disable=unused-import
+
+import numpy as np
+
+from cirq import ops
+from cirq.circuits.circuit import Circuit
+from cirq.circuits.moment import Moment
+from cirq.ops import QubitId
+
+
+# The number of moments read out of the arrays at a time while iterating.
+_MOMENTS_PER_CHUNK = 1024
+
+
+class CompactCircuit(object):
+    """An immutable circuit stored as a few flat arrays.
+
+    A Circuit holds a GateOperation object per operation and a Moment object
+    per moment, which costs hundreds of bytes per gate. A CompactCircuit
+    instead stores each distinct qubit and each distinct gate once, and
+    describes the operations with integer arrays:
+
+        gate_ids[k] is the index into gates of the gate of the k'th
+            operation.
+        qubit_ids[qubit_offsets[k]:qubit_offsets[k + 1]] are the indices into
+            qubits of the qubits the k'th operation acts on.
+        The operations of the m'th moment are those with index in
+            range(moment_offsets[m], moment_offsets[m + 1]).
+
+    Gate parameters are part of the entries of the gate table, so a circuit
+    made of a few kinds of gates takes a few bytes per operation regardless
+    of its length.
+
+    Converting to and from a Circuit is lossless. The xmon simulator, the
+    schedulers and the engine accept a CompactCircuit wherever they accept a
+    Circuit. The schedulers, the xmon simulator, and the engine for circuits
+    of xmon gates, work through the moments one at a time. The xmon
+    simulator converts each distinct gate to xmon gates once, and only fuses
+    gates within the conversion of a single gate. Only GateOperations can be
+    stored.
+
+    Attributes:
+        qubits: The distinct qubits of the circuit, in order of first use.
+        gates: The distinct gates of the circuit, in order of first use.
+        gate_ids: An int32 array with the gate index of each operation.
+        qubit_ids: An int32 array with the qubit indices of all operations.
+        qubit_offsets: An int64 array with the start of the qubit indices of
+            each operation in qubit_ids, followed by the length of qubit_ids.
+        moment_offsets: An int64 array with the index of the first operation
+            of each moment, followed by the number of operations.
+    """
+
+    def __init__(self,
+                 qubits: Sequence[QubitId],
+                 gates: Sequence[ops.Gate],
+                 gate_ids: np.ndarray,
+                 qubit_ids: np.ndarray,
+                 qubit_offsets: np.ndarray,
+                 moment_offsets: np.ndarray) -> None:
+        """Initializes a compact circuit from its tables and arrays.
+
+        Use from_circuit or from_moments to build one from operations.
+
+        Raises:
+            ValueError: The arrays are inconsistent with each other.
+        """
+        self.qubits = tuple(qubits)
+        self.gates = tuple(gates)
+        self.gate_ids = np.asarray(gate_ids, dtype=np.int32)
+        self.qubit_ids = np.asarray(qubit_ids, dtype=np.int32)
+        self.qubit_offsets = np.asarray(qubit_offsets, dtype=np.int64)
+        self.moment_offsets = np.asarray(moment_offsets, dtype=np.int64)
+        self._validate()
+
+    def _validate(self) -> None:
+        num_ops = len(self.gate_ids)
+        if (len(self.qubit_offsets) != num_ops + 1 or
+                self.qubit_offsets[0] != 0 or
+                self.qubit_offsets[-1] != len(self.qubit_ids) or
+                np.any(np.diff(self.qubit_offsets) < 0)):
+            raise ValueError('Qubit offsets do not match the operations.')
+        if (len(self.moment_offsets) == 0 or
+                self.moment_offsets[0] != 0 or
+                self.moment_offsets[-1] != num_ops or
+                np.any(np.diff(self.moment_offsets) < 0)):
+            raise ValueError('Moment offsets do not match the operations.')
+        if num_ops and not (0 <= self.gate_ids.min() and
+                            self.gate_ids.max() < len(self.gates)):
+            raise ValueError('Gate id out of range.')
+        num_qubits = len(self.qubits)
+        if len(self.qubit_ids) and not (0 <= self.qubit_ids.min() and
+                                        self.qubit_ids.max() < num_qubits):
+            raise ValueError('Qubit id out of range.')
+
+    @staticmethod
+    def from_moments(
+            moments: Iterable[Union[Moment, Iterable[ops.Operation]]]
+    ) -> 'CompactCircuit':
+        """Builds a compact circuit from a stream of moments.
+
+        The moments are consumed one at a time, so a generator of moments can
+        describe a circuit that would not fit in memory as a Circuit.
+
+        Args:
+            moments: The moments of the circuit, each given as a Moment or an
+                iterable of operations on distinct qubits.
+
+        Raises:
+            TypeError: An operation is not a GateOperation.
+            ValueError: Two operations of a moment act on the same qubit.
+        """
+        qubit_indices = {}  # type: Dict[QubitId, int]
+        qubits = []  # type: List[QubitId]
+        gates = _GateTable()
+        gate_ids = array.array('i')
+        qubit_ids = array.array('i')
+        qubit_offsets = array.array('q', [0])
+        moment_offsets = array.array('q', [0])
+
+        for moment_or_ops in moments:
+            moment = (moment_or_ops if isinstance(moment_or_ops, Moment)
+                      else Moment(moment_or_ops))
+            for op in moment.operations:
+                if not isinstance(op, ops.GateOperation):
+                    raise TypeError(
+                        'Not a GateOperation: {!r}'.format(op))
+                gate_ids.append(gates.index(op.gate))
+                for q in op.qubits:
+                    i = qubit_indices.get(q)  # type: Optional[int]
+                    if i is None:
+                        i = qubit_indices[q] = len(qubits)
+                        qubits.append(q)
+                    qubit_ids.append(i)
+                qubit_offsets.append(len(qubit_ids))
+            moment_offsets.append(len(gate_ids))
+
+        return CompactCircuit(qubits=qubits,
+                              gates=gates.gates,
+                              gate_ids=np.frombuffer(gate_ids, np.int32),
+                              qubit_ids=np.frombuffer(qubit_ids, np.int32),
+                              qubit_offsets=np.frombuffer(qubit_offsets,
+                                                          np.int64),
+                              moment_offsets=np.frombuffer(moment_offsets,
+                                                           np.int64))
+
+    @staticmethod
+    def from_circuit(circuit: Circuit) -> 'CompactCircuit':
+        """Builds a compact circuit with the same moments as a Circuit.
+
+        Raises:
+            TypeError: The circuit contains an operation that is not a
+                GateOperation.
+        """
+        return CompactCircuit.from_moments(circuit.moments)
+
+    def to_circuit(self) -> Circuit:
+        """Returns a Circuit with the same moments as this compact circuit."""
+        return Circuit(self.iter_moments())
+
+    def iter_moments(self, start: int = 0) -> Iterator[Moment]:
+        """Yields the moments of the circuit one at a time.
+
+        Args:
+            start: The index of the first moment to yield.
+        """
+        for moment_ids in self.iter_moment_indices(start):
+            yield Moment(self._operation(gate_id, qubit_ids)
+                         for gate_id, qubit_ids in moment_ids)
+
+    def iter_moment_indices(self, start: int = 0
+                            ) -> Iterator[List[Tuple[int, Tuple[int, ...]]]]:
+        """Yields the gate and qubit indices of each moment's operations.
+
+        Only a bounded number of moments are read out of the arrays at a
+        time, so iterating does not copy the whole circuit.
+
+        Args:
+            start: The index of the first moment to yield.
+
+        Yields:
+            For each moment, a list with the index into gates and the indices
+            into qubits of each of its operations.
+        """
+        num_moments = len(self)
+        for chunk_start in range(start, num_moments, _MOMENTS_PER_CHUNK):
+            chunk_end = min(chunk_start + _MOMENTS_PER_CHUNK, num_moments)
+            first_op = int(self.moment_offsets[chunk_start])
+            end_op = int(self.moment_offsets[chunk_end])
+            first_qubit = int(self.qubit_offsets[first_op])
+            gate_ids = self.gate_ids[first_op:end_op].tolist()
+            qubit_ids = self.qubit_ids[
+                first_qubit:int(self.qubit_offsets[end_op])].tolist()
+            qubit_offsets = (self.qubit_offsets[first_op:end_op + 1] -
+                             first_qubit).tolist()
+            op_offsets = (self.moment_offsets[chunk_start:chunk_end + 1] -
+                          first_op).tolist()
+            for m in range(chunk_end - chunk_start):
+                yield [(gate_ids[k],
+                        tuple(qubit_ids[qubit_offsets[k]:qubit_offsets[k + 1]]))
+                       for k in range(op_offsets[m], op_offsets[m + 1])]
+
+    def all_operations(self) -> Iterator[ops.Operation]:
+        """Yields the operations of the circuit, moment by moment."""
+        for moment_ids in self.iter_moment_indices():
+            for gate_id, qubit_ids in moment_ids:
+                yield self._operation(gate_id, qubit_ids)
+
+    def _operation(self, gate_id: int, qubit_ids: Tuple[int, ...]
+                   ) -> ops.GateOperation:
+        return ops.GateOperation(self.gates[gate_id],
+                                 [self.qubits[i] for i in qubit_ids])
+
+    def all_qubits(self) -> FrozenSet[QubitId]:
+        return frozenset(self.qubits)
+
+    def operation_count(self) -> int:
+        return len(self.gate_ids)
+
+    def __len__(self):
+        return len(self.moment_offsets) - 1
+
+    def __eq__(self, other):
+        if not isinstance(other, type(self)):
+            return NotImplemented
+        return (len(self) == len(other) and
+                all(a == b for a, b in zip(self.iter_moments(),
+                                           other.iter_moments())))
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None  # type: ignore
+
+    def __repr__(self):
+        return 'cirq.CompactCircuit.from_circuit({!r})'.format(
+            self.to_circuit())
+
+    def __str__(self):
+        return str(self.to_circuit())
+
+
+class _GateTable:
+    """Assigns an index to each distinct gate.
+
+    Equal hashable gates share an index. Unhashable gates are only shared when
+    they are the same object.
+    """
+
+    def __init__(self) -> None:
+        self.gates = []  # type: List[ops.Gate]
+        self._indices = {}  # type: Dict[ops.Gate, int]
+        self._unhashable_indices = {}  # type: Dict[int, Tuple[ops.Gate, int]]
+
+    def index(self, gate: ops.Gate) -> int:
+        try:
+            i = self._indices.get(gate)  # type: Optional[int]
+        except TypeError:
+            entry = self._unhashable_indices.get(id(gate))
+            if entry is None:
+                entry = self._unhashable_indices[id(gate)] = (gate,
+                                                              len(self.gates))
+                self.gates.append(gate)
+            return entry[1]
+        if i is None:
+            i = self._indices[gate] = len(self.gates)
+            self.gates.append(gate)
+        return i
@@ -0,0 +1,172 @@
+# Copyright 2018 The Cirq Developers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+
+import cirq
+from cirq.circuits import CompactCircuit
+
+a, b, c = cirq.LineQubit.range(3)
+
+
+def test_round_trip():
+    circuit = cirq.Circuit([
+        cirq.Moment([cirq.H(a), cirq.X(c)**0.25]),
+        cirq.Moment(),
+        cirq.Moment([cirq.CNOT(a, b)]),
+        cirq.Moment([cirq.CNOT(c, b),
+                     cirq.RotZGate(half_turns=cirq.Symbol('t')).on(a)]),
+        cirq.Moment([cirq.measure(a, b, c, key='m')]),
+    ])
+    compact = CompactCircuit.from_circuit(circuit)
+    assert len(compact) == 5
+    assert compact.operation_count() == 6
+    assert compact.all_qubits() == circuit.all_qubits()
+    assert compact.to_circuit() == circuit
+    assert list(compact.iter_moments()) == circuit.moments
+    assert list(compact.all_operations()) == list(circuit.all_operations())
+
+
+def test_arrays():
+    compact = CompactCircuit.from_circuit(cirq.Circuit([
+        cirq.Moment([cirq.H(b)]),
+        cirq.Moment([cirq.CNOT(b, a), cirq.H(c)]),
+        cirq.Moment([cirq.H(a)]),
+    ]))
+    assert compact.qubits == (b, a, c)
+    assert compact.gates == (cirq.H, cirq.CNOT)
+    np.testing.assert_equal(compact.gate_ids, [0, 1, 0, 0])
+    np.testing.assert_equal(compact.qubit_ids, [0, 0, 1, 2, 1])
+    np.testing.assert_equal(compact.qubit_offsets, [0, 1, 3, 4, 5])
+    np.testing.assert_equal(compact.moment_offsets, [0, 1, 3, 4])
+    assert compact.gate_ids.dtype == np.int32
+    assert compact.moment_offsets.dtype == np.int64
+
+
+def test_iter_moments_from_start(monkeypatch):
+    monkeypatch.setattr(cirq.circuits.compact_circuit, '_MOMENTS_PER_CHUNK', 2)
+    circuit = cirq.Circuit([
+        cirq.Moment([cirq.H(a), cirq.CNOT(b, c)]),
+        cirq.Moment(),
+        cirq.Moment([cirq.X(b)]),
+        cirq.Moment([cirq.CZ(a, c)]),
+        cirq.Moment([cirq.measure(a, b, c, key='m')]),
+    ])
+    compact = CompactCircuit.from_circuit(circuit)
+    for start in range(len(circuit) + 1):
+        assert list(compact.iter_moments(start)) == circuit.moments[start:]
+    assert list(compact.all_operations()) == list(circuit.all_operations())
+    assert list(compact.iter_moment_indices(3)) == [[(3, (0, 2))],
+                                                    [(4, (0, 1, 2))]]
+
+
+def test_empty():
+    compact = CompactCircuit.from_circuit(cirq.Circuit())
+    assert len(compact) == 0
+    assert compact.operation_count() == 0
+    assert compact.to_circuit() == cirq.Circuit()
+
+
+def test_from_moments_generator():
+    qubits = cirq.LineQubit.range(4)
+    compact = CompactCircuit.from_moments(
+        [cirq.CZ(qubits[i], qubits[i + 1]) for i in range(j % 2, 3, 2)]
+        for j in range(1000))
+    assert len(compact) == 1000
+    assert compact.operation_count() == 1500
+    assert compact.gates == (cirq.CZ,)
+    assert compact.to_circuit()[1] == cirq.Moment([cirq.CZ(qubits[1],
+                                                           qubits[2])])
+
+
+def test_from_moments_overlapping_operations():
+    with pytest.raises(ValueError):
+        CompactCircuit.from_moments([[cirq.X(a), cirq.Y(a)]])
+
+
+def test_unhashable_gates():
+    class UnhashableGate(cirq.Gate):
+        def __eq__(self, other):
+            return isinstance(other, type(self))
+
+        __hash__ = None  # type: ignore
+
+    gate = UnhashableGate()
+    circuit = cirq.Circuit.from_ops(gate(a, b), gate(b, c),
+                                    UnhashableGate()(a, b))
+    compact = CompactCircuit.from_circuit(circuit)
+    assert len(compact.gates) == 2
+    assert compact.to_circuit() == circuit
+
+
+def test_not_gate_operation():
+    class NoGateOperation(cirq.Operation):
+        qubits = (a,)
+
+        def with_qubits(self, *new_qubits):
+            raise NotImplementedError()
+
+    with pytest.raises(TypeError):
+        CompactCircuit.from_moments([[NoGateOperation()]])
+
+
+def test_inconsistent_arrays():
+    with pytest.raises(ValueError, match='Qubit offsets'):
+        CompactCircuit((a,), (cirq.X,), [0], [0], [0, 2], [0, 1])
+    with pytest.raises(ValueError, match='Moment offsets'):
+        CompactCircuit((a,), (cirq.X,), [0], [0], [0, 1], [0, 2])
+    with pytest.raises(ValueError, match='Gate id'):
+        CompactCircuit((a,), (cirq.X,), [1], [0], [0, 1], [0, 1])
+    with pytest.raises(ValueError, match='Qubit id'):
+        CompactCircuit((a,), (cirq.X,), [0], [1], [0, 1], [0, 1])
+
+
+def test_equality():
+    circuit = cirq.Circuit.from_ops(cirq.H(a), cirq.CNOT(a, b))
+    eq = cirq.testing.EqualsTester()
+    eq.make_equality_group(lambda: CompactCircuit.from_circuit(circuit))
+    eq.add_equality_group(CompactCircuit.from_circuit(circuit + circuit))
+    eq.add_equality_group(CompactCircuit.from_circuit(cirq.Circuit()))
+
+
+def test_repr_and_str():
+    circuit = cirq.Circuit.from_ops(cirq.H(a), cirq.CNOT(a, b))
+    compact = CompactCircuit.from_circuit(circuit)
+    assert str(compact) == str(circuit)
+    assert repr(compact) == 'cirq.CompactCircuit.from_circuit({!r})'.format(
+        circuit)
+
+
+def test_schedule():
+    device = cirq.google.Foxtail
+    q0, q1 = cirq.GridQubit(0, 0), cirq.GridQubit(0, 1)
+    circuit = cirq.Circuit.from_ops(
+        cirq.google.ExpWGate().on(q0),
+        cirq.google.Exp11Gate().on(q0, q1),
+        cirq.google.XmonMeasurementGate('m').on(q1))
+    assert (cirq.moment_by_moment_schedule(
+        device, CompactCircuit.from_circuit(circuit)) ==
+            cirq.moment_by_moment_schedule(device, circuit))
+
+
+def test_xmon_simulator():
+    circuit = cirq.Circuit.from_ops(
+        cirq.RotXGate(half_turns=cirq.Symbol('t')).on(a),
+        cirq.CNOT(a, b),
+        cirq.measure(a, b, key='m'))
+    results = cirq.google.XmonSimulator().run_sweep(
+        CompactCircuit.from_circuit(circuit), cirq.Points('t', [0, 1]))
+    np.testing.assert_equal([r.measurements['m'] for r in results],
+                            [[[False, False]], [[True, True]]])
@@ -14,7 +14,8 @@
 
 """A simplified time-slice of operations within a sequenced circuit."""
 
-from typing import Iterable
+from typing import Iterable, Optional
+from typing import Dict  # pylint: disable=unused-import
 
 from cirq import ops
 
@@ -46,12 +47,16 @@ class Moment(object):
         """
         self.operations = tuple(operations)
 
-        # Check that operations don't overlap.
-        affected_qubits = [q for op in self.operations for q in op.qubits]
-        self.qubits = frozenset(affected_qubits)
-        if len(affected_qubits) != len(self.qubits):
-            raise ValueError(
-                'Overlapping operations: {}'.format(self.operations))
+        # Map each qubit to the operation on it, checking that operations
+        # don't overlap.
+        self._qubit_to_op = {}  # type: Dict[ops.QubitId, ops.Operation]
+        for op in self.operations:
+            for q in op.qubits:
+                if q in self._qubit_to_op:
+                    raise ValueError(
+                        'Overlapping operations: {}'.format(self.operations))
+                self._qubit_to_op[q] = op
+        self.qubits = frozenset(self._qubit_to_op)
 
     def operates_on(self, qubits: Iterable[ops.QubitId]) -> bool:
         """Determines if the moment has operations touching the given qubits.
@@ -62,8 +67,19 @@ class Moment(object):
         Returns:
             Whether this moment has operations involving the qubits.
         """
-        qubits = frozenset(qubits)
-        return any(q in qubits for op in self.operations for q in op.qubits)
+        return any(q in self._qubit_to_op for q in qubits)
+
+    def operation_at(self, qubit: ops.QubitId) -> Optional[ops.Operation]:
+        """Returns the operation on the given qubit, if any.
+
+        Args:
+            qubit: The qubit to look up.
+
+        Returns:
+            None if no operation of the moment touches the qubit, or else the
+            operation.
+        """
+        return self._qubit_to_op.get(qubit)
 
     def with_operation(self, operation: ops.Operation):
         """Returns an equal moment, but with the given op added.
@@ -85,12 +101,13 @@ class Moment(object):
         Returns:
             The new moment.
         """
-        qubits = frozenset(qubits)
-        if not self.operates_on(qubits):
+        # Operations need not be hashable, so they are compared by id.
+        removed = {id(self._qubit_to_op[q]) for q in qubits
+                   if q in self._qubit_to_op}
+        if not removed:
             return self
-        return Moment(
-            operation for operation in self.operations
-            if qubits.isdisjoint(frozenset(operation.qubits)))
+        return Moment(operation for operation in self.operations
+                      if id(operation) not in removed)
 
     def __copy__(self):
         return type(self)(self.operations)
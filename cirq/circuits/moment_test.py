@@ -107,6 +107,26 @@ def test_operates_on():
     assert Moment([ops.X(a), ops.X(b)]).operates_on([a, b, c])
 
 
+def test_operation_at():
+    a = ops.QubitId()
+    b = ops.QubitId()
+    c = ops.QubitId()
+
+    assert Moment().operation_at(a) is None
+
+    cz = ops.CZ(a, b)
+    moment = Moment([cz])
+    assert moment.operation_at(a) is cz
+    assert moment.operation_at(b) is cz
+    assert moment.operation_at(c) is None
+
+    x = ops.X(c)
+    moment = moment.with_operation(x)
+    assert moment.operation_at(a) is cz
+    assert moment.operation_at(c) is x
+    assert moment.without_operations_touching([b]).operation_at(a) is None
+
+
 def test_with_operation():
     a = ops.QubitId()
     b = ops.QubitId()
@@ -25,3 +25,7 @@ from cirq.contrib.paulistring.pauli_interaction_gate import (
 from cirq.contrib.paulistring.pauli_string import (
     PauliString,
 )
+from cirq.contrib.paulistring.stabilizer_simulator import (
+    StabilizerSimulator,
+    StabilizerTableau,
+)
@@ -0,0 +1,464 @@
+# Copyright 2018 The Cirq Developers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""StabilizerSimulator for simulating Clifford circuits on many qubits.
+
+Rather than a wave function, the simulator keeps the stabilizer tableau of
+the state (Aaronson and Gottesman, "Improved Simulation of Stabilizer
+Circuits", arXiv:quant-ph/0406196). The tableau of n qubits has 2n rows of
+2n + 1 bits, so circuits on hundreds or thousands of qubits can be simulated,
+as long as every operation is a Clifford operation or a measurement.
+
+A simple example:
+    circuit = Circuit.from_ops(H(q1), CNOT(q1, q2), measure(q1, q2))
+    sim = StabilizerSimulator()
+    results = sim.run(circuit, repetitions=1000)
+"""
+
+from typing import (Dict, Iterator, List, Optional, Sequence, Tuple, Union,
+                    cast)
+
+import numpy as np
+
+from cirq import ops, value
+from cirq.circuits import Circuit
+from cirq.extension import Extensions
+from cirq.schedules import Schedule
+from cirq.study import ParamResolver, Sweepable, TrialResult, to_resolvers
+
+from cirq.contrib.paulistring.clifford_gate import CliffordGate
+from cirq.contrib.paulistring.pauli import Pauli
+
+
+# A single qubit Clifford gate, a CNOT, a CZ or a measurement, together with
+# the indices of the qubits it acts on.
+_Instruction = Tuple[str, Tuple[int, ...], Union[CliffordGate, ops.Operation,
+                                                 None]]
+
+# The Clifford gates that rotating around each axis by 0, 1, 2 and 3 quarter
+# turns is equal to.
+_QUARTER_TURN_GATES = {
+    ops.RotXGate: (CliffordGate.I, CliffordGate.X_sqrt, CliffordGate.X,
+                   CliffordGate.X_nsqrt),
+    ops.RotYGate: (CliffordGate.I, CliffordGate.Y_sqrt, CliffordGate.Y,
+                   CliffordGate.Y_nsqrt),
+    ops.RotZGate: (CliffordGate.I, CliffordGate.Z_sqrt, CliffordGate.Z,
+                   CliffordGate.Z_nsqrt),
+}
+
+# The two qubit gates that are Clifford operations at whole half turns.
+_TWO_QUBIT_GATE_TYPES = (ops.CNotGate, ops.Rot11Gate, ops.SwapGate)
+
+
+class StabilizerTableau:
+    """The stabilizer tableau of a state of qubits.
+
+    Rows 0 to n - 1 of the tableau are the destabilizers of the state and
+    rows n to 2n - 1 its stabilizers. Each row is a Pauli string with a sign;
+    the Pauli on qubit j is X, Y or Z when the bits xs[row, j] and zs[row, j]
+    are (1, 0), (1, 1) or (0, 1), and the string is negated when rs[row] is
+    set. Gates update whole columns of the tableau at once.
+
+    Attributes:
+        num_qubits: The number of qubits of the state.
+        xs: The X bits of the tableau, of shape (2n, n).
+        zs: The Z bits of the tableau, of shape (2n, n).
+        rs: The signs of the rows of the tableau, of shape (2n,).
+    """
+
+    def __init__(self, num_qubits: int) -> None:
+        """Initializes the tableau of the all zeros state.
+
+        Args:
+            num_qubits: The number of qubits of the state.
+        """
+        self.num_qubits = num_qubits
+        self.xs = np.zeros((2 * num_qubits, num_qubits), dtype=bool)
+        self.zs = np.zeros((2 * num_qubits, num_qubits), dtype=bool)
+        self.rs = np.zeros(2 * num_qubits, dtype=bool)
+        self.xs[:num_qubits] = np.eye(num_qubits, dtype=bool)
+        self.zs[num_qubits:] = np.eye(num_qubits, dtype=bool)
+
+    def copy(self) -> 'StabilizerTableau':
+        """Returns a copy of the tableau."""
+        result = StabilizerTableau(0)
+        result.num_qubits = self.num_qubits
+        result.xs = self.xs.copy()
+        result.zs = self.zs.copy()
+        result.rs = self.rs.copy()
+        return result
+
+    def apply_clifford(self, index: int, gate: CliffordGate) -> None:
+        """Applies a single qubit Clifford gate to a qubit.
+
+        Args:
+            index: The index of the qubit.
+            gate: The gate to apply.
+        """
+        x = self.xs[:, index].copy()
+        z = self.zs[:, index].copy()
+        for pauli, mask in ((Pauli.X, x & ~z),
+                            (Pauli.Y, x & z),
+                            (Pauli.Z, ~x & z)):
+            to, flip = gate.transform(pauli)
+            self.xs[mask, index] = to != Pauli.Z
+            self.zs[mask, index] = to != Pauli.X
+            if flip:
+                self.rs[mask] ^= True
+
+    def apply_cnot(self, control: int, target: int) -> None:
+        """Applies a CNOT to a pair of qubits.
+
+        Args:
+            control: The index of the control qubit.
+            target: The index of the target qubit.
+        """
+        xc, zc = self.xs[:, control], self.zs[:, control]
+        xt, zt = self.xs[:, target], self.zs[:, target]
+        self.rs ^= xc & zt & ~(xt ^ zc)
+        xt ^= xc
+        zc ^= zt
+
+    def apply_cz(self, index0: int, index1: int) -> None:
+        """Applies a CZ to a pair of qubits.
+
+        Args:
+            index0: The index of one of the qubits.
+            index1: The index of the other qubit.
+        """
+        x0, z0 = self.xs[:, index0], self.zs[:, index0]
+        x1, z1 = self.xs[:, index1], self.zs[:, index1]
+        self.rs ^= x0 & x1 & (z0 ^ z1)
+        z0 ^= x1
+        z1 ^= x0
+
+    def measure(self, index: int) -> bool:
+        """Measures a qubit in the computational basis.
+
+        Args:
+            index: The index of the qubit.
+
+        Returns:
+            True if the measured qubit is in the |1> state.
+        """
+        n = self.num_qubits
+        anticommuting = np.flatnonzero(self.xs[n:, index])
+        if not len(anticommuting):
+            return self._deterministic_outcome(index)
+
+        # The outcome is random. The first anticommuting stabilizer becomes
+        # a destabilizer and is replaced by +-Z on the measured qubit, after
+        # being multiplied into every other row that anticommutes with Z.
+        p = n + anticommuting[0]
+        rows = np.flatnonzero(self.xs[:, index])
+        self._multiply_rows(rows[rows != p], p)
+        self.xs[p - n] = self.xs[p]
+        self.zs[p - n] = self.zs[p]
+        self.rs[p - n] = self.rs[p]
+        self.xs[p] = False
+        self.zs[p] = False
+        self.zs[p, index] = True
+        self.rs[p] = np.random.randint(2) == 1
+        return bool(self.rs[p])
+
+    def _deterministic_outcome(self, index: int) -> bool:
+        """Returns the sign of Z on the qubit, which is in the stabilizers.
+
+        Z is the product of the stabilizers whose destabilizers anticommute
+        with it. The partial products are cumulative XORs of their bits, so
+        the phase of every step of the product is found at once.
+        """
+        n = self.num_qubits
+        rows = n + np.flatnonzero(self.xs[:n, index])
+        xs = self.xs[rows]
+        zs = self.zs[rows]
+        prefix_xs = np.logical_xor.accumulate(xs, axis=0)
+        prefix_zs = np.logical_xor.accumulate(zs, axis=0)
+        phase = 2 * int(np.sum(self.rs[rows])) + int(np.sum(_phase_exponents(
+            xs[1:], zs[1:], prefix_xs[:-1], prefix_zs[:-1])))
+        return phase % 4 == 2
+
+    def _multiply_rows(self, targets: np.ndarray, source: int) -> None:
+        """Multiplies the source row into each of the target rows."""
+        x, z = self.xs[source], self.zs[source]
+        phase = (2 * self.rs[targets].astype(np.int64) +
+                 2 * int(self.rs[source]) +
+                 _phase_exponents(x, z, self.xs[targets], self.zs[targets]))
+        self.rs[targets] = phase % 4 == 2
+        self.xs[targets] ^= x
+        self.zs[targets] ^= z
+
+
+def _phase_exponents(x1: np.ndarray,
+                     z1: np.ndarray,
+                     x2: np.ndarray,
+                     z2: np.ndarray) -> np.ndarray:
+    """Returns the power of i in the products of two Pauli strings.
+
+    The exponents of the Paulis of each qubit, given by their X and Z bits,
+    are summed over the last axis. The sum is 0 or 2 modulo 4 when the
+    strings are two rows of a tableau, which always commute or anticommute
+    an even number of times in the right order.
+    """
+    x1 = x1.astype(np.int64)
+    z1 = z1.astype(np.int64)
+    x2 = x2.astype(np.int64)
+    z2 = z2.astype(np.int64)
+    exponents = (x1 * z1 * (z2 - x2) +
+                 x1 * (1 - z1) * z2 * (2 * x2 - 1) +
+                 (1 - x1) * z1 * x2 * (1 - 2 * z2))
+    return np.sum(exponents, axis=-1)
+
+
+class StabilizerSimulator:
+    """Simulates Clifford circuits using their stabilizer tableau.
+
+    The simulator understands CliffordGate, PauliInteractionGate at whole
+    half turns, measurements, and the common gates that are Clifford
+    operations: H, CNOT, CZ and SWAP at whole half turns, and the X, Y and Z
+    rotations at multiples of a quarter turn. Other operations are
+    decomposed until they are understood.
+
+    The gates before the first measurement are only applied once; each
+    repetition starts from a copy of the resulting tableau.
+    """
+
+    def run(
+        self,
+        circuit: Circuit,
+        param_resolver: ParamResolver = ParamResolver({}),
+        repetitions: int = 1,
+        qubit_order: ops.QubitOrderOrList = ops.QubitOrder.DEFAULT,
+        extensions: Extensions = None,
+    ) -> TrialResult:
+        """Runs the entire supplied Circuit, mimicking the quantum hardware.
+
+        The initial state is the all zeros state in the computational basis.
+
+        Args:
+            circuit: The circuit to simulate.
+            param_resolver: Parameters to run with the program.
+            repetitions: The number of repetitions to simulate.
+            qubit_order: Determines the canonical ordering of the qubits.
+            extensions: Extensions that will be applied while trying to
+                decompose the circuit's operations into Clifford operations.
+
+        Returns:
+            TrialResult for a run.
+        """
+        return self.run_sweep(circuit, [param_resolver], repetitions,
+                              qubit_order, extensions)[0]
+
+    def run_sweep(
+            self,
+            program: Union[Circuit, Schedule],
+            params: Sweepable = ParamResolver({}),
+            repetitions: int = 1,
+            qubit_order: ops.QubitOrderOrList = ops.QubitOrder.DEFAULT,
+            extensions: Extensions = None
+    ) -> List[TrialResult]:
+        """Runs the entire supplied Circuit, mimicking the quantum hardware.
+
+        The initial state is the all zeros state in the computational basis.
+
+        Args:
+            program: The circuit or schedule to simulate.
+            params: Parameters to run with the program.
+            repetitions: The number of repetitions to simulate.
+            qubit_order: Determines the canonical ordering of the qubits.
+            extensions: Extensions that will be applied while trying to
+                decompose the circuit's operations into Clifford operations.
+
+        Returns:
+            TrialResult list for this run; one for each possible parameter
+            resolver.
+
+        Raises:
+            TypeError if an operation is not a Clifford operation.
+        """
+        circuit = (
+            program if isinstance(program, Circuit) else program.to_circuit())
+        param_resolvers = to_resolvers(params or ParamResolver({}))
+        extensions = extensions or Extensions()
+        qubits = ops.QubitOrder.as_qubit_order(qubit_order).order_for(
+            circuit.all_qubits())
+
+        trial_results = []  # type: List[TrialResult]
+        for param_resolver in param_resolvers:
+            instructions = _to_instructions(circuit, qubits, param_resolver,
+                                            extensions)
+            keys = ops.measurement_keys(
+                cast(ops.GateOperation, op)
+                for kind, _, op in instructions if kind == 'measure')
+            all_measurements = [
+                measurements for _, measurements in
+                _repeat(instructions, len(qubits), repetitions)]
+            trial_results.append(TrialResult(
+                params=param_resolver,
+                repetitions=repetitions,
+                measurements={
+                    k: np.array([m[k] for m in all_measurements])
+                    for k in keys}))
+        return trial_results
+
+    def sample(
+        self,
+        circuit: Circuit,
+        param_resolver: ParamResolver = ParamResolver({}),
+        repetitions: int = 1,
+        qubit_order: ops.QubitOrderOrList = ops.QubitOrder.DEFAULT,
+        extensions: Extensions = None,
+    ) -> np.ndarray:
+        """Samples every qubit in the computational basis after a circuit.
+
+        The measurements of the circuit are made as in run, but their results
+        are discarded.
+
+        Args:
+            circuit: The circuit to simulate.
+            param_resolver: Parameters to run with the program.
+            repetitions: The number of samples.
+            qubit_order: Determines the order of the qubits in the samples.
+            extensions: Extensions that will be applied while trying to
+                decompose the circuit's operations into Clifford operations.
+
+        Returns:
+            A boolean numpy array with a row for each repetition and a column
+            for each qubit, in the order given by qubit_order.
+
+        Raises:
+            TypeError if an operation is not a Clifford operation.
+        """
+        qubits = ops.QubitOrder.as_qubit_order(qubit_order).order_for(
+            circuit.all_qubits())
+        instructions = _to_instructions(circuit, qubits, param_resolver,
+                                        extensions or Extensions())
+        samples = np.zeros((repetitions, len(qubits)), dtype=bool)
+        for i, (tableau, _) in enumerate(
+                _repeat(instructions, len(qubits), repetitions)):
+            samples[i] = [tableau.measure(j) for j in range(len(qubits))]
+        return samples
+
+
+def _repeat(instructions: List[_Instruction],
+            num_qubits: int,
+            repetitions: int
+            ) -> Iterator[Tuple[StabilizerTableau, Dict[str, np.ndarray]]]:
+    """Yields the final tableau and measurements of each repetition."""
+    first_measurement = next(
+        (i for i, (kind, _, _) in enumerate(instructions)
+         if kind == 'measure'),
+        len(instructions))
+    start = StabilizerTableau(num_qubits)
+    _apply_instructions(start, instructions[:first_measurement])
+    for _ in range(repetitions):
+        tableau = start.copy()
+        measurements = _apply_instructions(
+            tableau, instructions[first_measurement:])
+        yield tableau, measurements
+
+
+def _apply_instructions(tableau: StabilizerTableau,
+                        instructions: List[_Instruction]
+                        ) -> Dict[str, np.ndarray]:
+    measurements = {}  # type: Dict[str, np.ndarray]
+    for kind, indices, arg in instructions:
+        if kind == 'clifford':
+            tableau.apply_clifford(indices[0], cast(CliffordGate, arg))
+        elif kind == 'cnot':
+            tableau.apply_cnot(*indices)
+        elif kind == 'cz':
+            tableau.apply_cz(*indices)
+        else:
+            op = cast(ops.GateOperation, arg)
+            results = [tableau.measure(i) for i in indices]
+            measurements[cast(ops.MeasurementGate, op.gate).key] = np.array(
+                results, dtype=bool) != np.array(
+                    ops.measurement_invert_mask(op), dtype=bool)
+    return measurements
+
+
+def _to_instructions(circuit: Circuit,
+                     qubits: Sequence[ops.QubitId],
+                     param_resolver: ParamResolver,
+                     extensions: Extensions) -> List[_Instruction]:
+    """Returns the resolved operations of the circuit as tableau updates.
+
+    Raises:
+        TypeError if an operation is not a Clifford operation.
+    """
+    indices = {q: i for i, q in enumerate(qubits)}
+    instructions = []  # type: List[_Instruction]
+    for op in ops.resolve_and_decompose(circuit.all_operations(),
+                                        param_resolver,
+                                        extensions,
+                                        _is_clifford):
+        targets = tuple(indices[q] for q in op.qubits)
+        gate = cast(ops.GateOperation, op).gate
+        if isinstance(gate, ops.MeasurementGate):
+            instructions.append(('measure', targets, op))
+        elif isinstance(gate, _TWO_QUBIT_GATE_TYPES):
+            if _quarter_turns(gate.half_turns) == 0:
+                continue
+            if isinstance(gate, ops.Rot11Gate):
+                instructions.append(('cz', targets, None))
+            elif isinstance(gate, ops.CNotGate):
+                instructions.append(('cnot', targets, None))
+            else:
+                a, b = targets
+                instructions.extend([('cnot', (a, b), None),
+                                     ('cnot', (b, a), None),
+                                     ('cnot', (a, b), None)])
+        else:
+            clifford = cast(CliffordGate, _single_qubit_clifford(gate))
+            if clifford != CliffordGate.I:
+                instructions.append(('clifford', targets, clifford))
+    return instructions
+
+
+def _is_clifford(op: ops.Operation) -> bool:
+    if not isinstance(op, ops.GateOperation):
+        return False
+    gate = op.gate
+    if isinstance(gate, _TWO_QUBIT_GATE_TYPES):
+        turns = _quarter_turns(gate.half_turns)
+        return turns is not None and turns % 2 == 0
+    return (isinstance(gate, ops.MeasurementGate) or
+            _single_qubit_clifford(gate) is not None)
+
+
+def _single_qubit_clifford(gate: ops.Gate) -> Optional[CliffordGate]:
+    if isinstance(gate, CliffordGate):
+        return gate
+    if isinstance(gate, ops.HGate):
+        return CliffordGate.H
+    for gate_type, gates in _QUARTER_TURN_GATES.items():
+        if isinstance(gate, gate_type):
+            rotation = cast(Union[ops.RotXGate, ops.RotYGate, ops.RotZGate],
+                            gate)
+            turns = _quarter_turns(rotation.half_turns)
+            return None if turns is None else gates[turns]
+    return None
+
+
+def _quarter_turns(half_turns: Union[value.Symbol, float],
+                   atol: float = 1e-8) -> Optional[int]:
+    """Returns the number of quarter turns modulo 4, or None if fractional."""
+    if isinstance(half_turns, value.Symbol):
+        return None
+    quarter_turns = 2 * half_turns
+    rounded = int(np.round(quarter_turns))
+    if abs(quarter_turns - rounded) > atol:
+        return None
+    return rounded % 4
@@ -0,0 +1,177 @@
+# Copyright 2018 The Cirq Developers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+
+import numpy as np
+import pytest
+
+import cirq
+from cirq.contrib.paulistring import (
+    CliffordGate,
+    Pauli,
+    PauliInteractionGate,
+    StabilizerSimulator,
+    StabilizerTableau,
+)
+
+Q0, Q1, Q2 = cirq.LineQubit.range(3)
+
+
+def test_run_deterministic():
+    circuit = cirq.Circuit.from_ops(
+        cirq.X(Q0),
+        cirq.CNOT(Q0, Q1),
+        cirq.measure(Q0, Q1, Q2, key='m'))
+    result = StabilizerSimulator().run(circuit, repetitions=3)
+    np.testing.assert_equal(result.measurements['m'],
+                            [[True, True, False]] * 3)
+
+
+def test_run_bell_state():
+    circuit = cirq.Circuit.from_ops(
+        cirq.H(Q0),
+        cirq.CNOT(Q0, Q1),
+        cirq.measure(Q0, key='a'),
+        cirq.measure(Q1, key='b'))
+    result = StabilizerSimulator().run(circuit, repetitions=100)
+    np.testing.assert_equal(result.measurements['a'],
+                            result.measurements['b'])
+    assert 0 < np.sum(result.measurements['a']) < 100
+
+
+def test_run_quarter_turns():
+    circuit = cirq.Circuit.from_ops(
+        cirq.H(Q0), cirq.S(Q0), cirq.S(Q0), cirq.H(Q0),
+        cirq.Y(Q1)**0.5, cirq.Y(Q1)**-1.5,
+        cirq.X(Q2)**0.5, cirq.Z(Q2)**-0.5, cirq.Y(Q2)**0.5,
+        cirq.measure(Q0, Q1, Q2, key='m'))
+    result = StabilizerSimulator().run(circuit, repetitions=5)
+    np.testing.assert_equal(result.measurements['m'],
+                            [[True, True, False]] * 5)
+
+
+def test_run_invert_mask():
+    circuit = cirq.Circuit.from_ops(
+        cirq.X(Q0),
+        cirq.measure(Q0, Q1, key='m', invert_mask=(True,)))
+    result = StabilizerSimulator().run(circuit)
+    np.testing.assert_equal(result.measurements['m'], [[False, False]])
+
+
+def test_run_mid_circuit_measurement():
+    circuit = cirq.Circuit.from_ops(
+        cirq.H(Q0),
+        cirq.measure(Q0, key='a'),
+        cirq.CNOT(Q0, Q1),
+        cirq.SWAP(Q1, Q2),
+        cirq.measure(Q1, Q2, key='b'))
+    result = StabilizerSimulator().run(circuit, repetitions=50)
+    np.testing.assert_equal(result.measurements['b'][:, 0], False)
+    np.testing.assert_equal(result.measurements['b'][:, 1],
+                            result.measurements['a'][:, 0])
+
+
+def test_run_ghz_many_qubits():
+    qubits = cirq.LineQubit.range(300)
+    circuit = cirq.Circuit.from_ops(
+        cirq.H(qubits[0]),
+        [cirq.CNOT(a, b) for a, b in zip(qubits, qubits[1:])],
+        cirq.measure(*qubits, key='m'))
+    result = StabilizerSimulator().run(circuit, repetitions=4)
+    for row in result.measurements['m']:
+        assert np.all(row == row[0])
+
+
+@pytest.mark.parametrize('gate', [
+    PauliInteractionGate(pauli0, invert0, pauli1, invert1)
+    for pauli0, invert0, pauli1, invert1 in itertools.product(
+        Pauli.XYZ, (False, True), Pauli.XYZ, (False, True))
+])
+def test_sample_pauli_interaction_gate_matches_unitary(gate):
+    circuit = cirq.Circuit.from_ops(
+        CliffordGate.H(Q0),
+        CliffordGate.X_sqrt(Q1),
+        gate(Q0, Q1))
+    probabilities = np.abs(circuit.to_unitary_matrix()[:, 0])**2
+    samples = StabilizerSimulator().sample(circuit, repetitions=20)
+    for sample in samples:
+        assert probabilities[2 * sample[0] + sample[1]] > 1e-8
+
+
+def test_run_sweep():
+    circuit = cirq.Circuit.from_ops(
+        cirq.RotXGate(half_turns=cirq.Symbol('a')).on(Q0),
+        cirq.measure(Q0, key='m'))
+    results = StabilizerSimulator().run_sweep(
+        circuit, cirq.Points('a', [0, 1, 2, 3]), repetitions=2)
+    assert [r.params.value_of('a') for r in results] == [0, 1, 2, 3]
+    np.testing.assert_equal([r.measurements['m'][:, 0] for r in results],
+                            [[False] * 2, [True] * 2] * 2)
+
+
+def test_non_clifford_operation():
+    circuit = cirq.Circuit.from_ops(cirq.X(Q0)**0.25)
+    with pytest.raises(TypeError):
+        StabilizerSimulator().run(circuit)
+    circuit = cirq.Circuit.from_ops(cirq.CZ(Q0, Q1)**0.5)
+    with pytest.raises(TypeError):
+        StabilizerSimulator().sample(circuit)
+
+
+def test_operation_without_gate():
+    class NoGateOperation(cirq.Operation):
+        qubits = (Q0,)
+
+        def with_qubits(self, *new_qubits):
+            raise NotImplementedError()
+
+    circuit = cirq.Circuit.from_ops(NoGateOperation())
+    with pytest.raises(TypeError, match='Unsupported operation'):
+        StabilizerSimulator().run(circuit)
+
+
+def test_repeated_measurement_key():
+    circuit = cirq.Circuit.from_ops(cirq.measure(Q0, key='m'),
+                                    cirq.measure(Q1, key='m'))
+    with pytest.raises(ValueError):
+        StabilizerSimulator().run(circuit)
+
+
+def test_sample_qubit_order():
+    circuit = cirq.Circuit.from_ops(cirq.X(Q1), cirq.measure(Q0, key='m'))
+    samples = StabilizerSimulator().sample(circuit, repetitions=2,
+                                           qubit_order=[Q1, Q0])
+    np.testing.assert_equal(samples, [[True, False]] * 2)
+
+
+def test_tableau_copy_is_independent():
+    tableau = StabilizerTableau(2)
+    copy = tableau.copy()
+    tableau.apply_clifford(0, CliffordGate.X)
+    tableau.apply_cnot(0, 1)
+    assert tableau.measure(1)
+    assert not copy.measure(1)
+
+
+def test_tableau_cz():
+    tableau = StabilizerTableau(2)
+    tableau.apply_clifford(0, CliffordGate.H)
+    tableau.apply_clifford(1, CliffordGate.H)
+    tableau.apply_cz(0, 1)
+    tableau.apply_cz(1, 0)
+    tableau.apply_clifford(0, CliffordGate.H)
+    tableau.apply_clifford(1, CliffordGate.H)
+    assert not tableau.measure(0)
+    assert not tableau.measure(1)
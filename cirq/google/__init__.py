@@ -49,6 +49,16 @@ from cirq.google.xmon_gates import (
     XmonMeasurementGate,
 )
 from cirq.google.sim import (
+    AmplitudeDampingChannel,
+    DensityMatrixSimulator,
+    DensityMatrixTrialResult,
+    DephasingChannel,
+    DepolarizingChannel,
+    FusedGate,
+    FuseGates,
+    FusionStats,
+    KrausChannel,
+    RenormPolicy,
     XmonOptions,
     XmonSimulator,
     XmonStepResult,
@@ -34,7 +34,9 @@ class ConvertToXmonGates(PointOptimizer):
 
     Second, checks if the given extensions are able to cast the operation into a
         KnownMatrix. If so, and the gate is a 1-qubit or 2-qubit gate, then
-        performs circuit synthesis of the operation.
+        performs circuit synthesis of the operation, or if keep_matrix_gates
+        is set, replaces it with a SingleQubitMatrixGate or TwoQubitMatrixGate
+        with the same matrix.
 
     Third, checks if the given extensions are able to cast the operation into a
         CompositeOperation. If so, recurses on the decomposition.
@@ -45,7 +47,8 @@ class ConvertToXmonGates(PointOptimizer):
 
     def __init__(self,
                  extensions: Extensions=None,
-                 ignore_failures=False) -> None:
+                 ignore_failures=False,
+                 keep_matrix_gates=False) -> None:
         """
         Args:
             extensions: The extensions instance to use when trying to
@@ -53,9 +56,14 @@ class ConvertToXmonGates(PointOptimizer):
                 gate extension.
             ignore_failures: If set, gates that fail to convert are forwarded
                 unchanged. If not set, conversion failures raise a TypeError.
+            keep_matrix_gates: If set, 1-qubit and 2-qubit operations with a
+                known matrix, that are not xmon gates, are converted into
+                matrix gates instead of being synthesized from xmon gates.
+                The xmon simulator can simulate these matrix gates directly.
         """
         self.extensions = extensions or xmon_gate_ext
         self.ignore_failures = ignore_failures
+        self.keep_matrix_gates = keep_matrix_gates
 
     def _convert_one(self, op: ops.Operation) -> ops.OP_TREE:
         # Already supported?
@@ -70,6 +78,15 @@ class ConvertToXmonGates(PointOptimizer):
 
         # Known matrix?
         mat = self.extensions.try_cast(ops.KnownMatrix, op)
+        if mat is not None and self.keep_matrix_gates:
+            if isinstance(op, ops.GateOperation) and isinstance(
+                    op.gate, (ops.SingleQubitMatrixGate,
+                              ops.TwoQubitMatrixGate)):
+                return op
+            if len(op.qubits) == 1:
+                return ops.SingleQubitMatrixGate(mat.matrix()).on(*op.qubits)
+            if len(op.qubits) == 2:
+                return ops.TwoQubitMatrixGate(mat.matrix()).on(*op.qubits)
         if mat is not None and len(op.qubits) == 1:
             gates = single_qubit_matrix_to_native_gates(mat.matrix())
             return [g.on(op.qubits[0]) for g in gates]
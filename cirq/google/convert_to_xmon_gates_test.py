@@ -38,3 +38,12 @@ def test_avoids_infinite_cycle_when_matrix_available():
     c = cirq.Circuit.from_ops(OtherX().on(q), OtherOtherX().on(q))
     cirq.google.ConvertToXmonGates().optimize_circuit(c)
     assert c.to_text_diagram() == '(0, 0): ───X───X───'
+
+
+def test_keep_matrix_gates():
+    q = cirq.GridQubit(0, 0)
+    c = cirq.Circuit.from_ops(OtherX().on(q), cirq.X(q))
+    cirq.google.ConvertToXmonGates(keep_matrix_gates=True).optimize_circuit(c)
+    ops = list(c.all_operations())
+    assert ops[0] == cirq.SingleQubitMatrixGate(OtherX().matrix()).on(q)
+    assert isinstance(ops[1].gate, cirq.google.ExpWGate)
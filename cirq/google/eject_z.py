@@ -79,10 +79,9 @@ class EjectZ(OptimizationPass):
         start_z = None
         prev_z = None
 
-        for i in range(len(circuit.moments)):
-            op = circuit.operation_at(qubit, i)
-            if op is None:
-                continue
+        i = circuit.next_moment_operating_on([qubit])
+        while i is not None:
+            op = cast(ops.Operation, circuit.operation_at(qubit, i))
 
             if start_z is None:
                 # Unparameterized Zs start optimization ranges.
@@ -105,6 +104,8 @@ class EjectZ(OptimizationPass):
                     yield start_z, prev_z
                 start_z = None
 
+            i = circuit.next_moment_operating_on([qubit], i + 1)
+
         # End of the circuit forces draining.
         if start_z is not None:
             yield start_z, len(circuit.moments)
@@ -127,12 +128,9 @@ class EjectZ(OptimizationPass):
         """
         lost_phase_turns = 0.0
 
-        for i in range(start, drain):
-            op = circuit.operation_at(qubit, i)
-
-            if op is None:
-                # Empty.
-                continue
+        i = circuit.next_moment_operating_on([qubit], start, drain - start)
+        while i is not None:
+            op = cast(ops.Operation, circuit.operation_at(qubit, i))
 
             known_z_half_turns = _try_get_known_z_half_turns(op)
             if known_z_half_turns is not None:
@@ -150,6 +148,8 @@ class EjectZ(OptimizationPass):
                                     phaseable.phase_by(-lost_phase_turns, k)),
                                InsertStrategy.INLINE)
 
+            i = circuit.next_moment_operating_on([qubit], i + 1, drain - i - 1)
+
         self._drain_into(circuit, qubit, drain, lost_phase_turns)
 
     def _drain_into(self, circuit: Circuit, qubit: ops.QubitId,
@@ -36,12 +36,14 @@ from apiclient import discovery
 from google.protobuf.json_format import MessageToDict
 
 from cirq.api.google.v1 import program_pb2
-from cirq.circuits import Circuit
+from cirq.circuits import Circuit, CompactCircuit
 from cirq.circuits.drop_empty_moments import DropEmptyMoments
 from cirq.devices import Device, UnconstrainedDevice
 from cirq.google.convert_to_xmon_gates import ConvertToXmonGates
 from cirq.google.params import sweep_to_proto
 from cirq.google.programs import schedule_to_proto, unpack_results
+from cirq.google.xmon_gate_extensions import xmon_gate_ext
+from cirq.google.xmon_gates import XmonGate
 from cirq.schedules import Schedule, moment_by_moment_schedule
 from cirq.study import ParamResolver, Sweep, Sweepable, TrialResult
 from cirq.study.sweeps import Points, Unit, Zip
@@ -170,7 +172,7 @@ class Engine:
             **kwargs)
 
     def run(self,
-            program: Union[Circuit, Schedule],
+            program: Union[Circuit, CompactCircuit, Schedule],
             job_config: Optional[JobConfig] = None,
             device: Device = None,
             param_resolver: ParamResolver = ParamResolver({}),
@@ -181,8 +183,8 @@ class Engine:
         """Runs the supplied Circuit or Schedule via Quantum Engine.
 
         Args:
-            program: The Circuit or Schedule to execute. If a circuit is
-                provided, a moment by moment schedule will be used.
+            program: The Circuit, CompactCircuit or Schedule to execute. If a
+                circuit is provided, a moment by moment schedule will be used.
             job_config: Configures the names of programs and jobs.
             device: The device on which to run a circuit. The circuit will be
                 validated against this device before sending to the engine.
@@ -288,8 +290,18 @@ class Engine:
         return implied_job_config
 
     def program_as_schedule(self,
-                            program: Union[Circuit, Schedule],
+                            program: Union[Circuit, CompactCircuit, Schedule],
                             device: Device = None) -> Schedule:
+        """Returns the schedule that runs the program on the device.
+
+        A CompactCircuit whose gates all have an XmonGate form is scheduled
+        moment by moment without building a Circuit. Other compact circuits
+        need their gates decomposed, which can add moments, so they are
+        converted to a Circuit first.
+        """
+        if isinstance(program, CompactCircuit):
+            return self._compact_circuit_as_schedule(
+                program, device or UnconstrainedDevice)
         if isinstance(program, Circuit):
             device = device or UnconstrainedDevice
             circuit_copy = Circuit(program.moments)
@@ -306,8 +318,29 @@ class Engine:
         else:
             raise TypeError('Unexpected program type.')
 
+    def _compact_circuit_as_schedule(self,
+                                     circuit: CompactCircuit,
+                                     device: Device) -> Schedule:
+        xmon_gates = []  # type: List[XmonGate]
+        for gate in circuit.gates:
+            xmon_gate = xmon_gate_ext.try_cast(XmonGate, gate)
+            if xmon_gate is None:
+                return self.program_as_schedule(circuit.to_circuit(), device)
+            xmon_gates.append(xmon_gate)
+        xmon_circuit = CompactCircuit(qubits=circuit.qubits,
+                                      gates=xmon_gates,
+                                      gate_ids=circuit.gate_ids,
+                                      qubit_ids=circuit.qubit_ids,
+                                      qubit_offsets=circuit.qubit_offsets,
+                                      moment_offsets=circuit.moment_offsets)
+        # Empty moments take no time in a moment by moment schedule, and
+        # the schedule is validated as a whole in place of the circuit.
+        schedule = moment_by_moment_schedule(device, xmon_circuit)
+        device.validate_schedule(schedule)
+        return schedule
+
     def run_sweep(self,
-                  program: Union[Circuit, Schedule],
+                  program: Union[Circuit, CompactCircuit, Schedule],
                   job_config: Optional[JobConfig] = None,
                   device: Device = None,
                   params: Sweepable = None,
@@ -321,8 +354,8 @@ class Engine:
         does not block until a result is returned.
 
         Args:
-            program: The Circuit or Schedule to execute. If a circuit is
-                provided, a moment by moment schedule will be used.
+            program: The Circuit, CompactCircuit or Schedule to execute. If a
+                circuit is provided, a moment by moment schedule will be used.
             job_config: Configures the names of programs and jobs.
             device: The device on which to run a circuit. The circuit will be
                 validated against this device before sending to the engine.
@@ -139,6 +139,43 @@ def test_schedule_and_device_both_not_supported(build):
         eng.run(schedule, JobConfig('project-id'), device=Foxtail)
 
 
+@mock.patch.object(discovery, 'build')
+def test_compact_circuit_as_schedule(build):
+    circuit = cirq.Circuit.from_ops(cirq.H.on(GridQubit(0, 1)),
+                                    cirq.CZ(GridQubit(0, 0), GridQubit(0, 1)))
+    eng = Engine(api_key="key")
+    assert (eng.program_as_schedule(cirq.CompactCircuit.from_circuit(circuit),
+                                    Foxtail) ==
+            eng.program_as_schedule(circuit, Foxtail))
+
+
+@mock.patch.object(discovery, 'build')
+def test_compact_xmon_circuit_as_schedule(build):
+    q0, q1 = GridQubit(0, 0), GridQubit(0, 1)
+    circuit = cirq.Circuit([
+        cirq.Moment([cirq.X(q0)]),
+        cirq.Moment(),
+        cirq.Moment([cirq.CZ(q0, q1)]),
+        cirq.Moment([cirq.measure(q0, q1, key='m')]),
+    ])
+    compact = cirq.CompactCircuit.from_circuit(circuit)
+    eng = Engine(api_key="key")
+    with mock.patch.object(cirq.CompactCircuit, 'to_circuit') as to_circuit:
+        schedule = eng.program_as_schedule(compact, Foxtail)
+    assert not to_circuit.called
+    assert schedule == eng.program_as_schedule(circuit, Foxtail)
+
+
+@mock.patch.object(discovery, 'build')
+def test_compact_circuit_device_validation_fails(build):
+    q0, q1 = GridQubit(0, 0), GridQubit(0, 1)
+    compact = cirq.CompactCircuit.from_circuit(cirq.Circuit.from_ops(
+        cirq.measure(q0, key='m'), cirq.measure(q1, key='m')))
+    eng = Engine(api_key="key")
+    with pytest.raises(ValueError, match='Measurement key'):
+        eng.program_as_schedule(compact, Foxtail)
+
+
 @mock.patch.object(discovery, 'build')
 def test_unsupported_program_type(build):
     eng = Engine(api_key="key")
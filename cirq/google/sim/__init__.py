@@ -15,6 +15,21 @@
 """Simulators specific to Google's quantum hardware.
 """
 
+from cirq.google.sim.density_matrix_simulator import (
+    DensityMatrixSimulator,
+    DensityMatrixTrialResult,
+)
+from cirq.google.sim.fuse_gates import (
+    FusedGate,
+    FuseGates,
+    FusionStats,
+)
+from cirq.google.sim.noise_channels import (
+    AmplitudeDampingChannel,
+    DephasingChannel,
+    DepolarizingChannel,
+    KrausChannel,
+)
 from cirq.google.sim.xmon_simulator import (
     XmonOptions,
     XmonSimulator,
@@ -22,5 +37,6 @@ from cirq.google.sim.xmon_simulator import (
     XmonSimulateTrialResult,
 )
 from cirq.google.sim.xmon_stepper import (
+    RenormPolicy,
     Stepper,
 )
@@ -0,0 +1,604 @@
+# Copyright 2018 The Cirq Developers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""DensityMatrixSimulator for simulating circuits with noise exactly.
+
+Rather than a wave function, the simulator keeps the density matrix of the
+qubits, so that noise channels can be applied exactly instead of being
+sampled over many realizations. The density matrix of n qubits has 4 ** n
+entries, which limits the simulator to a dozen or so qubits.
+
+A simple example:
+    circuit = Circuit.from_ops(H(q1), CNOT(q1, q2), measure(q1, q2))
+    sim = DensityMatrixSimulator(noise=[DepolarizingChannel(0.01)])
+    results = sim.run(circuit, repetitions=1000)
+"""
+
+import collections
+from typing import Dict, List, Optional, Sequence, Set, Tuple, Union, cast
+
+import numpy as np
+
+from cirq import ops
+from cirq.circuits import Circuit
+from cirq.extension import Extensions
+from cirq.google.sim.noise_channels import KrausChannel
+from cirq.schedules import Schedule
+from cirq.study import ParamResolver, Sweepable, TrialResult, to_resolvers
+
+
+# The operations of a moment, each with its matrix, or None for measurements.
+_MomentOps = List[Tuple[ops.Operation, Optional[np.ndarray]]]
+
+
+class DensityMatrixTrialResult:
+    """Results of a simulation of the DensityMatrixSimulator.
+
+    Attributes:
+        params: A ParamResolver of settings used for this result.
+        measurements: A dictionary from measurement gate key to measurement
+            results. Measurement results are a numpy ndarray of actual boolean
+            measurement results (ordered by the qubits acted on by the
+            measurement gate.)
+        final_density_matrix: The final density matrix of the system after
+            the trial finishes.
+    """
+
+    def __init__(self,
+                 params: ParamResolver,
+                 measurements: Dict[str, np.ndarray],
+                 final_density_matrix: np.ndarray) -> None:
+        self.params = params
+        self.measurements = measurements
+        self.final_density_matrix = final_density_matrix
+
+    def __repr__(self):
+        return ('DensityMatrixTrialResult(params={!r}, '
+                'measurements={!r}, '
+                'final_density_matrix={!r})').format(
+            self.params, self.measurements, self.final_density_matrix)
+
+    def __str__(self):
+        def bitstring(vals):
+            return ''.join('1' if v else '0' for v in vals)
+
+        results = sorted(
+            [(key, bitstring(val)) for key, val in self.measurements.items()])
+        return ' '.join(
+            ['{}={}'.format(key, val) for key, val in results])
+
+
+class DensityMatrixSimulator:
+    """Simulates circuits with noise using their density matrix.
+
+    After the gates of each moment are applied, and before the measurements
+    of the moment are made, every noise channel is applied to every qubit.
+    The channels acting on a qubit are combined into a single superoperator,
+    so the noise of a moment is one tensor contraction per qubit.
+
+    As for the XmonSimulator, the run methods mimic the quantum hardware and
+    the simulate methods give access to the final density matrix:
+        run
+        run_sweep
+        simulate
+        simulate_sweep
+    If all of the measurements are terminal, the run methods sample all of
+    the repetitions from the exact distribution of the final density matrix.
+    Otherwise the repetitions are simulated together, forking at each moment
+    with measurements into one branch per distinct result.
+    """
+
+    def __init__(self,
+                 noise: Sequence[KrausChannel] = (),
+                 dtype: type = np.complex64) -> None:
+        """Construct a DensityMatrixSimulator.
+
+        Args:
+            noise: The single qubit noise channels applied to every qubit
+                after every moment, in order.
+            dtype: The dtype of the density matrix, either np.complex64 (the
+                default) or np.complex128.
+
+        Raises:
+            ValueError if the dtype is not supported.
+        """
+        if dtype not in (np.complex64, np.complex128):
+            raise ValueError('Unsupported dtype {}.'.format(dtype))
+        self.noise = tuple(noise)
+        self.dtype = dtype
+        superoperator = np.eye(4)
+        for channel in self.noise:
+            superoperator = np.dot(channel.superoperator(), superoperator)
+        self._noise_superoperator = (
+            np.reshape(superoperator, (2, 2, 2, 2)).astype(dtype)
+            if self.noise else None)
+
+    def run(
+        self,
+        circuit: Circuit,
+        param_resolver: ParamResolver = ParamResolver({}),
+        repetitions: int = 1,
+        qubit_order: ops.QubitOrderOrList = ops.QubitOrder.DEFAULT,
+        extensions: Extensions = None,
+    ) -> TrialResult:
+        """Runs the entire supplied Circuit, mimicking the quantum hardware.
+
+        The initial state is the all zeros state in the computational basis.
+
+        Args:
+            circuit: The circuit to simulate.
+            param_resolver: Parameters to run with the program.
+            repetitions: The number of repetitions to simulate.
+            qubit_order: Determines the canonical ordering of the qubits used
+                to define the order of the density matrix.
+            extensions: Extensions that will be applied while trying to cast
+                the circuit's operations into gates with a known matrix.
+
+        Returns:
+            TrialResult for a run.
+        """
+        return self.run_sweep(circuit, [param_resolver], repetitions,
+                              qubit_order, extensions)[0]
+
+    def run_sweep(
+            self,
+            program: Union[Circuit, Schedule],
+            params: Sweepable = ParamResolver({}),
+            repetitions: int = 1,
+            qubit_order: ops.QubitOrderOrList = ops.QubitOrder.DEFAULT,
+            extensions: Extensions = None
+    ) -> List[TrialResult]:
+        """Runs the entire supplied Circuit, mimicking the quantum hardware.
+
+        The initial state is the all zeros state in the computational basis.
+
+        Args:
+            program: The circuit or schedule to simulate.
+            params: Parameters to run with the program.
+            repetitions: The number of repetitions to simulate.
+            qubit_order: Determines the canonical ordering of the qubits used
+                to define the order of the density matrix.
+            extensions: Extensions that will be applied while trying to cast
+                the circuit's operations into gates with a known matrix.
+
+        Returns:
+            TrialResult list for this run; one for each possible parameter
+            resolver.
+        """
+        circuit = (
+            program if isinstance(program, Circuit) else program.to_circuit())
+        param_resolvers = to_resolvers(params or ParamResolver({}))
+        extensions = extensions or Extensions()
+        qubits = ops.QubitOrder.as_qubit_order(qubit_order).order_for(
+            circuit.all_qubits())
+
+        trial_results = []  # type: List[TrialResult]
+        for param_resolver in param_resolvers:
+            moments = _resolved_moments(circuit, param_resolver, extensions,
+                                        self.dtype)
+            keys = ops.measurement_keys(
+                cast(ops.GateOperation, op)
+                for moment in moments for op, matrix in moment
+                if matrix is None)
+            if circuit.are_all_measurements_terminal():
+                measurements = self._run_sample(moments, qubits, repetitions)
+            else:
+                measurements = self._run_repeat(moments, qubits, keys,
+                                                repetitions)
+            trial_results.append(TrialResult(
+                params=param_resolver,
+                repetitions=repetitions,
+                measurements=measurements))
+        return trial_results
+
+    def _run_sample(self,
+                    moments: List[_MomentOps],
+                    qubits: Sequence[ops.QubitId],
+                    repetitions: int) -> Dict[str, np.ndarray]:
+        """Samples all repetitions of a circuit with terminal measurements.
+
+        Once a qubit has been measured it is no longer acted on, so the
+        noise of later moments is not applied to it.
+        """
+        axes = {q: i for i, q in enumerate(qubits)}
+        rho = _initial_density_matrix(0, len(qubits), self.dtype)
+        measured_ops = []  # type: List[ops.GateOperation]
+        measured_qubits = set()  # type: Set[ops.QubitId]
+        for moment in moments:
+            for op, matrix in moment:
+                if matrix is None:
+                    measured_ops.append(cast(ops.GateOperation, op))
+                else:
+                    rho = _apply_unitary(rho, matrix,
+                                         [axes[q] for q in op.qubits])
+            rho = self._apply_noise(
+                rho, [axes[q] for q in qubits if q not in measured_qubits])
+            measured_qubits.update(q for op in measured_ops
+                                   for q in op.qubits)
+
+        measured = [q for op in measured_ops for q in op.qubits]
+        if not measured:
+            return {}
+        probs = _marginal_probs(rho, [axes[q] for q in measured])
+        result = np.random.choice(len(probs), size=repetitions, p=probs)
+        shifts = np.arange(len(measured) - 1, -1, -1)
+        bits = (result[:, np.newaxis] >> shifts) & 1 == 1
+
+        measurements = {}  # type: Dict[str, np.ndarray]
+        start = 0
+        for op in measured_ops:
+            gate = cast(ops.MeasurementGate, op.gate)
+            end = start + len(op.qubits)
+            measurements[gate.key] = bits[:, start:end] != np.array(
+                ops.measurement_invert_mask(op), dtype=bool)
+            start = end
+        return measurements
+
+    def _run_repeat(self,
+                    moments: List[_MomentOps],
+                    qubits: Sequence[ops.QubitId],
+                    keys: Set[str],
+                    repetitions: int) -> Dict[str, np.ndarray]:
+        """Runs a circuit with non-terminal measurements.
+
+        As in the XmonSimulator, the repetitions are simulated together as
+        branches. At each moment with measurements the results of all of the
+        repetitions on the branch are sampled at once, and the branch forks
+        into one branch per distinct result, carrying the number of
+        repetitions that took it. The number of simulated branches depends
+        on the distinct results rather than on the number of repetitions.
+        """
+        axes = {q: i for i, q in enumerate(qubits)}
+        all_axes = list(range(len(qubits)))
+        measurements = {
+            k: [] for k in keys}  # type: Dict[str, List[np.ndarray]]
+        # Branches that remain to be simulated, as the moment they start at,
+        # the density matrix to start from, the number of repetitions on the
+        # branch, and the measurements so far.
+        branches = [(0, _initial_density_matrix(0, len(qubits), self.dtype),
+                     repetitions, {})
+                    ]  # type: List[Tuple[int, np.ndarray, int, Dict]]
+        while branches:
+            start, rho, count, branch_measurements = branches.pop()
+            for i in range(start, len(moments)):
+                measured_ops = []  # type: List[ops.GateOperation]
+                for op, matrix in moments[i]:
+                    if matrix is None:
+                        measured_ops.append(cast(ops.GateOperation, op))
+                    else:
+                        rho = _apply_unitary(rho, matrix,
+                                             [axes[q] for q in op.qubits])
+                rho = self._apply_noise(rho, all_axes)
+                if not measured_ops:
+                    continue
+                measured_axes = [axes[q] for op in measured_ops
+                                 for q in op.qubits]
+                probs = _marginal_probs(rho, measured_axes)
+                counts = np.random.multinomial(count, probs)
+                for result in np.flatnonzero(counts):
+                    bits = _result_bits(result, len(measured_axes))
+                    branches.append((
+                        i + 1,
+                        _project(rho, measured_axes, bits,
+                                 float(probs[result])),
+                        counts[result],
+                        _with_measurements(branch_measurements, measured_ops,
+                                           bits)))
+                break
+            else:
+                for k, v in branch_measurements.items():
+                    measurements[k].extend([np.array(v, dtype=bool)] * count)
+
+        # Interleave the repetitions of different branches.
+        permutation = np.random.permutation(repetitions)
+        return {k: np.array([v[i] for i in permutation], dtype=bool)
+                for k, v in measurements.items()}
+
+    def simulate(
+        self,
+        circuit: Circuit,
+        param_resolver: ParamResolver = ParamResolver({}),
+        qubit_order: ops.QubitOrderOrList = ops.QubitOrder.DEFAULT,
+        initial_state: Union[int, np.ndarray] = 0,
+        extensions: Extensions = None,
+    ) -> DensityMatrixTrialResult:
+        """Simulates the entire supplied Circuit.
+
+        Args:
+            circuit: The circuit to simulate.
+            param_resolver: Parameters to run with the program.
+            qubit_order: Determines the canonical ordering of the qubits used
+                to define the order of the density matrix.
+            initial_state: If an int, the state is set to the computational
+                basis state corresponding to this state. Otherwise if this is
+                a one dimensional np.ndarray it is a wave function, and if it
+                is a two dimensional np.ndarray it is a density matrix. In
+                either case it must be the correct size and normalized.
+            extensions: Extensions that will be applied while trying to cast
+                the circuit's operations into gates with a known matrix.
+
+        Returns:
+            DensityMatrixTrialResult for the simulation. Includes the final
+            density matrix.
+        """
+        return self.simulate_sweep(circuit, [param_resolver], qubit_order,
+                                   initial_state, extensions)[0]
+
+    def simulate_sweep(
+        self,
+        program: Union[Circuit, Schedule],
+        params: Sweepable = ParamResolver({}),
+        qubit_order: ops.QubitOrderOrList = ops.QubitOrder.DEFAULT,
+        initial_state: Union[int, np.ndarray] = 0,
+        extensions: Extensions = None
+    ) -> List[DensityMatrixTrialResult]:
+        """Simulates the entire supplied Circuit.
+
+        Args:
+            program: The circuit or schedule to simulate.
+            params: Parameters to run with the program.
+            qubit_order: Determines the canonical ordering of the qubits used
+                to define the order of the density matrix.
+            initial_state: If an int, the state is set to the computational
+                basis state corresponding to this state. Otherwise if this is
+                a one dimensional np.ndarray it is a wave function, and if it
+                is a two dimensional np.ndarray it is a density matrix. In
+                either case it must be the correct size and normalized.
+            extensions: Extensions that will be applied while trying to cast
+                the circuit's operations into gates with a known matrix.
+
+        Returns:
+            List of DensityMatrixTrialResults for this run, one for each
+            possible parameter resolver.
+        """
+        circuit = (
+            program if isinstance(program, Circuit) else program.to_circuit())
+        param_resolvers = to_resolvers(params or ParamResolver({}))
+        extensions = extensions or Extensions()
+        qubits = ops.QubitOrder.as_qubit_order(qubit_order).order_for(
+            circuit.all_qubits())
+
+        trial_results = []  # type: List[DensityMatrixTrialResult]
+        for param_resolver in param_resolvers:
+            moments = _resolved_moments(circuit, param_resolver, extensions,
+                                        self.dtype)
+            measurements, rho = self._simulate_moments(moments, qubits,
+                                                       initial_state)
+            trial_results.append(DensityMatrixTrialResult(
+                params=param_resolver,
+                measurements={k: np.array(v, dtype=bool)
+                              for k, v in measurements.items()},
+                final_density_matrix=np.reshape(rho, (1 << len(qubits),
+                                                      1 << len(qubits)))))
+        return trial_results
+
+    def _simulate_moments(self,
+                          moments: List[_MomentOps],
+                          qubits: Sequence[ops.QubitId],
+                          initial_state: Union[int, np.ndarray]
+                          ) -> Tuple[Dict[str, List[bool]], np.ndarray]:
+        """Simulates the moments, measuring and collapsing the state.
+
+        Returns:
+            The measurement results and the final density matrix as a tensor
+            with a row and a column axis for each qubit.
+        """
+        axes = {q: i for i, q in enumerate(qubits)}
+        rho = _initial_density_matrix(initial_state, len(qubits), self.dtype)
+        measurements = collections.defaultdict(
+            list)  # type: Dict[str, List[bool]]
+        all_axes = list(range(len(qubits)))
+        for moment in moments:
+            measured_ops = []  # type: List[ops.GateOperation]
+            for op, matrix in moment:
+                if matrix is None:
+                    measured_ops.append(cast(ops.GateOperation, op))
+                else:
+                    rho = _apply_unitary(rho, matrix,
+                                         [axes[q] for q in op.qubits])
+            rho = self._apply_noise(rho, all_axes)
+            for op in measured_ops:
+                gate = cast(ops.MeasurementGate, op.gate)
+                results, rho = _measure(rho, [axes[q] for q in op.qubits])
+                invert_mask = ops.measurement_invert_mask(op)
+                for result, invert in zip(results, invert_mask):
+                    measurements[gate.key].append(result != invert)
+        return measurements, rho
+
+    def _apply_noise(self, rho: np.ndarray, axes: List[int]) -> np.ndarray:
+        if self._noise_superoperator is None:
+            return rho
+        num_qubits = rho.ndim // 2
+        for axis in axes:
+            rho = _apply_superoperator(rho, self._noise_superoperator, axis,
+                                       num_qubits)
+        return rho
+
+
+def _resolved_moments(circuit: Circuit,
+                      param_resolver: ParamResolver,
+                      extensions: Extensions,
+                      dtype: type) -> List[_MomentOps]:
+    """Returns the operations of each moment, resolved and decomposed.
+
+    Operations are decomposed until they are measurements or have a known
+    matrix, and are paired with their matrix, or None for measurements.
+
+    Raises:
+        TypeError if an operation has no known matrix or decomposition.
+    """
+    moments = []  # type: List[_MomentOps]
+    for moment in circuit.moments:
+        moment_ops = []  # type: _MomentOps
+        for op in ops.resolve_and_decompose(
+                moment.operations, param_resolver, extensions,
+                lambda op: (_is_measurement(op) or extensions.try_cast(
+                    ops.KnownMatrix, op) is not None)):
+            known_matrix = extensions.try_cast(ops.KnownMatrix, op)
+            moment_ops.append((op, None if _is_measurement(op) else
+                               cast(ops.KnownMatrix,
+                                    known_matrix).matrix().astype(dtype)))
+        moments.append(moment_ops)
+    return moments
+
+
+def _is_measurement(op: ops.Operation) -> bool:
+    return (isinstance(op, ops.GateOperation) and
+            isinstance(op.gate, ops.MeasurementGate))
+
+
+def _initial_density_matrix(initial_state: Union[int, np.ndarray],
+                            num_qubits: int,
+                            dtype: type) -> np.ndarray:
+    """Returns the initial density matrix as a tensor.
+
+    The tensor has the row axes of the qubits followed by their column axes.
+    """
+    size = 1 << num_qubits
+    if isinstance(initial_state, int):
+        if not 0 <= initial_state < size:
+            raise ValueError(
+                'initial state was {} but expected state for {} qubits'.format(
+                    initial_state, num_qubits))
+        rho = np.zeros((size, size), dtype=dtype)
+        rho[initial_state, initial_state] = 1
+    elif isinstance(initial_state, np.ndarray) and initial_state.ndim == 1:
+        if initial_state.shape != (size,):
+            raise ValueError('Expected a wave function of size {} but was '
+                             '{}.'.format(size, initial_state.shape))
+        rho = np.outer(initial_state, np.conj(initial_state)).astype(dtype)
+    elif isinstance(initial_state, np.ndarray):
+        if initial_state.shape != (size, size):
+            raise ValueError('Expected a {}x{} density matrix but was '
+                             '{}.'.format(size, size, initial_state.shape))
+        rho = initial_state.astype(dtype)
+    else:
+        raise TypeError('initial_state was not of type int or ndarray')
+    if not np.isclose(np.real(np.trace(rho)), 1):
+        raise ValueError('Initial state is not normalized.')
+    return np.reshape(rho, [2] * (2 * num_qubits))
+
+
+def _apply_matrix(rho: np.ndarray,
+                  matrix: np.ndarray,
+                  axes: List[int]) -> np.ndarray:
+    """Left multiplies the given axes of the tensor by the matrix."""
+    k = len(axes)
+    matrix = np.reshape(matrix, [2] * (2 * k))
+    result = np.tensordot(matrix, rho, axes=(list(range(k, 2 * k)), axes))
+    return np.moveaxis(result, list(range(k)), axes)
+
+
+def _apply_unitary(rho: np.ndarray,
+                   matrix: np.ndarray,
+                   axes: List[int]) -> np.ndarray:
+    """Conjugates the density matrix tensor by a unitary on the given axes."""
+    num_qubits = rho.ndim // 2
+    rho = _apply_matrix(rho, matrix, axes)
+    return _apply_matrix(rho, np.conj(matrix),
+                         [num_qubits + axis for axis in axes])
+
+
+def _apply_superoperator(rho: np.ndarray,
+                         superoperator: np.ndarray,
+                         axis: int,
+                         num_qubits: int) -> np.ndarray:
+    """Applies a single qubit channel, given as a 2x2x2x2 tensor."""
+    return _apply_matrix(rho, superoperator, [axis, num_qubits + axis])
+
+
+def _marginal_probs(rho: np.ndarray, axes: List[int]) -> np.ndarray:
+    """Returns the probabilities of measuring the qubits on the given axes.
+
+    The first axis is the most significant bit of the index of a result.
+    """
+    num_qubits = rho.ndim // 2
+    size = 1 << num_qubits
+    diagonal = np.reshape(
+        np.real(np.diagonal(np.reshape(rho, (size, size)))).astype(np.float64),
+        [2] * num_qubits)
+    probs = np.sum(diagonal, axis=tuple(
+        axis for axis in range(num_qubits) if axis not in axes))
+    remaining = sorted(axes)
+    probs = np.reshape(
+        np.transpose(probs, [remaining.index(axis) for axis in axes]), -1)
+    # Account for any drift in the trace.
+    return probs / np.sum(probs)
+
+
+def _measure(rho: np.ndarray,
+             axes: List[int]) -> Tuple[List[bool], np.ndarray]:
+    """Measures the qubits on the given axes, collapsing the state.
+
+    Returns:
+        The measurement results, True for the |1> state, and the collapsed
+        density matrix tensor.
+    """
+    probs = _marginal_probs(rho, axes)
+    result = np.random.choice(len(probs), p=probs)
+    bits = _result_bits(result, len(axes))
+    return bits, _project(rho, axes, bits, float(probs[result]))
+
+
+def _result_bits(result: int, num_bits: int) -> List[bool]:
+    """Returns the bits of a result index, most significant first."""
+    return [bool((result >> (num_bits - 1 - i)) & 1) for i in range(num_bits)]
+
+
+def _project(rho: np.ndarray,
+             axes: List[int],
+             bits: List[bool],
+             prob: float) -> np.ndarray:
+    """Projects the qubits on the given axes onto a measurement result.
+
+    Args:
+        rho: The density matrix tensor.
+        axes: The axes of the measured qubits.
+        bits: The measurement results, True for the |1> state.
+        prob: The probability of the results, used to renormalize.
+
+    Returns:
+        The collapsed density matrix tensor.
+    """
+    num_qubits = rho.ndim // 2
+    projected = rho.copy()
+    for axis, bit in zip(axes, bits):
+        index = (
+            [slice(None)] * (2 * num_qubits))  # type: List[Union[int, slice]]
+        index[axis] = int(not bit)
+        projected[tuple(index)] = 0
+        index[axis] = slice(None)
+        index[num_qubits + axis] = int(not bit)
+        projected[tuple(index)] = 0
+    return projected / prob
+
+
+def _with_measurements(measurements: Dict[str, List[bool]],
+                       measured_ops: List[ops.GateOperation],
+                       bits: List[bool]) -> Dict[str, List[bool]]:
+    """Returns a copy of measurements extended by the results of the ops.
+
+    The bits are the results of the qubits of the measurement operations, in
+    order, before their invert masks are applied.
+    """
+    new_measurements = {k: list(v) for k, v in measurements.items()}
+    start = 0
+    for op in measured_ops:
+        gate = cast(ops.MeasurementGate, op.gate)
+        end = start + len(op.qubits)
+        invert_mask = ops.measurement_invert_mask(op)
+        new_measurements[gate.key] = [
+            bit != invert for bit, invert in zip(bits[start:end], invert_mask)]
+        start = end
+    return new_measurements
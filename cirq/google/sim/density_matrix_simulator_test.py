@@ -0,0 +1,223 @@
+# Copyright 2018 The Cirq Developers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for density_matrix_simulator."""
+
+import numpy as np
+import pytest
+
+import cirq
+import cirq.google as cg
+from cirq.google.sim import density_matrix_simulator
+from cirq.testing.mock import mock
+
+Q1, Q2, Q3 = cirq.LineQubit.range(3)
+
+
+def random_circuit():
+    np.random.seed(3)
+    circuit = cirq.Circuit()
+    for _ in range(6):
+        for q in (Q1, Q2, Q3):
+            circuit.append(cirq.RotXGate(half_turns=np.random.random())(q))
+            circuit.append(cirq.RotZGate(half_turns=np.random.random())(q))
+        circuit.append([cirq.CNOT(Q1, Q2), cirq.CZ(Q2, Q3)])
+    circuit.append(cirq.CCZ(Q1, Q2, Q3))
+    return circuit
+
+
+def test_simulate_without_noise_matches_wave_function():
+    circuit = random_circuit()
+    state = circuit.to_unitary_matrix()[:, 0]
+    result = cg.DensityMatrixSimulator(dtype=np.complex128).simulate(circuit)
+    np.testing.assert_allclose(result.final_density_matrix,
+                               np.outer(state, np.conj(state)), atol=1e-8)
+
+
+def test_simulate_noise_matches_kraus_operators():
+    channel = cg.AmplitudeDampingChannel(0.3)
+    circuit = cirq.Circuit.from_ops(cirq.X(Q1), cirq.H(Q2))
+    result = cg.DensityMatrixSimulator(
+        noise=[channel], dtype=np.complex128).simulate(circuit)
+
+    one = np.diag([0, 1])
+    plus = np.full((2, 2), 0.5)
+    expected = [sum(k.dot(rho).dot(np.conj(k).T)
+                    for k in channel.kraus_operators())
+                for rho in (one, plus)]
+    np.testing.assert_allclose(result.final_density_matrix,
+                               np.kron(expected[0], expected[1]), atol=1e-8)
+
+
+def test_simulate_combines_channels_in_order():
+    circuit = cirq.Circuit.from_ops(cirq.X(Q1))
+    simulator = cg.DensityMatrixSimulator(
+        noise=[cg.AmplitudeDampingChannel(1), cg.DepolarizingChannel(0.75)],
+        dtype=np.complex128)
+    np.testing.assert_allclose(simulator.simulate(circuit).final_density_matrix,
+                               np.eye(2) / 2, atol=1e-8)
+    simulator = cg.DensityMatrixSimulator(
+        noise=[cg.DepolarizingChannel(0.75), cg.AmplitudeDampingChannel(1)],
+        dtype=np.complex128)
+    np.testing.assert_allclose(simulator.simulate(circuit).final_density_matrix,
+                               np.diag([1, 0]), atol=1e-8)
+
+
+def test_simulate_initial_state():
+    circuit = cirq.Circuit.from_ops(cirq.X(Q1), cirq.X(Q2))
+    simulator = cg.DensityMatrixSimulator(dtype=np.complex128)
+    result = simulator.simulate(circuit, initial_state=1)
+    np.testing.assert_allclose(result.final_density_matrix,
+                               np.diag([0, 0, 1, 0]), atol=1e-8)
+
+    state = np.array([0, 0.6, 0, 0.8j])
+    result = simulator.simulate(circuit, initial_state=state)
+    flipped = state[::-1]
+    np.testing.assert_allclose(result.final_density_matrix,
+                               np.outer(flipped, np.conj(flipped)), atol=1e-8)
+
+    result = simulator.simulate(circuit, initial_state=np.eye(4) / 4)
+    np.testing.assert_allclose(result.final_density_matrix, np.eye(4) / 4,
+                               atol=1e-8)
+
+    with pytest.raises(ValueError):
+        simulator.simulate(circuit, initial_state=4)
+    with pytest.raises(ValueError):
+        simulator.simulate(circuit, initial_state=np.ones(3))
+    with pytest.raises(ValueError):
+        simulator.simulate(circuit, initial_state=np.eye(4))
+    with pytest.raises(TypeError):
+        simulator.simulate(circuit, initial_state='a')
+
+
+def test_simulate_measurement_collapses():
+    circuit = cirq.Circuit.from_ops(cirq.H(Q1), cirq.CNOT(Q1, Q2),
+                                    cirq.measure(Q1, key='a'))
+    simulator = cg.DensityMatrixSimulator(dtype=np.complex128)
+    for _ in range(5):
+        result = simulator.simulate(circuit)
+        bit = int(result.measurements['a'][0])
+        expected = np.zeros((4, 4))
+        expected[3 * bit, 3 * bit] = 1
+        np.testing.assert_allclose(result.final_density_matrix, expected,
+                                   atol=1e-6)
+        assert str(result) == 'a={}'.format(bit)
+
+
+def test_run_terminal_measurements_distribution():
+    np.random.seed(1)
+    circuit = cirq.Circuit.from_ops(
+        cirq.X(Q1), cirq.X(Q2), cirq.measure(Q1, key='a'), cirq.X(Q2),
+        cirq.measure(Q2, key='b', invert_mask=(True,)))
+    simulator = cg.DensityMatrixSimulator(
+        noise=[cg.AmplitudeDampingChannel(0.5)])
+    result = simulator.run(circuit, repetitions=10000)
+    assert result.measurements['a'].shape == (10000, 1)
+    # Noise is applied before the measurements of a moment, and not after a
+    # qubit is measured. Q1 decays twice before being measured. Q2 decays,
+    # is flipped, and decays twice more, with the result inverted.
+    np.testing.assert_allclose(np.mean(result.measurements['a']), 0.25,
+                               atol=0.02)
+    np.testing.assert_allclose(np.mean(result.measurements['b']), 0.875,
+                               atol=0.02)
+
+
+def test_run_non_terminal_measurements():
+    circuit = cirq.Circuit.from_ops(
+        cirq.X(Q1), cirq.measure(Q1, key='a'), cirq.X(Q1),
+        cirq.measure(Q1, Q2, key='b'))
+    result = cg.DensityMatrixSimulator().run(circuit, repetitions=3)
+    np.testing.assert_equal(result.measurements['a'], [[True]] * 3)
+    np.testing.assert_equal(result.measurements['b'], [[False, False]] * 3)
+
+
+def test_run_non_terminal_measurements_distribution():
+    np.random.seed(2)
+    circuit = cirq.Circuit.from_ops(
+        cirq.H(Q1), cirq.measure(Q1, key='a'), cirq.CNOT(Q1, Q2),
+        cirq.measure(Q2, key='b', invert_mask=(True,)))
+    result = cg.DensityMatrixSimulator(
+        noise=[cg.AmplitudeDampingChannel(0.5)]).run(circuit,
+                                                     repetitions=10000)
+    a = result.measurements['a'][:, 0]
+    b = result.measurements['b'][:, 0]
+    # Q1 decays twice before being measured. Q2 is flipped when Q1 was
+    # measured as |1>, and decays twice before being measured, with the
+    # result inverted.
+    np.testing.assert_allclose(np.mean(a), 0.125, atol=0.02)
+    np.testing.assert_allclose(np.mean(b[a]), 0.75, atol=0.04)
+    assert np.all(b[~a])
+    # The repetitions of the branches are interleaved.
+    assert 0 < np.sum(a[:5000]) < np.sum(a)
+
+
+def test_run_non_terminal_measurements_simulates_per_result():
+    circuit = cirq.Circuit.from_ops(
+        cirq.H(Q1), cirq.measure(Q1, key='a'), cirq.CNOT(Q1, Q2), cirq.H(Q1),
+        cirq.measure(Q1, Q2, key='b'))
+    simulator = cg.DensityMatrixSimulator()
+    call_counts = []
+    for repetitions in (100, 10000):
+        with mock.patch.object(density_matrix_simulator, '_apply_unitary',
+                               wraps=density_matrix_simulator._apply_unitary
+                               ) as apply_unitary:
+            result = simulator.run(circuit, repetitions=repetitions)
+        assert result.measurements['b'].shape == (repetitions, 2)
+        call_counts.append(apply_unitary.call_count)
+    assert call_counts[0] == call_counts[1]
+
+
+def test_run_sweep():
+    circuit = cirq.Circuit.from_ops(
+        cirq.RotXGate(half_turns=cirq.Symbol('t')).on(Q1),
+        cirq.measure(Q1, key='m'))
+    results = cg.DensityMatrixSimulator().run_sweep(
+        circuit, cirq.Points('t', [0, 1]), repetitions=2)
+    assert len(results) == 2
+    np.testing.assert_equal(results[0].measurements['m'], [[False]] * 2)
+    np.testing.assert_equal(results[1].measurements['m'], [[True]] * 2)
+    assert results[1].params.param_dict == {'t': 1}
+
+
+def test_repeated_measurement_key():
+    circuit = cirq.Circuit.from_ops(cirq.measure(Q1, key='a'),
+                                    cirq.measure(Q2, key='a'))
+    with pytest.raises(ValueError, match='Repeated'):
+        cg.DensityMatrixSimulator().run(circuit)
+
+
+def test_unsupported_operation():
+    class UnknownGate(cirq.Gate):
+        pass
+
+    circuit = cirq.Circuit.from_ops(UnknownGate().on(Q1))
+    with pytest.raises(TypeError):
+        cg.DensityMatrixSimulator().simulate(circuit)
+
+
+def test_operation_without_gate():
+    class NoGateOperation(cirq.Operation):
+        qubits = (Q1,)
+
+        def with_qubits(self, *new_qubits):
+            raise NotImplementedError()
+
+    circuit = cirq.Circuit.from_ops(NoGateOperation())
+    with pytest.raises(TypeError, match='Unsupported operation'):
+        cg.DensityMatrixSimulator().run(circuit)
+
+
+def test_invalid_dtype():
+    with pytest.raises(ValueError):
+        cg.DensityMatrixSimulator(dtype=np.float32)
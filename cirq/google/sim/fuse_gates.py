@@ -0,0 +1,198 @@
+# Copyright 2018 The Cirq Developers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An optimization pass that fuses runs of gates into matrix gates."""
+
+from typing import List, NamedTuple
+from typing import Dict, Optional  # pylint: disable=unused-import
+
+import numpy as np
+
+from cirq import linalg, ops
+from cirq.circuits import Circuit, InsertStrategy, OptimizationPass
+from cirq.extension import Extensions
+
+
+# The statistics of a gate fusion: the number of operations in the circuit
+# before fusion, the number of operations after fusion, and the number of
+# qubits of the largest fused block.
+FusionStats = NamedTuple('FusionStats', [('gates_in', int),
+                                         ('blocks_out', int),
+                                         ('largest_block', int)])
+
+
+class FusedGate(ops.Gate, ops.KnownMatrix):
+    """A gate on any number of qubits defined by its matrix.
+
+    The matrix is in the basis where the first qubit the gate is applied to
+    is the most significant bit.
+    """
+
+    def __init__(self, matrix: np.ndarray) -> None:
+        """
+        Initializes the fused gate.
+
+        Args:
+            matrix: The unitary matrix of the fused gates.
+        """
+        size = matrix.shape[0]
+        if (matrix.shape != (size, size) or size & (size - 1) or
+                not linalg.is_unitary(matrix)):
+            raise ValueError('Not a 2^k by 2^k unitary matrix: {}'.format(
+                matrix))
+        self._matrix = matrix
+
+    def num_qubits(self) -> int:
+        return self._matrix.shape[0].bit_length() - 1
+
+    def validate_args(self, qubits):
+        if len(qubits) != self.num_qubits():
+            raise ValueError(
+                '{}-qubit gate applied to {} qubits: {}({})'.format(
+                    self.num_qubits(), len(qubits), self, qubits))
+
+    def matrix(self) -> np.ndarray:
+        return self._matrix
+
+    def __hash__(self):
+        vals = tuple(v for _, v in np.ndenumerate(self._matrix))
+        return hash((FusedGate, vals))
+
+    def __eq__(self, other):
+        if not isinstance(other, type(self)):
+            return NotImplemented
+        return (self._matrix.shape == other.matrix().shape and
+                np.alltrue(self._matrix == other.matrix()))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'FusedGate({})'.format(repr(self._matrix))
+
+    def __str__(self):
+        return 'Fused{}'.format(self.num_qubits())
+
+
+class _Block(object):
+    """Operations that are being fused, and the qubits they act on."""
+
+    def __init__(self,
+                 qubits: List[ops.QubitId],
+                 operations: List[ops.Operation]) -> None:
+        self.qubits = qubits
+        self.operations = operations
+
+
+def _merged_qubits(blocks: List[_Block],
+                   op: ops.Operation) -> List[ops.QubitId]:
+    """Returns the qubits of the blocks merged with the operation."""
+    qubits = [q for block in blocks for q in block.qubits]
+    return qubits + [q for q in op.qubits if q not in qubits]
+
+
+class FuseGates(OptimizationPass):
+    """Fuses runs of gates on a few qubits into single matrix gates.
+
+    The operations of the circuit are scanned in order and greedily collected
+    into blocks. An operation with a known matrix joins the blocks that are
+    open on its qubits, merging them, as long as the merged block acts on at
+    most max_qubits qubits. Otherwise the largest of those blocks are closed
+    until the rest fit. Operations without a known matrix, such as
+    measurements, and parameterized operations close the blocks on their
+    qubits and are kept as they are.
+
+    Each block of more than one operation is replaced by a FusedGate with the
+    matrix of the block, so that a simulator applies the whole block with
+    one pass over the wave function. The statistics of the last fusion are
+    available as the stats attribute.
+    """
+
+    def __init__(self,
+                 max_qubits: int = 2,
+                 extensions: Extensions = None) -> None:
+        """
+        Args:
+            max_qubits: The largest number of qubits of a fused block.
+            extensions: The extensions to use when trying to cast operations
+                into KnownMatrix instances.
+        """
+        if max_qubits < 1:
+            raise ValueError(
+                'max_qubits must be at least 1. Was {}'.format(max_qubits))
+        self.max_qubits = max_qubits
+        self.extensions = extensions or Extensions()
+        self.stats = None  # type: Optional[FusionStats]
+
+    def optimize_circuit(self, circuit: Circuit):
+        gates_in = 0
+        largest_block = 0
+        output = []  # type: List[ops.Operation]
+        open_blocks = {}  # type: Dict[ops.QubitId, _Block]
+
+        def close(block: _Block):
+            for q in block.qubits:
+                del open_blocks[q]
+            output.append(self._fused_operation(block))
+
+        for op in circuit.all_operations():
+            gates_in += 1
+            blocks = []  # type: List[_Block]
+            for q in op.qubits:
+                block = open_blocks.get(q)
+                if block is not None and block not in blocks:
+                    blocks.append(block)
+
+            parameterizable = self.extensions.try_cast(
+                ops.ParameterizableEffect, op)
+            has_matrix = (len(op.qubits) <= self.max_qubits and
+                          self.extensions.try_cast(ops.KnownMatrix, op)
+                          is not None and
+                          (parameterizable is None or
+                           not parameterizable.is_parameterized()))
+            if not has_matrix:
+                for block in blocks:
+                    close(block)
+                output.append(op)
+                continue
+
+            qubits = _merged_qubits(blocks, op)
+            while len(qubits) > self.max_qubits:
+                largest = max(blocks, key=lambda b: len(b.qubits))
+                blocks.remove(largest)
+                close(largest)
+                qubits = _merged_qubits(blocks, op)
+            merged = _Block(qubits, [o for block in blocks
+                                     for o in block.operations] + [op])
+
+            for q in merged.qubits:
+                open_blocks[q] = merged
+            largest_block = max(largest_block, len(merged.qubits))
+
+        for block in list(open_blocks.values()):
+            if block.qubits[0] in open_blocks:
+                close(block)
+
+        self.stats = FusionStats(gates_in=gates_in,
+                                 blocks_out=len(output),
+                                 largest_block=largest_block)
+        circuit.moments = Circuit.from_ops(
+            output, strategy=InsertStrategy.EARLIEST).moments
+
+    def _fused_operation(self, block: _Block) -> ops.Operation:
+        if len(block.operations) == 1:
+            return block.operations[0]
+        matrix = Circuit.from_ops(block.operations).to_unitary_matrix(
+            qubit_order=block.qubits, ext=self.extensions)
+        return FusedGate(matrix).on(*block.qubits)
@@ -0,0 +1,115 @@
+# Copyright 2018 The Cirq Developers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+
+import cirq
+import cirq.google as cg
+
+
+Q0, Q1, Q2, Q3 = cirq.LineQubit.range(4)
+
+
+def assert_fusion_preserves_matrix(circuit, max_qubits):
+    qubits = sorted(circuit.all_qubits())
+    fused = cirq.Circuit(circuit.moments)
+    fuser = cg.FuseGates(max_qubits)
+    fuser.optimize_circuit(fused)
+    cirq.testing.assert_allclose_up_to_global_phase(
+        fused.to_unitary_matrix(qubit_order=qubits),
+        circuit.to_unitary_matrix(qubit_order=qubits),
+        atol=1e-8)
+    for op in fused.all_operations():
+        assert len(op.qubits) <= max(max_qubits, 2)
+    return fused, fuser.stats
+
+
+def test_fuse_gates():
+    circuit = cirq.Circuit.from_ops(
+        cirq.H(Q0), cirq.H(Q1), cirq.CNOT(Q0, Q1), cirq.X(Q2) ** 0.5,
+        cirq.CZ(Q1, Q2), cirq.Y(Q3), cirq.CNOT(Q2, Q3), cirq.H(Q0),
+        cirq.SWAP(Q0, Q1))
+
+    fused, stats = assert_fusion_preserves_matrix(circuit, 2)
+    assert stats == cg.FusionStats(gates_in=9, blocks_out=4,
+                                   largest_block=2)
+    assert len(fused) == 3
+
+    fused, stats = assert_fusion_preserves_matrix(circuit, 4)
+    assert stats == cg.FusionStats(gates_in=9, blocks_out=1,
+                                   largest_block=4)
+    gate = list(fused.all_operations())[0].gate
+    assert isinstance(gate, cg.FusedGate)
+    assert gate.num_qubits() == 4
+
+    _, stats = assert_fusion_preserves_matrix(circuit, 1)
+    assert stats == cg.FusionStats(gates_in=9, blocks_out=9,
+                                   largest_block=1)
+
+
+def test_fuse_gates_keeps_operations_without_matrix():
+    rot_x = cirq.RotXGate(half_turns=cirq.Symbol('t')).on(Q1)
+    circuit = cirq.Circuit.from_ops(
+        cirq.H(Q0), cirq.CNOT(Q0, Q1), cirq.measure(Q0, key='a'),
+        cirq.H(Q0), cirq.X(Q0), rot_x, cirq.H(Q1))
+    fuser = cg.FuseGates(2)
+    fuser.optimize_circuit(circuit)
+    assert fuser.stats == cg.FusionStats(gates_in=7, blocks_out=5,
+                                         largest_block=2)
+    assert len(circuit) == 3
+    fused_cnot, = circuit[0].operations
+    assert isinstance(fused_cnot.gate, cg.FusedGate)
+    assert fused_cnot.qubits == (Q0, Q1)
+    assert set(circuit[1].operations) == {cirq.measure(Q0, key='a'), rot_x}
+    fused_hx, h = sorted(circuit[2].operations, key=lambda op: op.qubits)
+    assert isinstance(fused_hx.gate, cg.FusedGate)
+    assert fused_hx.qubits == (Q0,)
+    assert h == cirq.H(Q1)
+
+
+def test_fuse_gates_keeps_parameterized_xmon_gates():
+    exp_w = cg.ExpWGate(half_turns=cirq.Symbol('t')).on(Q0)
+    circuit = cirq.Circuit.from_ops(cirq.H(Q0), cirq.X(Q0), exp_w, cirq.H(Q0))
+    fuser = cg.FuseGates(2)
+    fuser.optimize_circuit(circuit)
+    assert fuser.stats == cg.FusionStats(gates_in=4, blocks_out=3,
+                                         largest_block=1)
+    assert list(circuit.all_operations())[1] == exp_w
+
+
+def test_fuse_gates_invalid_max_qubits():
+    with pytest.raises(ValueError):
+        cg.FuseGates(0)
+
+
+def test_fused_gate():
+    matrix = cirq.Circuit.from_ops(cirq.CCZ(Q0, Q1, Q2)).to_unitary_matrix()
+    gate = cg.FusedGate(matrix)
+    assert gate.num_qubits() == 3
+    np.testing.assert_equal(gate.matrix(), matrix)
+    gate.validate_args([Q0, Q1, Q2])
+    with pytest.raises(ValueError):
+        gate.validate_args([Q0, Q1])
+    with pytest.raises(ValueError):
+        cg.FusedGate(np.ones((8, 8)))
+    with pytest.raises(ValueError):
+        cg.FusedGate(np.eye(3))
+
+    eq = cirq.testing.EqualsTester()
+    eq.add_equality_group(gate, cg.FusedGate(matrix))
+    eq.add_equality_group(cg.FusedGate(np.eye(8)))
+    eq.add_equality_group(cg.FusedGate(np.eye(2)))
+    assert str(gate) == 'Fused3'
+    assert repr(cg.FusedGate(np.eye(2))).startswith('FusedGate(array(')
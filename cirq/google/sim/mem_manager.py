@@ -14,21 +14,54 @@
 
 """Global level manager of shared numpy arrays."""
 
+import os
+import tempfile
 import warnings
 from multiprocessing import Lock, RawArray  # type: ignore
+from typing import Any, Dict, Hashable, NamedTuple, Optional, Tuple, Union
+from typing import List, Set  # pylint: disable=unused-import
 
 import numpy as np
 
 
+# Shared memory used by an owner, or by all owners. live_bytes and count are
+# the bytes in and the number of arrays that have not been freed, and
+# peak_bytes is the largest that live_bytes has been.
+MemoryUsage = NamedTuple('MemoryUsage', [
+    ('live_bytes', int),
+    ('peak_bytes', int),
+    ('count', int),
+])
+
+_NO_USAGE = MemoryUsage(0, 0, 0)
+
+# The handle of a RawArray holds its index in the low bits and the number of
+# arrays created before it in the high bits. An index is reused once its array
+# is freed, but a handle is never reused, so freeing a handle twice cannot
+# free the array that reused its index.
+_INDEX_BITS = 32
+_INDEX_MASK = (1 << _INDEX_BITS) - 1
+
+
 class SharedMemManager(object):
     """Manager of global shared numpy arrays.
 
     Multiprocessing requires that shared memory needs to be inherited, and to
     use this with pools (not processes), this requires that it is global. This
     class is responsible for managing this global memory.
-    """
 
-    _INITIAL_SIZE = 1024
+    Arrays can instead be backed by memory-mapped files in a directory, for
+    example on a tmpfs or a local disk, which allows arrays that are larger
+    than physical memory. The handle of such an array is the path of its file,
+    which any process can open, so these arrays need not be inherited. The
+    files are in the .npy format, so they can also be read with np.load.
+
+    Every array has an owner, such as the Stepper that created it, so that
+    all of the arrays of an owner can be freed together and the memory used
+    by each owner can be inspected. Owners should be unique, as an owner that
+    is freed late, for example by a __del__ method, frees the arrays of any
+    later owner equal to it.
+    """
 
     _instance = None  # type: SharedMemManager
 
@@ -40,18 +73,39 @@ class SharedMemManager(object):
 
     def __init__(self):
         self._lock = Lock()
-        self._current = 0
-        self._count = 0
-        self._arrays = SharedMemManager._INITIAL_SIZE * [None]
-
-    def _create_array(self, arr: np.ndarray) -> int:
+        # The RawArrays by the index in their handle, with None for freed
+        # arrays.
+        self._arrays = []  # type: List[Any]
+        # Indices of freed arrays, which are reused before _arrays is grown.
+        self._free_indices = []  # type: List[int]
+        self._num_created = 0
+        # Owners that were freed while the lock was held.
+        self._pending_owners = []  # type: List[Optional[Hashable]]
+        # Memory-mapped arrays opened by this process, keyed by path.
+        self._mapped_arrays = {}  # type: Dict[str, np.ndarray]
+        # The owner and size in bytes of each live array, keyed by handle.
+        self._allocations = {
+        }  # type: Dict[Union[int, str], Tuple[Optional[Hashable], int]]
+        # The handles of the live arrays of each owner.
+        self._owned = {
+        }  # type: Dict[Optional[Hashable], Set[Union[int, str]]]
+        self._usage = {}  # type: Dict[Optional[Hashable], MemoryUsage]
+        self._total_usage = _NO_USAGE
+
+    def _create_array(self, arr: np.ndarray,
+                      directory: str = None,
+                      owner: Optional[Hashable] = None) -> Union[int, str]:
         """Returns the handle of a RawArray created from the given numpy array.
 
         Args:
           arr: A numpy ndarray.
+          directory: If not None, the array is backed by a memory-mapped
+            file created in this directory instead of a RawArray.
+          owner: The owner the array is accounted to.
 
         Returns:
-          The handle (int) of the array.
+          The handle of the array. This is an int for RawArrays and the path
+          of the file for memory-mapped arrays.
 
         Raises:
           ValueError: if arr is not a ndarray or of an unsupported dtype. If
@@ -60,6 +114,11 @@ class SharedMemManager(object):
         """
         if not isinstance(arr, np.ndarray):
             raise ValueError('Array is not a numpy ndarray.')
+        if directory is not None:
+            path = self._create_mapped_array(arr.shape, arr.dtype, directory,
+                                             owner)
+            self._mapped_arrays[path][...] = arr
+            return path
         try:
            c_arr = np.ctypeslib.as_ctypes(arr)
         except KeyError:
@@ -68,41 +127,168 @@ class SharedMemManager(object):
 
         # pylint: disable=protected-access
         raw_arr = RawArray(c_arr._type_, c_arr)
+        return self._add_raw_array(raw_arr, owner, arr.nbytes)
 
-        with self._lock:
-            if self._count >= len(self._arrays):
-                self._arrays += len(self._arrays) * [None]
+    def _create_empty_array(self, shape: Tuple[int, ...],
+                            dtype: type,
+                            directory: str = None,
+                            owner: Optional[Hashable] = None
+                            ) -> Union[int, str]:
+        """Returns the handle of a new array filled with zeros.
 
-            self._get_next_free()
+        Unlike _create_array, no numpy array of the same size is needed to
+        create the array.
 
-            self._arrays[self._current] = raw_arr
-
-            self._count += 1
+        Args:
+          shape: The shape of the array, with at least one dimension.
+          dtype: The dtype of the array.
+          directory: If not None, the array is backed by a memory-mapped
+            file created in this directory instead of a RawArray.
+          owner: The owner the array is accounted to.
 
-        return self._current
+        Returns:
+          The handle of the array.
 
-    def _get_next_free(self):
-        loop_count = 0
-        while self._arrays[self._current] is not None:
-            self._current = (self._current + 1) % len(self._arrays)
-            loop_count += 1
-            if loop_count == len(self._arrays):
-                raise RuntimeError(
-                    'Cannot find free space to allocate new array.')
+        Raises:
+          ValueError: if the dtype is unsupported.
+        """
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if directory is not None:
+            return self._create_mapped_array(shape, dtype, directory, owner)
+        try:
+            # pylint: disable=protected-access
+            c_type = np.ctypeslib.as_ctypes(np.zeros(1, dtype=dtype))._type_
+        except KeyError:
+            raise ValueError('Array has unsupported dtype {}.'.format(dtype))
+        for dim in reversed(shape[1:]):
+            c_type = c_type * dim
+        # RawArrays are created filled with zeros.
+        raw_arr = RawArray(c_type, shape[0])
+        return self._add_raw_array(raw_arr, owner, nbytes)
+
+    def _add_raw_array(self, raw_arr: Any, owner: Optional[Hashable],
+                       nbytes: int) -> int:
+        self._free_pending_owners()
+        with self._lock:
+            if self._free_indices:
+                index = self._free_indices.pop()
+                self._arrays[index] = raw_arr
+            else:
+                index = len(self._arrays)
+                self._arrays.append(raw_arr)
+            handle = (self._num_created << _INDEX_BITS) | index
+            self._num_created += 1
+            self._track(handle, owner, nbytes)
+        return handle
+
+    def _create_mapped_array(self, shape: Tuple[int, ...], dtype: type,
+                             directory: str,
+                             owner: Optional[Hashable]) -> str:
+        self._free_pending_owners()
+        file_descriptor, path = tempfile.mkstemp(suffix='.npy', dir=directory)
+        os.close(file_descriptor)
+        mapped = np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                           shape=shape)
+        with self._lock:
+            self._mapped_arrays[path] = mapped.view(np.ndarray)
+            self._track(path, owner, mapped.nbytes)
+        return path
+
+    def _track(self, handle: Union[int, str], owner: Optional[Hashable],
+               nbytes: int):
+        """Accounts for a new array. Must be called holding the lock."""
+        self._allocations[handle] = (owner, nbytes)
+        self._owned.setdefault(owner, set()).add(handle)
+        self._usage[owner] = _add_usage(
+            self._usage.get(owner, _NO_USAGE), nbytes, 1)
+        self._total_usage = _add_usage(self._total_usage, nbytes, 1)
+
+    def _untrack(self, handle: Union[int, str]) -> bool:
+        """Accounts for a freed array. Must be called holding the lock.
 
-    def _free_array(self, handle: int):
+        Returns:
+          Whether the array was live.
+        """
+        if handle not in self._allocations:
+            return False
+        owner, nbytes = self._allocations.pop(handle)
+        self._owned[owner].remove(handle)
+        self._usage[owner] = _add_usage(self._usage[owner], -nbytes, -1)
+        self._total_usage = _add_usage(self._total_usage, -nbytes, -1)
+        # Forget owners without arrays, so that short lived owners do not
+        # accumulate.
+        if not self._owned[owner]:
+            del self._owned[owner]
+            del self._usage[owner]
+        return True
+
+    def _free_array(self, handle: Union[int, str]):
         """Frees the memory for the array with the given handle.
 
+        Freeing an array that was already freed does nothing.
+
         Args:
           handle: The handle of the array whose memory should be freed. This
             handle must come from the _create_array method.
         """
+        self._free_pending_owners()
+        with self._lock:
+            path = self._release(handle)
+        _remove_file(path)
+
+    def _free_owner(self, owner: Optional[Hashable], block: bool = True):
+        """Frees the memory for all of the arrays of the given owner.
+
+        Owners are also freed from __del__ methods, which the garbage
+        collector can call while this thread holds the lock. Those pass
+        block=False: rather than wait for the lock, which could deadlock, a
+        busy lock leaves the owner to be freed by the next call that creates
+        or frees an array.
+        """
+        if not self._lock.acquire(block):
+            self._pending_owners.append(owner)
+            return
+        try:
+            paths = [self._release(handle)
+                     for handle in list(self._owned.get(owner, ()))]
+        finally:
+            self._lock.release()
+        for path in paths:
+            _remove_file(path)
+
+    def _free_pending_owners(self):
+        for _ in range(len(self._pending_owners)):
+            self._free_owner(self._pending_owners.pop(), block=False)
+
+    def _release(self, handle: Union[int, str]) -> Optional[str]:
+        """Releases an array. Must be called holding the lock.
+
+        Returns:
+          The path of the file to remove for memory-mapped arrays.
+        """
+        if not self._untrack(handle):
+            return None
+        if isinstance(handle, str):
+            self._mapped_arrays.pop(handle, None)
+            return handle
+        index = handle & _INDEX_MASK
+        self._arrays[index] = None
+        self._free_indices.append(index)
+        return None
+
+    def _get_usage(self, owner: Optional[Hashable]) -> MemoryUsage:
         with self._lock:
-            if self._arrays[handle] is not None:
-                self._arrays[handle] = None
-                self._count -= 1
+            return self._usage.get(owner, _NO_USAGE)
 
-    def _get_array(self, handle: int) -> np.ndarray:
+    def _get_usage_by_owner(self) -> Dict[Optional[Hashable], MemoryUsage]:
+        with self._lock:
+            return dict(self._usage)
+
+    def _get_total_usage(self) -> MemoryUsage:
+        with self._lock:
+            return self._total_usage
+
+    def _get_array(self, handle: Union[int, str]) -> np.ndarray:
         """Returns the array with the given handle.
 
         Args:
@@ -111,10 +297,23 @@ class SharedMemManager(object):
 
         Returns:
           The numpy ndarray with the handle given from _create_array.
+
+        Raises:
+          ValueError: The array was freed. The index of a freed array is
+            reused, so its handle would otherwise return a later array.
         """
+        if isinstance(handle, str):
+            with self._lock:
+                if handle not in self._mapped_arrays:
+                    self._mapped_arrays[handle] = np.lib.format.open_memmap(
+                        handle, mode='r+').view(np.ndarray)
+                return self._mapped_arrays[handle]
+        if handle not in self._allocations:
+            raise ValueError('The array with handle {} was freed.'.format(
+                handle))
         with warnings.catch_warnings():
             warnings.simplefilter('ignore', RuntimeWarning)
-            return np.ctypeslib.as_array(self._arrays[handle])
+            return np.ctypeslib.as_array(self._arrays[handle & _INDEX_MASK])
 
     @staticmethod
     def get_instance() -> 'SharedMemManager':
@@ -124,15 +323,22 @@ class SharedMemManager(object):
         return SharedMemManager._instance
 
     @staticmethod
-    def create_array(arr: np.ndarray) -> int:
+    def create_array(arr: np.ndarray,
+                     directory: str = None,
+                     owner: Optional[Hashable] = None) -> Union[int, str]:
         """Returns the handle of a RawArray created from the given numpy array.
 
         Args:
           arr: A numpy ndarray. Only arrays with a dtype supported by numpy
             ctypeslib as_ctypes can be used.
+          directory: If not None, the array is instead backed by a
+            memory-mapped file created in this directory.
+          owner: The owner the array is accounted to, which can free it
+            along with its other arrays using free_owner.
 
         Returns:
-          The handle (int) of the array.
+          The handle of the array. This is an int for RawArrays and the path
+          of the file for memory-mapped arrays.
 
         Raises:
           ValueError: if arr is not a ndarray or of an unsupported dtype. If
@@ -140,10 +346,42 @@ class SharedMemManager(object):
             another dtype and then converting on get is often a work around.
         """
         # pylint: disable=protected-access
-        return SharedMemManager._instance._create_array(arr)
+        return SharedMemManager._instance._create_array(arr, directory, owner)
 
     @staticmethod
-    def free_array(handle: int):
+    def create_empty_array(shape: Tuple[int, ...],
+                           dtype: type,
+                           directory: str = None,
+                           owner: Optional[Hashable] = None
+                           ) -> Union[int, str]:
+        """Returns the handle of a new array filled with zeros.
+
+        Unlike create_array, no numpy array of the same size is needed to
+        create the array, so arrays larger than physical memory can be
+        created in a directory.
+
+        Args:
+          shape: The shape of the array, with at least one dimension.
+          dtype: The dtype of the array. Only dtypes supported by numpy
+            ctypeslib as_ctypes can be used.
+          directory: If not None, the array is instead backed by a
+            memory-mapped file created in this directory.
+          owner: The owner the array is accounted to, which can free it
+            along with its other arrays using free_owner.
+
+        Returns:
+          The handle of the array. This is an int for RawArrays and the path
+          of the file for memory-mapped arrays.
+
+        Raises:
+          ValueError: if the dtype is unsupported.
+        """
+        # pylint: disable=protected-access
+        return SharedMemManager._instance._create_empty_array(
+            shape, dtype, directory, owner)
+
+    @staticmethod
+    def free_array(handle: Union[int, str]):
         """Frees the memory for the array with the given handle.
 
         Args:
@@ -154,7 +392,46 @@ class SharedMemManager(object):
         SharedMemManager._instance._free_array(handle)
 
     @staticmethod
-    def get_array(handle: int) -> np.ndarray:
+    def free_owner(owner: Optional[Hashable], block: bool = True):
+        """Frees the memory for all of the arrays of the given owner.
+
+        Args:
+          owner: The owner given to create_array.
+          block: Whether to wait for the lock of the manager. If False and
+            the lock is held, the arrays are freed by the next call that
+            creates or frees an array instead. __del__ methods must pass
+            False, since the garbage collector can call them while the lock
+            is held by the same thread.
+        """
+        # pylint: disable=protected-access
+        SharedMemManager._instance._free_owner(owner, block)
+
+    @staticmethod
+    def usage(owner: Optional[Hashable] = None) -> MemoryUsage:
+        """Returns the memory used by the arrays of the given owner.
+
+        The peak of an owner is forgotten once all of its arrays are freed.
+
+        Args:
+          owner: The owner given to create_array.
+        """
+        # pylint: disable=protected-access
+        return SharedMemManager._instance._get_usage(owner)
+
+    @staticmethod
+    def usage_by_owner() -> Dict[Optional[Hashable], MemoryUsage]:
+        """Returns the memory used by each owner with live arrays."""
+        # pylint: disable=protected-access
+        return SharedMemManager._instance._get_usage_by_owner()
+
+    @staticmethod
+    def total_usage() -> MemoryUsage:
+        """Returns the memory used by the arrays of all owners."""
+        # pylint: disable=protected-access
+        return SharedMemManager._instance._get_total_usage()
+
+    @staticmethod
+    def get_array(handle: Union[int, str]) -> np.ndarray:
         """Frees the memory for the array with the given handle.
 
         Args:
@@ -163,10 +440,26 @@ class SharedMemManager(object):
 
         Returns:
           The numpy ndarray with the handle given from _create_array.
+
+        Raises:
+          ValueError: The array was freed.
         """
         # pylint: disable=protected-access
         return SharedMemManager._instance._get_array(handle)
 
 
+def _remove_file(path: Optional[str]):
+    if path is not None and os.path.exists(path):
+        os.remove(path)
+
+
+def _add_usage(usage: MemoryUsage, nbytes: int, count: int) -> MemoryUsage:
+    """Returns the usage after allocating (or, if negative, freeing) arrays."""
+    live_bytes = usage.live_bytes + nbytes
+    return MemoryUsage(live_bytes=live_bytes,
+                       peak_bytes=max(usage.peak_bytes, live_bytes),
+                       count=usage.count + count)
+
+
 # Create instance on module load.
 SharedMemManager.get_instance()
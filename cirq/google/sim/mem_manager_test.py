@@ -17,6 +17,8 @@
 from __future__ import absolute_import
 
 import multiprocessing
+import os
+import threading
 import pytest
 
 import numpy as np
@@ -79,6 +81,105 @@ def test_fills_gaps():
     mem_manager.SharedMemManager.free_array(new_handle)
 
 
+def index(handle):
+    return handle & mem_manager._INDEX_MASK
+
+
+def test_reuses_freed_handles():
+    handles = [mem_manager.SharedMemManager.create_array(np.array([i]))
+               for i in range(3)]
+    mem_manager.SharedMemManager.free_array(handles[1])
+    # Freeing twice does not free the handle twice.
+    mem_manager.SharedMemManager.free_array(handles[1])
+    new_handles = [mem_manager.SharedMemManager.create_array(np.array([3]))
+                   for _ in range(2)]
+    assert index(new_handles[0]) == index(handles[1])
+    assert index(new_handles[1]) not in [index(h) for h in handles]
+    assert new_handles[0] not in handles
+
+    # The stale handle does not free or get the array that reused its index.
+    count = mem_manager.SharedMemManager.total_usage().count
+    mem_manager.SharedMemManager.free_array(handles[1])
+    assert mem_manager.SharedMemManager.total_usage().count == count
+    np.testing.assert_equal(
+        mem_manager.SharedMemManager.get_array(new_handles[0]), [3])
+    with pytest.raises(ValueError, match='freed'):
+        mem_manager.SharedMemManager.get_array(handles[1])
+    for handle in handles[::2] + new_handles:
+        mem_manager.SharedMemManager.free_array(handle)
+
+
+def test_free_owner():
+    owner = 'test_free_owner'
+    other = mem_manager.SharedMemManager.create_array(np.array([1]))
+    handles = [mem_manager.SharedMemManager.create_array(np.array([i]),
+                                                         owner=owner)
+               for i in range(3)]
+    mem_manager.SharedMemManager.free_owner(owner)
+    assert mem_manager.SharedMemManager.usage(owner).count == 0
+    new_handles = [mem_manager.SharedMemManager.create_array(np.array([i]))
+                   for i in range(3)]
+    assert {index(h) for h in new_handles} == {index(h) for h in handles}
+    np.testing.assert_equal(mem_manager.SharedMemManager.get_array(other), [1])
+    for handle in new_handles + [other]:
+        mem_manager.SharedMemManager.free_array(handle)
+
+
+def test_free_owner_while_locked():
+    owner = 'test_free_owner_while_locked'
+    handle = mem_manager.SharedMemManager.create_array(np.array([1]),
+                                                       owner=owner)
+    # As when the garbage collector frees an owner while the lock is held.
+    manager = mem_manager.SharedMemManager.get_instance()
+    with manager._lock:
+        mem_manager.SharedMemManager.free_owner(owner, block=False)
+    assert mem_manager.SharedMemManager.usage(owner).count == 1
+    # The owner is freed by the next call that creates or frees an array.
+    other = mem_manager.SharedMemManager.create_array(np.array([2]))
+    assert mem_manager.SharedMemManager.usage(owner).count == 0
+    assert handle not in manager._allocations
+    mem_manager.SharedMemManager.free_array(other)
+
+
+def test_free_owner_waits_for_lock():
+    owner = 'test_free_owner_waits_for_lock'
+    mem_manager.SharedMemManager.create_array(np.array([1]), owner=owner)
+    manager = mem_manager.SharedMemManager.get_instance()
+    manager._lock.acquire()
+    release = threading.Timer(0.1, manager._lock.release)
+    release.start()
+    mem_manager.SharedMemManager.free_owner(owner)
+    release.join()
+    # The arrays were freed once the lock was released, not left pending.
+    assert mem_manager.SharedMemManager.usage(owner).count == 0
+    assert not manager._pending_owners
+
+
+def test_usage(tmpdir):
+    owner = 'test_usage'
+    total = mem_manager.SharedMemManager.total_usage()
+    assert mem_manager.SharedMemManager.usage(owner) == (0, 0, 0)
+
+    small = mem_manager.SharedMemManager.create_array(
+        np.zeros(2, dtype=np.float32), owner=owner)
+    large = mem_manager.SharedMemManager.create_array(
+        np.zeros(4, dtype=np.float64), str(tmpdir), owner=owner)
+    assert mem_manager.SharedMemManager.usage(owner) == (40, 40, 2)
+    assert mem_manager.SharedMemManager.usage_by_owner()[owner] == (40, 40, 2)
+    assert (mem_manager.SharedMemManager.total_usage().live_bytes ==
+            total.live_bytes + 40)
+
+    mem_manager.SharedMemManager.free_array(large)
+    assert mem_manager.SharedMemManager.usage(owner) == (8, 40, 1)
+    mem_manager.SharedMemManager.free_array(small)
+    assert owner not in mem_manager.SharedMemManager.usage_by_owner()
+    assert mem_manager.SharedMemManager.usage(owner) == (0, 0, 0)
+    assert mem_manager.SharedMemManager.total_usage().live_bytes == (
+        total.live_bytes)
+    assert mem_manager.SharedMemManager.total_usage().peak_bytes >= (
+        total.live_bytes + 40)
+
+
 def test_with_multiprocessing_pool():
     one = np.array([1])
     handle = mem_manager.SharedMemManager.create_array(one)
@@ -107,3 +208,58 @@ def test_with_multiple_multiprocessing_pools():
     np.testing.assert_equal([2] * 10, two_result)
     mem_manager.SharedMemManager.free_array(one_handle)
     mem_manager.SharedMemManager.free_array(two_handle)
+
+
+def test_mapped_array(tmpdir):
+    arr = np.array([[1.0, 2.0], [3.0, 4.0]], dtype=np.float32)
+    handle = mem_manager.SharedMemManager.create_array(arr, str(tmpdir))
+    assert os.path.dirname(handle) == str(tmpdir)
+    assert os.path.exists(handle)
+    mapped = mem_manager.SharedMemManager.get_array(handle)
+    assert mapped.dtype == np.float32
+    np.testing.assert_equal(mapped, arr)
+
+    # Writes go to the file, which is in the .npy format.
+    mapped[1, 1] = 5.0
+    np.testing.assert_equal(np.load(handle), [[1.0, 2.0], [3.0, 5.0]])
+
+    mem_manager.SharedMemManager.free_array(handle)
+    assert not os.path.exists(handle)
+    # Freeing twice is harmless.
+    mem_manager.SharedMemManager.free_array(handle)
+
+
+@pytest.mark.parametrize('in_directory', (False, True))
+def test_create_empty_array(in_directory, tmpdir):
+    directory = str(tmpdir) if in_directory else None
+    handle = mem_manager.SharedMemManager.create_empty_array(
+        (2, 3), np.float32, directory, owner='empty')
+    arr = mem_manager.SharedMemManager.get_array(handle)
+    assert arr.dtype == np.float32
+    np.testing.assert_equal(arr, np.zeros((2, 3)))
+    arr[1, 2] = 1.0
+    np.testing.assert_equal(mem_manager.SharedMemManager.get_array(handle),
+                            [[0, 0, 0], [0, 0, 1]])
+    assert mem_manager.SharedMemManager.usage('empty').live_bytes == 24
+    mem_manager.SharedMemManager.free_owner('empty')
+
+
+def test_create_empty_array_unsupported_dtype():
+    with pytest.raises(ValueError):
+        mem_manager.SharedMemManager.create_empty_array((2,), np.complex64)
+
+
+def add_one_to_mapped(handle: str):
+    mem_manager.SharedMemManager.get_array(handle)[0] += 1
+
+
+def test_mapped_array_with_multiprocessing_pool(tmpdir):
+    arr = np.zeros(10)
+    handle = mem_manager.SharedMemManager.create_array(arr, str(tmpdir))
+    pool = multiprocessing.Pool(processes=2)
+    pool.map(add_one_to_mapped, [handle])
+    pool.close()
+    pool.join()
+    np.testing.assert_equal(
+        mem_manager.SharedMemManager.get_array(handle)[0], 1)
+    mem_manager.SharedMemManager.free_array(handle)
@@ -0,0 +1,130 @@
+# Copyright 2018 The Cirq Developers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Single qubit noise channels given by their Kraus operators."""
+
+from typing import List
+
+import numpy as np
+
+from cirq import abc
+
+
+def _check_probability(name: str, value: float):
+    if not 0 <= value <= 1:
+        raise ValueError(
+            '{} must be between 0 and 1. Was {}'.format(name, value))
+
+
+class KrausChannel(metaclass=abc.ABCMeta):
+    """A single qubit noise channel.
+
+    The channel maps a density matrix rho to sum_k K_k rho K_k^dagger, where
+    the K_k are its Kraus operators.
+    """
+
+    @abc.abstractmethod
+    def kraus_operators(self) -> List[np.ndarray]:
+        """Returns the 2x2 Kraus operators of the channel."""
+
+    def superoperator(self) -> np.ndarray:
+        """Returns the channel as a 4x4 matrix.
+
+        The matrix acts on the density matrix of the qubit flattened in row
+        major order, so that a channel can be applied to a qubit of a larger
+        density matrix with a single tensor contraction, and several channels
+        on the same qubit can be combined by multiplying their matrices.
+        """
+        return sum(np.kron(k, np.conj(k)) for k in self.kraus_operators())
+
+
+class DepolarizingChannel(KrausChannel):
+    """Applies each of the X, Y and Z errors with probability p / 3."""
+
+    def __init__(self, p: float) -> None:
+        _check_probability('Depolarizing probability', p)
+        self.p = p
+
+    def kraus_operators(self) -> List[np.ndarray]:
+        return [np.sqrt(1 - self.p) * np.eye(2),
+                np.sqrt(self.p / 3) * np.array([[0, 1], [1, 0]]),
+                np.sqrt(self.p / 3) * np.array([[0, -1j], [1j, 0]]),
+                np.sqrt(self.p / 3) * np.array([[1, 0], [0, -1]])]
+
+    def __eq__(self, other):
+        if not isinstance(other, type(self)):
+            return NotImplemented
+        return self.p == other.p
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((DepolarizingChannel, self.p))
+
+    def __repr__(self):
+        return 'cirq.google.DepolarizingChannel(p={!r})'.format(self.p)
+
+
+class AmplitudeDampingChannel(KrausChannel):
+    """Decays the |1> state to the |0> state with probability gamma."""
+
+    def __init__(self, gamma: float) -> None:
+        _check_probability('Amplitude damping gamma', gamma)
+        self.gamma = gamma
+
+    def kraus_operators(self) -> List[np.ndarray]:
+        return [np.array([[1, 0], [0, np.sqrt(1 - self.gamma)]]),
+                np.array([[0, np.sqrt(self.gamma)], [0, 0]])]
+
+    def __eq__(self, other):
+        if not isinstance(other, type(self)):
+            return NotImplemented
+        return self.gamma == other.gamma
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((AmplitudeDampingChannel, self.gamma))
+
+    def __repr__(self):
+        return 'cirq.google.AmplitudeDampingChannel(gamma={!r})'.format(
+            self.gamma)
+
+
+class DephasingChannel(KrausChannel):
+    """Applies a Z error with probability p."""
+
+    def __init__(self, p: float) -> None:
+        _check_probability('Dephasing probability', p)
+        self.p = p
+
+    def kraus_operators(self) -> List[np.ndarray]:
+        return [np.sqrt(1 - self.p) * np.eye(2),
+                np.sqrt(self.p) * np.array([[1, 0], [0, -1]])]
+
+    def __eq__(self, other):
+        if not isinstance(other, type(self)):
+            return NotImplemented
+        return self.p == other.p
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((DephasingChannel, self.p))
+
+    def __repr__(self):
+        return 'cirq.google.DephasingChannel(p={!r})'.format(self.p)
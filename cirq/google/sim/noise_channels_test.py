@@ -0,0 +1,87 @@
+# Copyright 2018 The Cirq Developers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+
+import cirq
+import cirq.google as cg
+
+
+def apply_kraus(channel, rho):
+    return sum(k.dot(rho).dot(np.conj(k).T)
+               for k in channel.kraus_operators())
+
+
+@pytest.mark.parametrize('channel', (
+    cg.DepolarizingChannel(0.3),
+    cg.AmplitudeDampingChannel(0.2),
+    cg.DephasingChannel(0.1),
+    cg.DepolarizingChannel(0),
+    cg.AmplitudeDampingChannel(1),
+))
+def test_channel_is_trace_preserving(channel):
+    total = sum(np.conj(k).T.dot(k) for k in channel.kraus_operators())
+    np.testing.assert_allclose(total, np.eye(2), atol=1e-8)
+
+
+@pytest.mark.parametrize('channel', (
+    cg.DepolarizingChannel(0.3),
+    cg.AmplitudeDampingChannel(0.2),
+    cg.DephasingChannel(0.1),
+))
+def test_superoperator(channel):
+    rho = np.array([[0.7, 0.2 - 0.3j], [0.2 + 0.3j, 0.3]])
+    np.testing.assert_allclose(
+        np.reshape(channel.superoperator().dot(np.reshape(rho, -1)), (2, 2)),
+        apply_kraus(channel, rho),
+        atol=1e-8)
+
+
+def test_channels_on_states():
+    one = np.diag([0, 1])
+    plus = np.full((2, 2), 0.5)
+    np.testing.assert_allclose(
+        apply_kraus(cg.AmplitudeDampingChannel(0.25), one),
+        np.diag([0.25, 0.75]), atol=1e-8)
+    np.testing.assert_allclose(
+        apply_kraus(cg.DephasingChannel(0.25), plus),
+        [[0.5, 0.25], [0.25, 0.5]], atol=1e-8)
+    np.testing.assert_allclose(
+        apply_kraus(cg.DepolarizingChannel(0.75), one),
+        np.eye(2) / 2, atol=1e-8)
+
+
+def test_invalid_probabilities():
+    with pytest.raises(ValueError):
+        cg.DepolarizingChannel(-0.1)
+    with pytest.raises(ValueError):
+        cg.AmplitudeDampingChannel(1.1)
+    with pytest.raises(ValueError):
+        cg.DephasingChannel(2)
+
+
+def test_channel_eq_and_repr():
+    eq = cirq.testing.EqualsTester()
+    eq.add_equality_group(cg.DepolarizingChannel(0.1),
+                          cg.DepolarizingChannel(0.1))
+    eq.add_equality_group(cg.DepolarizingChannel(0.2))
+    eq.add_equality_group(cg.AmplitudeDampingChannel(0.1))
+    eq.add_equality_group(cg.DephasingChannel(0.1))
+    assert (repr(cg.DepolarizingChannel(0.1)) ==
+            'cirq.google.DepolarizingChannel(p=0.1)')
+    assert (repr(cg.AmplitudeDampingChannel(0.1)) ==
+            'cirq.google.AmplitudeDampingChannel(gamma=0.1)')
+    assert (repr(cg.DephasingChannel(0.1)) ==
+            'cirq.google.DephasingChannel(p=0.1)')
@@ -35,22 +35,46 @@ via.
 
 import math
 import collections
-from typing import Dict, Iterable, Iterator, List, Set, Union, cast
-from typing import Tuple  # pylint: disable=unused-import
+import contextlib
+import multiprocessing
+from typing import (
+    Any, Callable, ContextManager, Dict, FrozenSet, Iterable, Iterator, List,
+    Optional, Sequence, Set, Tuple, Union, cast,
+)
+from typing import TYPE_CHECKING
 
 import numpy as np
 
 from cirq import ops
-from cirq.circuits import Circuit
+from cirq.circuits import Circuit, CompactCircuit, Moment
 from cirq.circuits.drop_empty_moments import DropEmptyMoments
 from cirq.extension import Extensions
 from cirq.google import xmon_gates
 from cirq.google import xmon_gate_ext
 from cirq.google.convert_to_xmon_gates import ConvertToXmonGates
 from cirq.google.sim import xmon_stepper
+from cirq.google.sim.fuse_gates import FusedGate, FuseGates
 from cirq.ops import raw_types
 from cirq.schedules import Schedule
-from cirq.study import ParamResolver, Sweep, Sweepable, TrialResult
+from cirq.study import ParamResolver, Sweepable, TrialResult, to_resolvers
+
+if TYPE_CHECKING:
+    # pylint: disable=unused-import
+    from cirq.contrib.paulistring import PauliString
+
+
+# A circuit of xmon gates, held whole or expanded from a compact circuit.
+_XmonCircuit = Union[Circuit, '_CompactXmonCircuit']
+
+# Number of compiled circuits a simulator caches.
+_COMPILED_CIRCUIT_CACHE_SIZE = 16
+
+# Marks a circuit missing from the compiled circuit cache, since a circuit
+# that cannot be compiled is cached as None.
+_NOT_COMPILED = object()
+
+# Number of operations of a compact circuit read out of its arrays at a time.
+_OPERATIONS_PER_CHUNK = 1 << 20
 
 
 class XmonOptions:
@@ -66,12 +90,40 @@ class XmonOptions:
             but on the order of 10 percent faster).  However this varies
             significantly by architecture, and processes should not be used
             for interactive use on Windows.
+        renorm_policy: Determines when the wave function is renormalized to
+            correct for floating point drift.
+        dtype: The numpy dtype of the wave function, np.complex64 or
+            np.complex128.
+        sweep_processes: The number of processes used to simulate the points
+            of a sweep in parallel. Only circuits on fewer than
+            min_qubits_before_shard qubits, which are not sharded, are
+            simulated in parallel.
+        plan_shard_qubits: Whether to reorder the qubits of sharded
+            simulations, so that the qubits with the most W gates are not
+            sharded over.
+        state_directory: A directory to store the wave function in as
+            memory-mapped files, or None to keep it in memory.
+        low_memory: Whether to simulate without a scratch pad, halving the
+            memory used.
+        matrix_gates: Whether to simulate 1-qubit and 2-qubit gates with a
+            known matrix directly, instead of converting them to xmon gates.
+        fusion_qubits: If not None, runs of gates are fused into matrix gates
+            on up to this many qubits before simulating.
     """
 
     def __init__(self,
                  num_shards: int=None,
                  min_qubits_before_shard: int=18,
-                 use_processes: bool=False) -> None:
+                 use_processes: bool=False,
+                 renorm_policy: xmon_stepper.RenormPolicy =
+                 xmon_stepper.RenormPolicy.EVERY_MOMENT,
+                 dtype: type = np.complex64,
+                 sweep_processes: int = 1,
+                 plan_shard_qubits: bool = False,
+                 state_directory: str = None,
+                 low_memory: bool = False,
+                 matrix_gates: bool = False,
+                 fusion_qubits: int = None) -> None:
         """XmonSimulator options constructor.
 
         Args:
@@ -86,6 +138,52 @@ class XmonOptions:
                 machine but on the order of 10 percent faster).  However this
                 varies significantly by architecture, and processes should not
                 be used for interactive python use on Windows.
+            renorm_policy: Determines when the wave function is renormalized
+                to correct for floating point drift. The default renormalizes
+                after every moment. Using RenormPolicy.BEFORE_MEASUREMENT, or
+                a policy with a period or tolerance, saves two passes over the
+                wave function per moment.
+            dtype: The numpy dtype of the wave function. The default
+                np.complex64 is faster and uses half the memory; np.complex128
+                should be used for deep circuits or when precise amplitudes
+                are needed.
+            sweep_processes: The number of processes used to simulate the
+                points of a sweep in parallel. The default of 1 simulates
+                points one after another in this process. Only circuits on
+                fewer than min_qubits_before_shard qubits are simulated in
+                parallel, as larger circuits already shard the wave function
+                across processors. Each point gets its own random seed drawn
+                from np.random, so seeding np.random makes parallel sweeps
+                reproducible.
+            plan_shard_qubits: Whether to reorder the qubits of sharded
+                simulations. W gates on the qubits that the wave function is
+                sharded over need a pass across shards, so when this is True
+                the qubits with the fewest W gates are the ones sharded over.
+                The reordering is undone for states that are passed in or
+                returned, but then XmonStepResult.state(copy=False) returns a
+                copy.
+            state_directory: If not None, the wave function and the scratch
+                pad of the same size are stored in memory-mapped files in
+                this directory instead of in memory. Pointing this at a tmpfs
+                or a local disk allows simulations larger than physical
+                memory. If the simulation crashes, the wave function can be
+                recovered from these .npy files.
+            low_memory: If True, no scratch pad the size of the wave function
+                is allocated, halving the memory used. W gates on the qubits
+                that the wave function is sharded over are then applied in
+                place on pairs of shards, using half as many workers.
+            matrix_gates: If True, 1-qubit and 2-qubit gates that are not
+                xmon gates but have a known matrix are simulated by applying
+                their matrix, instead of being synthesized from several xmon
+                gates. A general 2-qubit gate is then one pass over the wave
+                function rather than up to 3 CZs and 8 single qubit gates.
+            fusion_qubits: If not None, the circuit is passed through
+                FuseGates before being simulated, which fuses runs of gates
+                into blocks of up to this many qubits. Each block is applied
+                with a single pass over the wave function. Between 2 and 5
+                qubits is typical, as the cost of applying a block grows
+                exponentially with its number of qubits. The final state may
+                differ by a global phase from the one without fusion.
         """
         assert num_shards is None or num_shards > 0, (
             "Num_shards cannot be less than 1.")
@@ -98,6 +196,20 @@ class XmonOptions:
             'Min_qubit_before_shard must be positive.')
         self.min_qubits_before_shard = min_qubits_before_shard
         self.use_processes = use_processes
+        self.renorm_policy = renorm_policy
+        assert dtype in xmon_stepper.SUPPORTED_DTYPES, (
+            'Dtype must be np.complex64 or np.complex128.')
+        self.dtype = dtype
+        assert sweep_processes >= 1, (
+            'Sweep_processes must be at least 1.')
+        self.sweep_processes = sweep_processes
+        self.plan_shard_qubits = plan_shard_qubits
+        self.state_directory = state_directory
+        self.low_memory = low_memory
+        self.matrix_gates = matrix_gates
+        assert fusion_qubits is None or fusion_qubits >= 1, (
+            'Fusion_qubits must be at least 1.')
+        self.fusion_qubits = fusion_qubits
 
 
 class XmonSimulateTrialResult:
@@ -156,6 +268,14 @@ class XmonSimulator:
         simulate
         simulate_sweep
         simulate_moment_steps (for stepping through a circuit moment by moment)
+
+    To get exact expectation values of Pauli observables on the final wave
+    function, without sampling and without returning the wave function, the
+    expectation_values method is provided.
+
+    The simulator keeps its steppers, and its pool of processes for sweeps
+    when options.sweep_processes is above one, alive between calls. The close
+    method shuts them down.
     """
 
     def __init__(self, options: XmonOptions = None) -> None:
@@ -165,6 +285,13 @@ class XmonSimulator:
             options: XmonOptions configuring the simulation.
         """
         self.options = options or XmonOptions()
+        self._stepper_cache = _StepperCache()
+        # The pool of processes simulating sweep points, created when first
+        # needed.
+        self._sweep_pool = None  # type: Any
+        self._compiled_circuits = (
+            collections.OrderedDict()
+        )  # type: collections.OrderedDict
 
     def run(
         self,
@@ -200,7 +327,7 @@ class XmonSimulator:
 
     def run_sweep(
             self,
-            program: Union[Circuit, Schedule],
+            program: Union[Circuit, CompactCircuit, Schedule],
             params: Sweepable = ParamResolver({}),
             repetitions: int = 1,
             qubit_order: ops.QubitOrderOrList = ops.QubitOrder.DEFAULT,
@@ -215,7 +342,9 @@ class XmonSimulator:
         computational basis.
 
         Args:
-            program: The circuit or schedule to simulate.
+            program: The circuit, compact circuit or schedule to simulate.
+                A compact circuit is converted to xmon gates and simulated
+                one moment at a time, see CompactCircuit.
             params: Parameters to run with the program.
             repetitions: The number of repetitions to simulate.
             qubit_order: Determines the canonical ordering of the qubits used to
@@ -228,23 +357,34 @@ class XmonSimulator:
             TrialResult list for this run; one for each possible parameter
             resolver.
         """
-        circuit = (
-            program if isinstance(program, Circuit) else program.to_circuit())
-        param_resolvers = self._to_resolvers(params or ParamResolver({}))
+        circuit = (program if isinstance(program, (Circuit, CompactCircuit))
+                   else program.to_circuit())
+        param_resolvers = to_resolvers(params or ParamResolver({}))
+        extensions = extensions or xmon_gate_ext
+
+        # The moments before the first parameterized one are the same for
+        # every point, so they are simulated once and each point continues
+        # from their final state.
+        prefix, circuit = self._split_sweep_prefix(circuit, param_resolvers,
+                                                   extensions)
+        checkpoints = {}  # type: Dict[Tuple, Union[int, np.ndarray]]
 
-        trial_results = []  # type: List[TrialResult]
         qubit_order = ops.QubitOrder.as_qubit_order(qubit_order)
-        for param_resolver in param_resolvers:
-            xmon_circuit, keys = self._to_xmon_circuit(
-                    circuit,
-                    param_resolver,
-                    extensions or xmon_gate_ext)
-            if xmon_circuit.are_all_measurements_terminal():
-                measurements = self._run_sweep_sample(xmon_circuit, repetitions,
-                                                      qubit_order)
-            else:
-                measurements = self._run_sweep_repeat(keys, xmon_circuit,
-                                                      repetitions, qubit_order)
+        points = [
+        ]  # type: List[Tuple[_XmonCircuit, Tuple, Set[str], int, Any]]
+        for xmon_circuit, keys in self._to_xmon_circuits(
+                circuit, param_resolvers, extensions):
+            qubits = tuple(qubit_order.order_for(
+                xmon_circuit.all_qubits() | prefix.all_qubits()))
+            if qubits not in checkpoints:
+                checkpoints[qubits] = self._simulate_prefix(prefix, qubits)
+            points.append((xmon_circuit, qubits, keys, repetitions,
+                           checkpoints[qubits]))
+        all_measurements = self._map_sweep_points('_run_sweep_point', points)
+
+        trial_results = []  # type: List[TrialResult]
+        for param_resolver, measurements in zip(param_resolvers,
+                                                all_measurements):
             trial_results.append(TrialResult(
                 params=param_resolver,
                 repetitions=repetitions,
@@ -252,27 +392,157 @@ class XmonSimulator:
             ))
         return trial_results
 
-    def _run_sweep_repeat(self, keys, circuit, repetitions, qubit_order):
+    def _split_sweep_prefix(self,
+                            circuit: Union[Circuit, CompactCircuit],
+                            param_resolvers: List[ParamResolver],
+                            extensions: Extensions
+                            ) -> Tuple[Circuit, Union[Circuit, CompactCircuit]]:
+        """Splits off the moments that no sweep point changes.
+
+        Returns:
+            The xmon circuit of the moments before the first moment with a
+            parameterized operation, and the rest of the circuit. The prefix
+            is empty if there is only one sweep point, if it has
+            measurements, which would have to be sampled for every
+            repetition, or if the circuit is a compact circuit.
+        """
+        if len(param_resolvers) < 2 or isinstance(circuit, CompactCircuit):
+            return Circuit(), circuit
+        split = len(circuit)
+        for i, moment in enumerate(circuit.moments):
+            if any(ops.is_parameterized(op, extensions)
+                   for op in moment.operations):
+                split = i
+                break
+        if split == 0:
+            return Circuit(), circuit
+        prefix, keys = self._to_xmon_circuit(Circuit(circuit.moments[:split]),
+                                             ParamResolver({}),
+                                             extensions)
+        if keys:
+            return Circuit(), circuit
+        return cast(Circuit, prefix), Circuit(circuit.moments[split:])
+
+    def _simulate_prefix(self, prefix: Circuit,
+                         qubits: Tuple) -> Union[int, np.ndarray]:
+        """Returns the state after simulating the prefix of a sweep."""
+        if not prefix.moments:
+            return 0
+        step_result = None
+        for step_result in _simulator_iterator(
+                prefix,
+                self.options,
+                qubits,
+                initial_state=0,
+                stepper_cache=self._stepper_cache):
+            pass
+        return cast(XmonStepResult, step_result).state(copy=True)
+
+    def _run_sweep_point(self, circuit, qubit_order, keys, repetitions,
+                         initial_state):
+        if circuit.are_all_measurements_terminal():
+            return self._run_sweep_sample(circuit, repetitions, qubit_order,
+                                          initial_state)
+        return self._run_sweep_repeat(keys, circuit, repetitions, qubit_order,
+                                      initial_state)
+
+    def _run_sweep_repeat(self, keys, circuit, repetitions, qubit_order,
+                          initial_state):
+        """Runs a circuit with non-terminal measurements.
+
+        Rather than simulating every repetition separately, the repetitions
+        are simulated together as branches. At each moment with measurements
+        the results of all of the repetitions on the branch are sampled at
+        once, and the branch forks into one branch per distinct result. Each
+        branch is simulated once, weighted by the number of repetitions that
+        took it, so circuits that are deterministic after their measurements
+        cost little more than a single repetition.
+        """
+        qubits = ops.QubitOrder.as_qubit_order(qubit_order).order_for(
+            circuit.all_qubits())
+        qubit_map = {q: i for i, q in enumerate(reversed(qubits))}
+        stepper_map = _plan_stepper_map(circuit, qubit_map, self.options)
+        if isinstance(circuit, Circuit):
+            all_moment_ops = [_moment_ops(moment, stepper_map)
+                              for moment in circuit.moments]
+            start_position = 0  # type: Any
+
+            def moment_ops_from(position):
+                return enumerate(all_moment_ops[position:], position + 1)
+        else:
+            # The moments of a compact circuit are expanded again for each
+            # branch rather than kept.
+            start_position = (0, 0)
+
+            def moment_ops_from(position):
+                return ((end, _moment_ops(moment, stepper_map))
+                        for end, moment in circuit.moments_from(position))
         measurements = {
             k: [] for k in keys}  # type: Dict[str, List[np.ndarray]]
-        for _ in range(repetitions):
-            all_step_results = _simulator_iterator(
-                circuit,
-                self.options,
-                qubit_order,
-                initial_state=0)
-            for step_result in all_step_results:
-                for k, v in step_result.measurements.items():
-                    measurements[k].append(np.array(v, dtype=bool))
-        return measurements
-
-    def _run_sweep_sample(self, circuit, repetitions, qubit_order):
+
+        with self._stepper_cache.stepper(
+                len(qubits), self.options,
+                _permute_qubits(initial_state, qubit_map,
+                                stepper_map)) as stepper:
+            # Branches that remain to be simulated, as the position of the
+            # moment they start at, the state to start from (None for the
+            # initial state), the measurement results to project onto first,
+            # the number of repetitions on the branch, and the measurements
+            # so far.
+            branches = [(start_position, None, [], repetitions, {})
+                        ]  # type: List[Tuple[Any, Any, List, int, Dict]]
+            while branches:
+                start, state, projections, count, branch_measurements = (
+                    branches.pop())
+                if state is not None:
+                    stepper.reset_state(state)
+                for index, result in projections:
+                    stepper.project(index, result)
+                for end, (phase_map, w_ops, measured,
+                          matrix_ops) in moment_ops_from(start):
+                    stepper.simulate_moment(w_ops=w_ops, phase_map=phase_map,
+                                            matrix_ops=matrix_ops)
+                    if not measured:
+                        continue
+                    indices = [index for index, _, _ in measured]
+                    outcomes, counts = np.unique(
+                        stepper.sample_measurements(indices, count),
+                        axis=0,
+                        return_counts=True)
+                    if len(outcomes) > 1:
+                        state = stepper.current_state
+                        for outcome, outcome_count in zip(outcomes, counts):
+                            branches.append((
+                                end,
+                                state,
+                                list(zip(indices, outcome)),
+                                outcome_count,
+                                _with_measurements(branch_measurements,
+                                                   measured, outcome)))
+                        break
+                    for index, result in zip(indices, outcomes[0]):
+                        stepper.project(index, result)
+                    branch_measurements = _with_measurements(
+                        branch_measurements, measured, outcomes[0])
+                else:
+                    for k, v in branch_measurements.items():
+                        measurements[k].extend(
+                            [np.array(v, dtype=bool)] * count)
+
+        # Interleave the repetitions of different branches.
+        permutation = np.random.permutation(repetitions)
+        return {k: [v[i] for i in permutation]
+                for k, v in measurements.items()}
+
+    def _run_sweep_sample(self, circuit, repetitions, qubit_order,
+                          initial_state):
         all_step_results = _simulator_iterator(
             circuit,
             self.options,
             qubit_order,
-            initial_state=0,
-            perform_measurements=False)
+            initial_state=initial_state,
+            perform_measurements=False,
+            stepper_cache=self._stepper_cache)
         step_result = None
         for step_result in all_step_results:
             pass
@@ -301,7 +571,7 @@ class XmonSimulator:
                 basis state corresponding to this state.
                 Otherwise  if this is a np.ndarray it is the full initial
                 state. In this case it must be the correct size, be normalized
-                (an L2 norm of 1), and be safely castable to a np.complex64.
+                (an L2 norm of 1), and be safely castable to options.dtype.
             extensions: Extensions that will be applied while trying to
                 decompose the circuit's gates into XmonGates. If None, this
                 uses the default of xmon_gate_ext.
@@ -316,7 +586,7 @@ class XmonSimulator:
 
     def simulate_sweep(
         self,
-        program: Union[Circuit, Schedule],
+        program: Union[Circuit, CompactCircuit, Schedule],
         params: Sweepable = ParamResolver({}),
         qubit_order: ops.QubitOrderOrList = ops.QubitOrder.DEFAULT,
         initial_state: Union[int, np.ndarray] = 0,
@@ -325,7 +595,9 @@ class XmonSimulator:
         """Simulates the entire supplied Circuit.
 
         Args:
-            program: The circuit or schedule to simulate.
+            program: The circuit, compact circuit or schedule to simulate.
+                A compact circuit is converted to xmon gates and simulated
+                one moment at a time, see CompactCircuit.
             params: Parameters to run with the program.
             qubit_order: Determines the canonical ordering of the qubits used to
                 define the order of amplitudes in the wave function.
@@ -333,7 +605,7 @@ class XmonSimulator:
                 basis state corresponding to this state.
                 Otherwise if this is a np.ndarray it is the full initial state.
                 In this case it must be the correct size, be normalized (an L2
-                norm of 1), and be safely castable to a np.complex64.
+                norm of 1), and be safely castable to options.dtype.
             extensions: Extensions that will be applied while trying to
                 decompose the circuit's gates into XmonGates. If None, this
                 uses the default of xmon_gate_ext.
@@ -342,40 +614,97 @@ class XmonSimulator:
             List of XmonSimulatorTrialResults for this run, one for each
             possible parameter resolver.
         """
-        circuit = (
-            program if isinstance(program, Circuit) else program.to_circuit())
-        param_resolvers = self._to_resolvers(params or ParamResolver({}))
+        circuit = (program if isinstance(program, (Circuit, CompactCircuit))
+                   else program.to_circuit())
+        param_resolvers = to_resolvers(params or ParamResolver({}))
 
-        trial_results = []  # type: List[XmonSimulateTrialResult]
         qubit_order = ops.QubitOrder.as_qubit_order(qubit_order)
-        for param_resolver in param_resolvers:
-            xmon_circuit, _ = self._to_xmon_circuit(
-                circuit,
-                param_resolver,
-                extensions or xmon_gate_ext)
-            measurements = {}  # type: Dict[str, np.ndarray]
-            all_step_results = _simulator_iterator(
-                xmon_circuit,
-                self.options,
-                qubit_order,
-                initial_state)
-            step_result = None
-            for step_result in all_step_results:
-                for k, v in step_result.measurements.items():
-                    measurements[k] = np.array(v, dtype=bool)
-            if step_result:
-                final_state = step_result.state()
-            else:
-                # Empty circuit, so final state should be initial state.
-                num_qubits = len(qubit_order.order_for(circuit.all_qubits()))
-                final_state = xmon_stepper.decode_initial_state(initial_state,
-                                                                num_qubits)
+        points = []  # type: List[Tuple[_XmonCircuit, Tuple, Any]]
+        for xmon_circuit, _ in self._to_xmon_circuits(
+                circuit, param_resolvers, extensions or xmon_gate_ext):
+            # An empty circuit leaves the initial state on all of the qubits
+            # of the original circuit.
+            qubits = qubit_order.order_for(
+                circuit.all_qubits()
+                if isinstance(xmon_circuit, Circuit) and
+                not xmon_circuit.moments else xmon_circuit.all_qubits())
+            points.append((xmon_circuit, tuple(qubits), initial_state))
+        results = self._map_sweep_points('_simulate_sweep_point', points)
+
+        trial_results = []  # type: List[XmonSimulateTrialResult]
+        for param_resolver, (measurements, final_state) in zip(
+                param_resolvers, results):
             trial_results.append(XmonSimulateTrialResult(
                 params=param_resolver,
                 measurements=measurements,
                 final_state=final_state))
         return trial_results
 
+    def _simulate_sweep_point(self, circuit, qubit_order, initial_state):
+        measurements = {}  # type: Dict[str, np.ndarray]
+        all_step_results = _simulator_iterator(
+            circuit,
+            self.options,
+            qubit_order,
+            initial_state,
+            stepper_cache=self._stepper_cache)
+        step_result = None
+        for step_result in all_step_results:
+            for k, v in step_result.measurements.items():
+                measurements[k] = np.array(v, dtype=bool)
+        if step_result:
+            # The stepper is reused, so its state must be copied out.
+            final_state = step_result.state(copy=True)
+        else:
+            # Empty circuit, so final state should be initial state.
+            final_state = xmon_stepper.decode_initial_state(
+                _cast_initial_state(initial_state, self.options.dtype),
+                len(qubit_order), self.options.dtype)
+        return measurements, final_state
+
+    def _map_sweep_points(self, method_name: str,
+                          points: Sequence[Tuple]) -> List[Any]:
+        """Calls the named method on the arguments of each sweep point.
+
+        The points are spread over a process pool when the options allow it
+        and none of the circuits are large enough to be sharded. The first
+        argument of each point is its xmon circuit and the second its qubits.
+        """
+        num_processes = min(self.options.sweep_processes, len(points))
+        if num_processes <= 1 or any(
+                len(point[1]) >= self.options.min_qubits_before_shard
+                for point in points):
+            method = getattr(self, method_name)
+            return [method(*point) for point in points]
+
+        # Each worker simulates a contiguous chunk of the points with one
+        # simulator, so its cached stepper is reused across the chunk.
+        bounds = np.linspace(0, len(points), num_processes + 1).astype(int)
+        seeds = np.random.randint(2 ** 31, size=num_processes)
+        tasks = [(method_name, points[start:end], seed)
+                 for start, end, seed in zip(bounds[:-1], bounds[1:], seeds)]
+        if self._sweep_pool is None:
+            self._sweep_pool = multiprocessing.Pool(
+                self.options.sweep_processes,
+                initializer=_init_sweep_worker,
+                initargs=(self.options,))
+        return [result
+                for chunk_results in self._sweep_pool.map(
+                    _simulate_sweep_points_task, tasks)
+                for result in chunk_results]
+
+    def close(self) -> None:
+        """Shuts down the sweep process pool and frees the cached steppers.
+
+        The simulator can still be used afterwards, and then starts them
+        anew.
+        """
+        if self._sweep_pool is not None:
+            self._sweep_pool.close()
+            self._sweep_pool.join()
+            self._sweep_pool = None
+        self._stepper_cache.close()
+
     def simulate_moment_steps(
             self,
             program: Circuit,
@@ -395,7 +724,7 @@ class XmonSimulator:
                 basis state corresponding to this state.
                 Otherwise if this is a np.ndarray it is the full initial state.
                 In this case it must be the correct size, be normalized (an L2
-                norm of 1), and be safely castable to a np.complex64.
+                norm of 1), and be safely castable to options.dtype.
             param_resolver: A ParamResolver for determining values of
                 Symbols.
             extensions: Extensions that will be applied while trying to
@@ -415,32 +744,222 @@ class XmonSimulator:
                                    qubit_order,
                                    initial_state)
 
-    def _to_resolvers(self, sweepable: Sweepable) -> List[ParamResolver]:
-        if isinstance(sweepable, ParamResolver):
-            return [sweepable]
-        elif isinstance(sweepable, Sweep):
-            return list(sweepable)
-        elif isinstance(sweepable, collections.Iterable):
-            iterable = cast(collections.Iterable, sweepable)
-            return list(iterable) if isinstance(next(iter(iterable)),
-                                                ParamResolver) else sum(
-                [list(s) for s in iterable], [])
-        raise TypeError('Unexpected Sweepable type')
-
-    def _to_xmon_circuit(self, circuit: Circuit,
+    def expectation_values(
+            self,
+            program: Union[Circuit, CompactCircuit, Schedule],
+            observables: Sequence['PauliString'],
+            params: Sweepable = ParamResolver({}),
+            qubit_order: ops.QubitOrderOrList = ops.QubitOrder.DEFAULT,
+            extensions: Extensions = None
+    ) -> List[np.ndarray]:
+        """Computes the expectation values of Pauli observables exactly.
+
+        The expectation values are computed on the sharded final wave
+        function, so no measurements are sampled and the wave function is
+        not gathered. The initial state is the all zeros state in the
+        computational basis.
+
+        Args:
+            program: The circuit, compact circuit or schedule to simulate.
+                Measurements must all be terminal, and are ignored. A compact
+                circuit is converted to xmon gates and simulated one moment
+                at a time, see CompactCircuit.
+            observables: The PauliStrings to compute the expectation values
+                of. Qubits of the observables that are not in the circuit
+                are in the zero state.
+            params: Parameters to run with the program.
+            qubit_order: Determines the canonical ordering of the qubits used
+                to define the order of amplitudes in the wave function.
+            extensions: Extensions that will be applied while trying to
+                decompose the circuit's gates into XmonGates. If None, this
+                uses the default of xmon_gate_ext.
+
+        Returns:
+            A list with an array for each possible parameter resolver, holding
+            the expectation value of each of the observables, in order.
+
+        Raises:
+            ValueError if the circuit has measurements that are not terminal.
+        """
+        circuit = (program if isinstance(program, (Circuit, CompactCircuit))
+                   else program.to_circuit())
+        param_resolvers = to_resolvers(params or ParamResolver({}))
+        observables = list(observables)
+        observable_qubits = {q for observable in observables
+                             for q in observable.keys()}
+
+        qubit_order = ops.QubitOrder.as_qubit_order(qubit_order)
+        points = [
+        ]  # type: List[Tuple[_XmonCircuit, Tuple, List[PauliString]]]
+        for xmon_circuit, _ in self._to_xmon_circuits(
+                circuit, param_resolvers, extensions or xmon_gate_ext):
+            if not xmon_circuit.are_all_measurements_terminal():
+                raise ValueError('Expectation values require all of the '
+                                 'measurements to be terminal.')
+            qubits = qubit_order.order_for(
+                set(xmon_circuit.all_qubits()) | observable_qubits)
+            points.append((xmon_circuit, tuple(qubits), observables))
+        return self._map_sweep_points('_expectation_values_point', points)
+
+    def _expectation_values_point(self, circuit, qubit_order, observables):
+        qubit_map = {q: i for i, q in enumerate(reversed(qubit_order))}
+        stepper_map = _plan_stepper_map(circuit, qubit_map, self.options)
+        with self._stepper_cache.stepper(len(qubit_order), self.options,
+                                         0) as stepper:
+            for moment in circuit:
+                phase_map, w_ops, _, matrix_ops = _moment_ops(moment,
+                                                              stepper_map)
+                stepper.simulate_moment(w_ops=w_ops, phase_map=phase_map,
+                                        matrix_ops=matrix_ops)
+            return np.array([_pauli_expectation(stepper, observable,
+                                                stepper_map)
+                             for observable in observables])
+
+    def _to_xmon_circuit(self, circuit: Union[Circuit, CompactCircuit],
                          param_resolver: ParamResolver,
+                         extensions: Extensions = None
+                         ) -> Tuple[_XmonCircuit, Set[str]]:
+        """Converts the circuit to xmon gates with its parameters resolved.
+        """
+        return self._to_xmon_circuits(circuit, [param_resolver],
+                                      extensions)[0]
+
+    def _to_xmon_circuits(self, circuit: Union[Circuit, CompactCircuit],
+                          param_resolvers: Iterable[ParamResolver],
+                          extensions: Extensions = None
+                          ) -> List[Tuple[_XmonCircuit, Set[str]]]:
+        """Converts the circuit to xmon gates for each of the resolvers.
+
+        A compact circuit is converted gate by gate into a
+        _CompactXmonCircuit. A Circuit is compiled once with its parameters
+        unresolved, and the compiled circuit is cached by the structure of
+        the circuit, so that each sweep point and each later call with an
+        equal circuit only resolves the parameterized operations. Circuits
+        whose parameterized operations can only be converted once resolved
+        are converted anew for each resolver.
+
+        Returns:
+            The xmon circuit and its measurement keys for each resolver.
+        """
+        if isinstance(circuit, CompactCircuit):
+            xmon_circuits = [
+            ]  # type: List[Tuple[_XmonCircuit, Set[str]]]
+            for param_resolver in param_resolvers:
+                xmon_compact = self._to_compact_xmon_circuit(
+                    circuit, param_resolver, extensions)
+                xmon_circuits.append((xmon_compact, xmon_compact.keys))
+            return xmon_circuits
+        compiled = self._compile(circuit, extensions)
+        if compiled is not None:
+            return [(compiled.bind(param_resolver), compiled.keys)
+                    for param_resolver in param_resolvers]
+        return [self._convert_to_xmon(
+                    self._to_circuit_with_parameters_resolved(
+                        circuit, param_resolver, extensions or xmon_gate_ext),
+                    extensions)
+                for param_resolver in param_resolvers]
+
+    def _to_compact_xmon_circuit(self,
+                                 circuit: CompactCircuit,
+                                 param_resolver: ParamResolver,
+                                 extensions: Extensions = None
+                                 ) -> '_CompactXmonCircuit':
+        """Converts the gates of a compact circuit to xmon templates.
+
+        Raises:
+            ValueError: Two measurements of the circuit have the same key.
+        """
+        extensions = extensions or xmon_gate_ext
+        gates = [_resolve_gate(gate, param_resolver, extensions)
+                 for gate in circuit.gates]
+        uses = np.bincount(circuit.gate_ids, minlength=len(gates))
+        templates = {
+        }  # type: Dict[Tuple[int, int], List[List[Tuple[ops.Gate, Tuple]]]]
+        keys = set()  # type: Set[str]
+        for gate_id, num_qubits in sorted(_gate_arities(circuit)):
+            qubits = [ops.NamedQubit(str(i)) for i in range(num_qubits)]
+            positions = {
+                q: i for i, q in enumerate(qubits)
+            }  # type: Dict[raw_types.QubitId, int]
+            xmon_circuit, template_keys = self._convert_to_xmon(
+                Circuit([Moment([gates[gate_id].on(*qubits)])]), extensions)
+            for key in template_keys:
+                if key in keys or uses[gate_id] > 1:
+                    raise ValueError('Repeated Measurement key {}'.format(key))
+                keys.add(key)
+            templates[gate_id, num_qubits] = [
+                [(cast(ops.GateOperation, op).gate,
+                  tuple(positions[q] for q in op.qubits))
+                 for op in moment.operations]
+                for moment in xmon_circuit.moments]
+        return _CompactXmonCircuit(
+            CompactCircuit(circuit.qubits, gates, circuit.gate_ids,
+                           circuit.qubit_ids, circuit.qubit_offsets,
+                           circuit.moment_offsets),
+            templates, keys)
+
+    def _compile(self, circuit: Circuit,
+                 extensions: Extensions = None
+                 ) -> Optional['_CompiledCircuit']:
+        """Returns the cached compiled circuit, compiling it if needed.
+
+        Circuits with gates that cannot be hashed are compiled without being
+        cached.
+
+        Returns None if the circuit has parameterized operations that cannot
+        be converted to xmon gates before their parameters are resolved.
+        """
+        extensions = extensions or xmon_gate_ext
+        key = (tuple(circuit.moments), extensions, self.options.matrix_gates,
+               self.options.fusion_qubits)
+        try:
+            compiled = self._compiled_circuits.get(key, _NOT_COMPILED)
+        except TypeError:
+            return self._compile_uncached(circuit, extensions)
+        if compiled is not _NOT_COMPILED:
+            self._compiled_circuits.move_to_end(key)
+            return compiled
+        compiled = self._compile_uncached(circuit, extensions)
+        if len(self._compiled_circuits) >= _COMPILED_CIRCUIT_CACHE_SIZE:
+            self._compiled_circuits.popitem(last=False)
+        self._compiled_circuits[key] = compiled
+        return compiled
+
+    def _compile_uncached(self, circuit: Circuit,
+                          extensions: Extensions
+                          ) -> Optional['_CompiledCircuit']:
+        try:
+            xmon_circuit, keys = self._convert_to_xmon(
+                Circuit(circuit.moments), extensions)
+        except TypeError:
+            # Only unresolved parameters can be the cause of the failure
+            # that resolving them first gets around.
+            if any(ops.is_parameterized(op, extensions)
+                   for op in circuit.all_operations()):
+                return None
+            raise
+        return _CompiledCircuit(xmon_circuit, keys, extensions)
+
+    def _convert_to_xmon(self, circuit: Circuit,
                          extensions: Extensions = None
                          ) -> Tuple[Circuit, Set[str]]:
-        converter = ConvertToXmonGates(extensions)
+        """Converts the circuit to xmon gates in place.
+
+        Returns:
+            The converted circuit and its measurement keys.
+        """
+        converter = ConvertToXmonGates(
+            extensions, keep_matrix_gates=self.options.matrix_gates)
         extensions = converter.extensions
 
         # TODO: Use one optimization pass.
-        xmon_circuit = self._to_circuit_with_parameters_resolved(
-                circuit, param_resolver, extensions)
-        converter.optimize_circuit(xmon_circuit)
-        DropEmptyMoments().optimize_circuit(xmon_circuit)
-        keys = find_measurement_keys(xmon_circuit)
-        return xmon_circuit, keys
+        converter.optimize_circuit(circuit)
+        if self.options.fusion_qubits is not None:
+            FuseGates(self.options.fusion_qubits,
+                      extensions).optimize_circuit(circuit)
+        DropEmptyMoments().optimize_circuit(circuit)
+        keys = find_measurement_keys(circuit)
+        return circuit, keys
 
     def _to_circuit_with_parameters_resolved(
             self,
@@ -450,35 +969,230 @@ class XmonSimulator:
             ) -> Circuit:
         resolved_circuit = Circuit()
         for moment in circuit.moments:
-            resolved_circuit.append(_resolve_operations(
-                moment.operations,
-                param_resolver,
-                extensions))
+            resolved_circuit.append([
+                ops.resolve_operation(op, param_resolver, extensions)
+                for op in moment.operations])
         return resolved_circuit
 
 
-def _resolve_operations(
-        operations: Iterable[ops.Operation],
-        param_resolver: ParamResolver,
-        extensions) -> List[ops.Operation]:
-    resolved_operations = []  # type: List[ops.Operation]
-    for op in operations:
-        cast_op = extensions.try_cast(ops.ParameterizableEffect, op)
-        if cast_op is None:
-            resolved_op = op
+class _CompiledCircuit(object):
+    """An xmon circuit converted with its parameters left unresolved.
+
+    Attributes:
+        circuit: The xmon circuit, which may contain parameterized gates.
+        keys: The measurement keys of the circuit.
+    """
+
+    def __init__(self,
+                 circuit: Circuit,
+                 keys: Set[str],
+                 extensions: Extensions) -> None:
+        self.circuit = circuit
+        self.keys = keys
+        self._extensions = extensions
+        # The indices of the moments with parameterized operations.
+        self._parameterized_moments = [
+            i for i, moment in enumerate(circuit.moments)
+            if any(ops.is_parameterized(op, extensions)
+                   for op in moment.operations)]
+
+    def bind(self, param_resolver: ParamResolver) -> Circuit:
+        """Returns the circuit with its parameters resolved.
+
+        Only the moments with parameterized operations are rebuilt, the
+        others are shared with the compiled circuit.
+        """
+        moments = list(self.circuit.moments)
+        for i in self._parameterized_moments:
+            moments[i] = Moment(
+                ops.resolve_operation(op, param_resolver, self._extensions)
+                for op in moments[i].operations)
+        return Circuit(moments)
+
+
+class _CompactXmonCircuit(object):
+    """A compact circuit converted to xmon gates as it is iterated.
+
+    Each distinct gate of the compact circuit is converted once, for each
+    number of qubits it is applied to, into a template: the layers of xmon
+    operations it becomes, on the positions of its qubits. The xmon moments
+    of a moment of the compact circuit are its operations' template layers
+    merged, and are built from the templates only when they are iterated,
+    so the converted circuit is never held in memory. Gates are fused only
+    within their own template.
+
+    The methods mirror the parts of the Circuit interface that simulating a
+    sweep point uses.
+
+    Attributes:
+        circuit: The compact circuit, with the parameters of its gates
+            resolved.
+        keys: The measurement keys of the circuit.
+    """
+
+    def __init__(self,
+                 circuit: CompactCircuit,
+                 templates: Dict[Tuple[int, int],
+                                 List[List[Tuple[ops.Gate, Tuple]]]],
+                 keys: Set[str]) -> None:
+        self.circuit = circuit
+        self.keys = keys
+        self._templates = templates
+        self._measurement_ids = {
+            gate_id for (gate_id, _), template in templates.items()
+            if any(isinstance(gate, xmon_gates.XmonMeasurementGate)
+                   for layer in template for gate, _ in layer)}
+
+    def moments_from(self, position: Tuple[int, int] = (0, 0)
+                     ) -> Iterator[Tuple[Tuple[int, int], Moment]]:
+        """Yields the xmon moments after a position, with their end position.
+
+        A position is the index of a moment of the compact circuit and the
+        number of its xmon moments that come before the position.
+        """
+        start, start_layer = position
+        qubits = self.circuit.qubits
+        for m, moment_ids in enumerate(
+                self.circuit.iter_moment_indices(start), start):
+            layers = []  # type: List[List[ops.Operation]]
+            for gate_id, qubit_ids in moment_ids:
+                template = self._templates[gate_id, len(qubit_ids)]
+                layers.extend([] for _ in range(len(template) - len(layers)))
+                for layer, template_layer in zip(layers, template):
+                    layer.extend(
+                        ops.GateOperation(gate,
+                                          [qubits[qubit_ids[i]]
+                                           for i in positions])
+                        for gate, positions in template_layer)
+            for k in range(start_layer if m == start else 0, len(layers)):
+                yield (m, k + 1), Moment(layers[k])
+
+    def __iter__(self) -> Iterator[Moment]:
+        return (moment for _, moment in self.moments_from())
+
+    def all_operations(self) -> Iterator[ops.Operation]:
+        return (op for moment in self for op in moment.operations)
+
+    def findall_operations(self,
+                           predicate: Callable[[ops.Operation], bool]
+                           ) -> Iterator[Tuple[int, ops.Operation]]:
+        for index, moment in enumerate(self):
+            for op in moment.operations:
+                if predicate(op):
+                    yield index, op
+
+    def all_qubits(self) -> FrozenSet[raw_types.QubitId]:
+        return self.circuit.all_qubits()
+
+    def are_all_measurements_terminal(self) -> bool:
+        measured = set()  # type: Set[int]
+        for moment_ids in self.circuit.iter_moment_indices():
+            if any(measured.intersection(qubit_ids)
+                   for _, qubit_ids in moment_ids):
+                return False
+            for gate_id, qubit_ids in moment_ids:
+                if gate_id in self._measurement_ids:
+                    measured.update(qubit_ids)
+        return True
+
+
+# The simulator of a sweep process pool worker.
+_sweep_worker_simulator = None  # type: Optional[XmonSimulator]
+
+
+def _init_sweep_worker(options: XmonOptions) -> None:
+    """Creates the simulator of a sweep process pool worker."""
+    global _sweep_worker_simulator
+    _sweep_worker_simulator = XmonSimulator(options)
+
+
+def _simulate_sweep_points_task(args: Tuple[str, Sequence[Tuple], int]
+                                ) -> List[Any]:
+    """Simulates a chunk of sweep points inside of a sweep pool worker."""
+    method_name, points, seed = args
+    np.random.seed(seed)
+    method = getattr(_sweep_worker_simulator, method_name)
+    return [method(*point) for point in points]
+
+
+def _new_stepper(num_qubits: int,
+                 options: XmonOptions,
+                 initial_state: Union[int, np.ndarray]
+                 ) -> xmon_stepper.Stepper:
+    return xmon_stepper.Stepper(
+        num_qubits=num_qubits,
+        num_prefix_qubits=options.num_prefix_qubits,
+        initial_state=initial_state,
+        min_qubits_before_shard=options.min_qubits_before_shard,
+        use_processes=options.use_processes,
+        renorm_policy=options.renorm_policy,
+        dtype=options.dtype,
+        state_directory=options.state_directory,
+        low_memory=options.low_memory)
+
+
+class _StepperCache(object):
+    """Steppers kept alive between simulations for reuse.
+
+    Creating a stepper starts its pool and allocates its shared memory. A
+    cached stepper keeps both, and is reset to the new initial state when it
+    is reused. Steppers are keyed by their number of qubits and options.
+    """
+
+    def __init__(self) -> None:
+        self._steppers = {}  # type: Dict[Tuple, xmon_stepper.Stepper]
+
+    @contextlib.contextmanager
+    def stepper(self,
+                num_qubits: int,
+                options: XmonOptions,
+                initial_state: Union[int, np.ndarray]
+                ) -> Iterator[xmon_stepper.Stepper]:
+        """Takes a stepper from the cache, returning it once done.
+
+        While the stepper is in use it is not in the cache, so simulations
+        that are interleaved get different steppers.
+        """
+        key = (num_qubits, options.num_prefix_qubits,
+               options.min_qubits_before_shard, options.use_processes,
+               options.renorm_policy, options.dtype, options.state_directory,
+               options.low_memory)
+        stepper = self._steppers.pop(key, None)
+        if stepper is None:
+            stepper = _new_stepper(num_qubits, options, initial_state)
+            stepper.__enter__()
         else:
-            resolved_op = cast_op.with_parameters_resolved_by(
-                param_resolver)
-        resolved_operations.append(resolved_op)
-    return resolved_operations
+            stepper.reset_state(initial_state)
+        try:
+            yield stepper
+        finally:
+            if key in self._steppers:
+                stepper.close()
+            else:
+                self._steppers[key] = stepper
+
+    def close(self):
+        """Shuts down the pools and frees the memory of the cached steppers.
+        """
+        for stepper in self._steppers.values():
+            stepper.close()
+        self._steppers.clear()
+
+    def __del__(self):
+        # Dropping the steppers frees their memory from their own __del__,
+        # which does not wait for the lock of the memory manager.
+        for stepper in self._steppers.values():
+            stepper.close_pool()
+        self._steppers.clear()
 
 
 def _simulator_iterator(
-        circuit: Circuit,
+        circuit: _XmonCircuit,
         options: 'XmonOptions' = XmonOptions(),
         qubit_order: ops.QubitOrderOrList = ops.QubitOrder.DEFAULT,
         initial_state: Union[int, np.ndarray]=0,
         perform_measurements: bool=True,
+        stepper_cache: '_StepperCache' = None,
 ) -> Iterator['XmonStepResult']:
     """Iterator over XmonStepResult from Moments of a Circuit.
 
@@ -486,7 +1200,8 @@ def _simulator_iterator(
     XmonSimulator and use methods on that object to get an iterator.
 
     Args:
-        circuit: The circuit to simulate. Must contain only xmon gates with no
+        circuit: The circuit to simulate. Must contain only xmon gates,
+            1-qubit and 2-qubit matrix gates, and fused gates, with no
             unresolved parameters.
         options: XmonOptions configuring the simulation.
         qubit_order: Determines the canonical ordering of the qubits used to
@@ -498,10 +1213,14 @@ def _simulator_iterator(
 
             If this is a np.ndarray it is the full initial state.
             In this case it must be the correct size, be normalized (an L2
-            norm of 1), and be safely castable to a np.complex64.
+            norm of 1), and be safely castable to options.dtype.
         perform_measurements: Whether or not to perform the measurements in
             the circuit. Should only be set to False when optimizing for
             sampling over the measurements.
+        stepper_cache: If given, the stepper is taken from and returned to
+            this cache instead of being created and torn down for this
+            circuit. The step results must then not be used after the
+            iteration has finished and another simulation has started.
 
     Yields:
         XmonStepResults from simulating a Moment of the Circuit.
@@ -513,55 +1232,220 @@ def _simulator_iterator(
     qubits = ops.QubitOrder.as_qubit_order(qubit_order).order_for(
         circuit.all_qubits())
     qubit_map = {q: i for i, q in enumerate(reversed(qubits))}
-    if isinstance(initial_state, np.ndarray):
-        initial_state = initial_state.astype(dtype=np.complex64,
-                                             casting='safe')
-
-    with xmon_stepper.Stepper(
-            num_qubits=len(qubits),
-            num_prefix_qubits=options.num_prefix_qubits,
-            initial_state=initial_state,
-            min_qubits_before_shard=options.min_qubits_before_shard,
-            use_processes=options.use_processes
-    ) as stepper:
-        for moment in circuit.moments:
+    stepper_map = _plan_stepper_map(circuit, qubit_map, options)
+    initial_state = _cast_initial_state(initial_state, options.dtype)
+    initial_state = _permute_qubits(initial_state, qubit_map, stepper_map)
+
+    if stepper_cache is None:
+        stepper_context = _pool_context(
+            _new_stepper(len(qubits), options, initial_state)
+        )  # type: ContextManager[xmon_stepper.Stepper]
+    else:
+        stepper_context = stepper_cache.stepper(len(qubits), options,
+                                                initial_state)
+    with stepper_context as stepper:
+        for moment in circuit:
             measurements = collections.defaultdict(
                 list)  # type: Dict[str, List[bool]]
-            phase_map = {}  # type: Dict[Tuple[int, ...], float]
-            for op in moment.operations:
-                gate = op.gate
-                if isinstance(gate, xmon_gates.ExpZGate):
-                    index = qubit_map[op.qubits[0]]
-                    phase_map[(index,)] = cast(float, gate.half_turns)
-                elif isinstance(gate, xmon_gates.Exp11Gate):
-                    index0 = qubit_map[op.qubits[0]]
-                    index1 = qubit_map[op.qubits[1]]
-                    phase_map[(index0, index1)] = cast(float, gate.half_turns)
-                elif isinstance(gate, xmon_gates.ExpWGate):
-                    index = qubit_map[op.qubits[0]]
-                    stepper.simulate_w(
-                        index=index,
-                        half_turns=gate.half_turns,
-                        axis_half_turns=gate.axis_half_turns)
-                elif (isinstance(gate, xmon_gates.XmonMeasurementGate)):
-                    if perform_measurements:
-                        invert_mask = (
-                                gate.invert_mask or len(op.qubits) * (False,))
-                        for qubit, invert in zip(op.qubits, invert_mask):
-                            index = qubit_map[qubit]
-                            result = stepper.simulate_measurement(index)
-                            if invert:
-                                result = not result
-                            measurements[cast(str, gate.key)].append(result)
-                else:
-                    raise TypeError('{!r} is not supported by the '
-                                    'xmon simulator.'.format(gate))
-            stepper.simulate_phases(phase_map)
-            yield XmonStepResult(stepper, qubit_map, measurements)
+            phase_map, w_ops, measured, matrix_ops = _moment_ops(moment,
+                                                                 stepper_map)
+            if not perform_measurements:
+                measured = []
+            results = stepper.simulate_moment(
+                w_ops=w_ops,
+                phase_map=phase_map,
+                measurement_indices=[index for index, _, _ in measured],
+                matrix_ops=matrix_ops)
+            for (_, key, invert), result in zip(measured, results):
+                measurements[key].append(result != invert)
+            yield XmonStepResult(stepper, qubit_map, measurements,
+                                 stepper_map)
+
+
+@contextlib.contextmanager
+def _pool_context(stepper: xmon_stepper.Stepper
+                  ) -> Iterator[xmon_stepper.Stepper]:
+    """Shuts down the pool of the stepper on exit, keeping its memory.
+
+    Step results can still be used after the last step, so the memory of the
+    stepper is freed once they are deleted.
+    """
+    try:
+        yield stepper
+    finally:
+        stepper.close_pool()
+
+
+def _resolve_gate(gate: ops.Gate,
+                  param_resolver: ParamResolver,
+                  extensions: Extensions) -> ops.Gate:
+    """Returns the gate with its parameters resolved."""
+    parameterizable = extensions.try_cast(ops.ParameterizableEffect, gate)
+    if parameterizable is None:
+        return gate
+    return cast(ops.Gate,
+                parameterizable.with_parameters_resolved_by(param_resolver))
 
 
-def _sample_measurements(circuit: Circuit, step_result: 'XmonStepResult',
-    repetitions: int) -> Dict[str, List]:
+def _gate_arities(circuit: CompactCircuit) -> Set[Tuple[int, int]]:
+    """Returns the distinct gate indices and qubit counts of the operations.
+
+    The arrays of the circuit are read a bounded number of operations at a
+    time.
+    """
+    arities = set()  # type: Set[Tuple[int, int]]
+    num_ops = circuit.operation_count()
+    for start in range(0, num_ops, _OPERATIONS_PER_CHUNK):
+        end = min(start + _OPERATIONS_PER_CHUNK, num_ops)
+        num_qubits = np.diff(circuit.qubit_offsets[start:end + 1])
+        pairs = np.unique(
+            circuit.gate_ids[start:end].astype(np.int64) << 32 | num_qubits)
+        arities.update((int(pair >> 32), int(pair & 0xFFFFFFFF))
+                       for pair in pairs)
+    return arities
+
+
+def _cast_initial_state(initial_state: Union[int, np.ndarray],
+                        dtype: type) -> Union[int, np.ndarray]:
+    """Casts an initial wave function to the dtype of the simulation.
+
+    Raises:
+        ValueError: The initial state cannot be safely cast to the dtype.
+    """
+    if not isinstance(initial_state, np.ndarray):
+        return initial_state
+    if not np.can_cast(initial_state.dtype, dtype, casting='safe'):
+        raise ValueError(
+            'Initial state of dtype {} cannot be safely cast to {}.'.format(
+                initial_state.dtype, np.dtype(dtype)))
+    return initial_state.astype(dtype)
+
+
+# Gates that mix the amplitudes of the qubits they act on.
+_MIXING_GATE_TYPES = (xmon_gates.ExpWGate,
+                      ops.SingleQubitMatrixGate,
+                      ops.TwoQubitMatrixGate,
+                      FusedGate)
+
+
+def _plan_stepper_map(circuit: _XmonCircuit,
+                      qubit_map: Dict[raw_types.QubitId, int],
+                      options: XmonOptions) -> Dict[raw_types.QubitId, int]:
+    """Returns the index of each qubit in the stepper's wave function.
+
+    This is the qubit_map, unless options.plan_shard_qubits is set and the
+    wave function will be sharded. In that case the prefix indices, which the
+    wave function is sharded over, go to the qubits with the fewest W gates
+    and matrix gates.
+    Ties are broken in favor of the qubit_map, and the qubits keep their
+    relative order within the shard and the prefix indices.
+    """
+    num_qubits = len(qubit_map)
+    num_prefix_qubits = xmon_stepper.choose_num_prefix_qubits(
+        num_qubits, options.num_prefix_qubits,
+        options.min_qubits_before_shard)
+    if not options.plan_shard_qubits or num_prefix_qubits == 0:
+        return qubit_map
+
+    w_counts = collections.Counter(
+        q for _, op in circuit.findall_operations(
+            lambda op: isinstance(op.gate, _MIXING_GATE_TYPES))
+        for q in op.qubits)
+    by_index = sorted(qubit_map, key=lambda q: qubit_map[q])
+    prefix_qubits = set(sorted(
+        by_index, key=lambda q: (w_counts[q], -qubit_map[q]))[
+        :num_prefix_qubits])
+    ordered = ([q for q in by_index if q not in prefix_qubits] +
+               [q for q in by_index if q in prefix_qubits])
+    return {q: i for i, q in enumerate(ordered)}
+
+
+def _permute_qubits(state: Union[int, np.ndarray],
+                    from_map: Dict[raw_types.QubitId, int],
+                    to_map: Dict[raw_types.QubitId, int]
+                    ) -> Union[int, np.ndarray]:
+    """Moves each qubit of a state from its index in one map to the other.
+
+    Ints are treated as computational basis states. States that are not
+    valid are returned as they are, for the stepper to reject.
+    """
+    if from_map == to_map:
+        return state
+    num_qubits = len(from_map)
+    if isinstance(state, int):
+        xmon_stepper.check_basis_state(state, num_qubits)
+        return sum(((state >> from_map[q]) & 1) << to_map[q]
+                   for q in from_map)
+    if not isinstance(state, np.ndarray) or state.size != 1 << num_qubits:
+        return state
+    # Tensor axis order is the reverse of index order.
+    axes = [0] * num_qubits
+    for q, index in to_map.items():
+        axes[num_qubits - 1 - index] = num_qubits - 1 - from_map[q]
+    return np.transpose(np.reshape(state, [2] * num_qubits),
+                        axes).reshape(-1)
+
+
+def _moment_ops(moment: Moment, qubit_map: Dict[raw_types.QubitId, int]
+                ) -> Tuple[Dict[Tuple[int, ...], float],
+                           List[Tuple[int, float, float]],
+                           List[Tuple[int, str, bool]],
+                           List[Tuple[Tuple[int, ...], np.ndarray]]]:
+    """Translates the xmon operations of a moment into stepper arguments.
+
+    Returns:
+        A tuple of the phase map, the W operations as tuples of the qubit
+        index, half turns, and axis half turns, the measured qubit indices
+        along with their measurement key and inversion, and the matrix
+        operations as tuples of the qubit indices and the matrix.
+    """
+    phase_map = {}  # type: Dict[Tuple[int, ...], float]
+    w_ops = []  # type: List[Tuple[int, float, float]]
+    measured = []  # type: List[Tuple[int, str, bool]]
+    matrix_ops = []  # type: List[Tuple[Tuple[int, ...], np.ndarray]]
+    for op in moment.operations:
+        gate = op.gate
+        if isinstance(gate, xmon_gates.ExpZGate):
+            index = qubit_map[op.qubits[0]]
+            phase_map[(index,)] = cast(float, gate.half_turns)
+        elif isinstance(gate, xmon_gates.Exp11Gate):
+            index0 = qubit_map[op.qubits[0]]
+            index1 = qubit_map[op.qubits[1]]
+            phase_map[(index0, index1)] = cast(float, gate.half_turns)
+        elif isinstance(gate, xmon_gates.ExpWGate):
+            index = qubit_map[op.qubits[0]]
+            w_ops.append((index,
+                          cast(float, gate.half_turns),
+                          cast(float, gate.axis_half_turns)))
+        elif (isinstance(gate, xmon_gates.XmonMeasurementGate)):
+            invert_mask = gate.invert_mask or len(op.qubits) * (False,)
+            for qubit, invert in zip(op.qubits, invert_mask):
+                measured.append((qubit_map[qubit],
+                                 cast(str, gate.key),
+                                 invert))
+        elif isinstance(gate, (ops.SingleQubitMatrixGate,
+                               ops.TwoQubitMatrixGate,
+                               FusedGate)):
+            matrix_ops.append((tuple(qubit_map[q] for q in op.qubits),
+                               gate.matrix()))
+        else:
+            raise TypeError('{!r} is not supported by the '
+                            'xmon simulator.'.format(gate))
+    return phase_map, w_ops, measured, matrix_ops
+
+
+def _with_measurements(measurements: Dict[str, List[bool]],
+                       measured: List[Tuple[int, str, bool]],
+                       results: Iterable[bool]) -> Dict[str, List[bool]]:
+    """Returns a copy of measurements extended by the given results."""
+    new_measurements = {k: list(v) for k, v in measurements.items()}
+    for (_, key, invert), result in zip(measured, results):
+        new_measurements.setdefault(key, []).append(bool(result) != invert)
+    return new_measurements
+
+
+def _sample_measurements(circuit: _XmonCircuit, step_result: 'XmonStepResult',
+    repetitions: int) -> Dict[str, np.ndarray]:
     """Sample from measurements in the given circuit.
 
     This should only be called if the circuit has only terminal measurements.
@@ -575,9 +1459,8 @@ def _sample_measurements(circuit: Circuit, step_result: 'XmonStepResult',
 
     Returns:
         A dictionary from the measurement keys to the measurement results.
-        These results are lists of lists, with the outer list corresponding to
-        the repetition, and the inner list corresponding to the qubits as
-        ordered in the measurement gate.
+        These results are bool arrays, with a row for each repetition and a
+        column for each qubit as ordered in the measurement gate.
     """
     if step_result is None:
         return {}
@@ -586,12 +1469,21 @@ def _sample_measurements(circuit: Circuit, step_result: 'XmonStepResult',
     all_qubits = []  # type: List[raw_types.QubitId]
     current_index = 0
     for _, op in circuit.findall_operations(is_meas):
-        key = cast(str, op.gate.key)
+        key = cast(xmon_gates.XmonMeasurementGate, op.gate).key
         bounds[key] = (current_index, current_index + len(op.qubits))
         all_qubits.extend(op.qubits)
         current_index += len(op.qubits)
     sample = step_result.sample(all_qubits, repetitions)
-    return {k: [x[s:e] for x in sample] for k,(s, e) in bounds.items()}
+    return {k: sample[:, s:e] for k, (s, e) in bounds.items()}
+
+
+def _pauli_expectation(stepper: xmon_stepper.Stepper,
+                       observable: 'PauliString',
+                       qubit_map: Dict[raw_types.QubitId, int]) -> float:
+    """Returns the expectation value of a PauliString on a stepper's state."""
+    value = stepper.pauli_expectation(
+        {qubit_map[q]: str(pauli) for q, pauli in observable.items()})
+    return -value if observable.negated else value
 
 
 def find_measurement_keys(circuit: Circuit) -> Set[str]:
@@ -615,18 +1507,24 @@ class XmonStepResult:
             used to define the state (see the state() method).
         measurements: A dictionary from measurement gate key to measurement
             results, ordered by the qubits that the measurement operates on.
+        drift_count: The number of gates applied since the wave function was
+            last renormalized, as of this step. See XmonOptions.renorm_policy.
     """
 
     def __init__(
             self,
             stepper: xmon_stepper.Stepper,
             qubit_map: Dict,
-            measurements: Dict[str, List[bool]]) -> None:
+            measurements: Dict[str, List[bool]],
+            stepper_map: Dict = None) -> None:
         self.qubit_map = qubit_map or {}
         self.measurements = measurements or collections.defaultdict(list)
+        self.drift_count = stepper.drift_count
         self._stepper = stepper
+        # The index of each qubit in the stepper, if reordered from qubit_map.
+        self._stepper_map = stepper_map or self.qubit_map
 
-    def state(self) -> np.ndarray:
+    def state(self, copy: bool = True) -> np.ndarray:
         """Return the state (wave function) at this point in the computation.
 
         The state is returned in the computational basis with these basis
@@ -651,8 +1549,22 @@ class XmonStepResult:
                | 6 |   1    |   1    |   0    |
                | 7 |   1    |   1    |   1    |
                +---+--------+--------+--------+
+
+        Args:
+            copy: If True (the default), a copy of the wave function is
+                returned. If False, a read-only view of the simulator's wave
+                function is returned without copying it. The view is only
+                valid until the simulation advances to the next step. If the
+                qubits were reordered by XmonOptions.plan_shard_qubits, a
+                reordered copy is always returned.
+
+        Returns:
+            The wave function as a numpy array.
         """
-        return self._stepper.current_state
+        if self._stepper_map != self.qubit_map:
+            return _permute_qubits(self._stepper.get_state(copy=False),
+                                   self._stepper_map, self.qubit_map)
+        return self._stepper.get_state(copy=copy)
 
     def set_state(self, state: Union[int, np.ndarray]):
         """Updates the state of the simulator to the given new state.
@@ -661,25 +1573,35 @@ class XmonStepResult:
             state: If this is an int, then this is the state to reset
             the stepper to, expressed as an integer of the computational basis.
             Integer to bitwise indices is little endian. Otherwise if this is
-            a np.ndarray this must be the correct size and have dtype of
-            np.complex64.
+            a np.ndarray this must be the correct size and have the dtype
+            of the simulator's XmonOptions.
 
         Raises:
             ValueError if the state is incorrectly sized or not of the correct
             dtype.
         """
-        self._stepper.reset_state(state)
+        self._stepper.reset_state(
+            _permute_qubits(state, self.qubit_map, self._stepper_map))
 
-    def sample(self, qubits: List[raw_types.QubitId], repetitions: int=1):
+    def sample(self, qubits: List[raw_types.QubitId],
+               repetitions: int=1) -> np.ndarray:
         """Samples from the wave function at this point in the computation.
 
         Note that this does not collapse the wave function.
 
         Returns:
-            Measurement results with True corresponding to the |1> state.
-            The outer list is for repetitions, and the inner corresponds to
-            measurements ordered by the supplied qubits.
+            Measurement results with True corresponding to the |1> state, as
+            a bool array with a row for each repetition and a column for
+            each of the supplied qubits, in order.
         """
         return self._stepper.sample_measurements(
-            indices=[self.qubit_map[q] for q in qubits],
+            indices=[self._stepper_map[q] for q in qubits],
             repetitions=repetitions)
+
+    def expectation_value(self, observable: 'PauliString') -> float:
+        """Returns the expectation value of a PauliString at this point.
+
+        The qubits of the observable must be in the qubit_map.
+        """
+        return _pauli_expectation(self._stepper, observable,
+                                  self._stepper_map)
@@ -24,6 +24,8 @@ import pytest
 
 import cirq
 import cirq.google as cg
+from cirq.contrib.paulistring import Pauli, PauliString
+from cirq.google.sim import xmon_simulator
 
 Q1 = cirq.GridQubit(0, 0)
 Q2 = cirq.GridQubit(1, 0)
@@ -67,6 +69,16 @@ def test_xmon_options_negative_min_qubits_before_shard():
         cg.XmonOptions(min_qubits_before_shard=-1)
 
 
+def test_xmon_options_unsupported_dtype():
+    with pytest.raises(AssertionError):
+        cg.XmonOptions(dtype=np.float64)
+
+
+def test_xmon_options_sweep_processes():
+    with pytest.raises(AssertionError):
+        cg.XmonOptions(sweep_processes=0)
+
+
 def test_xmon_options():
     options = cg.XmonOptions(num_shards=3,
                              min_qubits_before_shard=0)
@@ -453,6 +465,26 @@ def test_simulate_moment_steps_state():
                                              [0.5j, 0.5, -0.5, -0.5j]]))
 
 
+def test_simulate_moment_steps_state_view():
+    circuit = basic_circuit()
+    simulator = cg.XmonSimulator()
+    steps = simulator.simulate_moment_steps(circuit)
+    step = next(steps)
+    view = step.state(copy=False)
+    copy = step.state()
+    assert not view.flags.writeable
+    with pytest.raises(ValueError):
+        view[0] = 1
+    assert np.shares_memory(view, step.state(copy=False))
+    assert not np.shares_memory(view, copy)
+    np.testing.assert_almost_equal(view, [0.5, 0.5j, 0.5j, -0.5])
+
+    # The view follows the simulation, the copy does not.
+    next(steps)
+    np.testing.assert_almost_equal(view, [0.5, 0.5j, 0.5j, 0.5])
+    np.testing.assert_almost_equal(copy, [0.5, 0.5j, 0.5j, -0.5])
+
+
 def test_simulate_moment_steps_set_state():
     np.random.seed(0)
     circuit = basic_circuit()
@@ -486,13 +518,170 @@ def test_simulate_moment_steps_sample():
     simulator = cg.XmonSimulator()
     for step in simulator.simulate_moment_steps(circuit, qubit_order=[Q1, Q2]):
         pass
-    assert [[True]] == step.sample([Q1])
-    assert [[True, False]] == step.sample([Q1, Q2])
-    assert [[False]] == step.sample([Q2])
+    np.testing.assert_equal(step.sample([Q1]), [[True]])
+    np.testing.assert_equal(step.sample([Q1, Q2]), [[True, False]])
+    np.testing.assert_equal(step.sample([Q2]), [[False]])
 
-    assert [[True]] * 3 == step.sample([Q1], 3)
-    assert [[True, False]] * 3 == step.sample([Q1, Q2], 3)
-    assert [[False]] * 3 == step.sample([Q2], 3)
+    np.testing.assert_equal(step.sample([Q1], 3), [[True]] * 3)
+    np.testing.assert_equal(step.sample([Q1, Q2], 3), [[True, False]] * 3)
+    np.testing.assert_equal(step.sample([Q2], 3), [[False]] * 3)
+
+
+def test_simulate_moment_steps_drift_count():
+    circuit = basic_circuit()
+    simulator = cg.XmonSimulator()
+    assert [step.drift_count for step in
+            simulator.simulate_moment_steps(circuit)] == [0, 0, 0, 0]
+
+    options = cg.XmonOptions(renorm_policy=cg.RenormPolicy(period=2))
+    assert [step.drift_count for step in
+            simulator.simulate_moment_steps(circuit, options)] == [2, 0, 2, 0]
+
+
+@pytest.mark.parametrize('renorm_policy', (cg.RenormPolicy.NEVER,
+                                           cg.RenormPolicy.BEFORE_MEASUREMENT,
+                                           cg.RenormPolicy(tolerance=1e-6)))
+def test_renorm_policy_results(renorm_policy):
+    # Drop the terminal measurement, so the final states are deterministic.
+    circuit = large_circuit()[:-1]
+    expected = cg.XmonSimulator().simulate(circuit).final_state
+    simulator = cg.XmonSimulator(cg.XmonOptions(renorm_policy=renorm_policy))
+    result = simulator.simulate(circuit).final_state
+    np.testing.assert_almost_equal(result, expected, decimal=5)
+
+
+def test_simulate_state_directory(tmpdir):
+    circuit = large_circuit()[:-1]
+    expected = cg.XmonSimulator().simulate(circuit).final_state
+    simulator = cg.XmonSimulator(cg.XmonOptions(
+        num_shards=4, min_qubits_before_shard=0,
+        state_directory=str(tmpdir)))
+    result = simulator.simulate(circuit).final_state
+    np.testing.assert_almost_equal(result, expected, decimal=5)
+    assert tmpdir.listdir()
+
+
+def test_simulate_low_memory():
+    circuit = large_circuit()[:-1]
+    expected = cg.XmonSimulator().simulate(circuit).final_state
+    simulator = cg.XmonSimulator(cg.XmonOptions(
+        num_shards=4, min_qubits_before_shard=0, low_memory=True))
+    result = simulator.simulate(circuit).final_state
+    np.testing.assert_almost_equal(result, expected, decimal=5)
+
+
+@pytest.mark.parametrize('fusion_qubits', (1, 2, 4))
+def test_simulate_fusion_qubits(fusion_qubits):
+    circuit = large_circuit()[:-1]
+    expected = cg.XmonSimulator().simulate(circuit).final_state
+    for num_shards in (None, 4):
+        simulator = cg.XmonSimulator(cg.XmonOptions(
+            num_shards=num_shards, min_qubits_before_shard=0,
+            fusion_qubits=fusion_qubits))
+        result = simulator.simulate(circuit).final_state
+        # Fused blocks use the matrices of the gates, whose global phases
+        # differ from those of the xmon gates.
+        cirq.testing.assert_allclose_up_to_global_phase(result, expected,
+                                                        atol=1e-5)
+
+
+def test_run_fusion_qubits():
+    circuit = cirq.Circuit.from_ops(
+        cirq.X(Q1), cirq.CNOT(Q1, Q2), cirq.measure(Q1, key='a'),
+        cirq.H(Q1), cirq.H(Q1), cirq.measure(Q1, Q2, key='b'))
+    simulator = cg.XmonSimulator(cg.XmonOptions(fusion_qubits=2))
+    result = simulator.run(circuit, repetitions=3)
+    np.testing.assert_equal(result.measurements['a'], [[True]] * 3)
+    np.testing.assert_equal(result.measurements['b'], [[True, True]] * 3)
+
+
+@pytest.mark.parametrize('num_shards', (None, 4))
+def test_expectation_values(num_shards):
+    circuit = large_circuit()
+    qubits = sorted(circuit.all_qubits())
+    final_state = cg.XmonSimulator(cg.XmonOptions(
+        dtype=np.complex128)).simulate(circuit[:-1]).final_state
+    observables = [
+        PauliString({qubits[0]: Pauli.Z}),
+        PauliString({qubits[1]: Pauli.X, qubits[3]: Pauli.Y}),
+        PauliString({q: Pauli.Y for q in qubits[:5]}, negated=True),
+        PauliString({}),
+    ]
+    simulator = cg.XmonSimulator(cg.XmonOptions(
+        num_shards=num_shards, min_qubits_before_shard=0,
+        dtype=np.complex128))
+    result, = simulator.expectation_values(circuit, observables)
+    assert len(result) == 4
+    for observable, value in zip(observables, result):
+        op_circuits = [cirq.Circuit.from_ops(
+            {Pauli.X: cirq.X, Pauli.Y: cirq.Y, Pauli.Z: cirq.Z}[pauli](q))
+            for q, pauli in observable.items()]
+        state = final_state
+        for op_circuit in op_circuits:
+            state = op_circuit.to_unitary_matrix(
+                qubit_order=qubits,
+                qubits_that_should_be_present=qubits).dot(state)
+        expected = np.real(np.vdot(final_state, state))
+        if observable.negated:
+            expected = -expected
+        np.testing.assert_almost_equal(value, expected)
+
+
+def test_expectation_values_sweep():
+    circuit = cirq.Circuit.from_ops(
+        cirq.RotXGate(half_turns=cirq.Symbol('t')).on(Q1))
+    observables = [PauliString({Q1: Pauli.Z}), PauliString({Q2: Pauli.Z}),
+                   PauliString({Q2: Pauli.X})]
+    results = cg.XmonSimulator().expectation_values(
+        circuit, observables, cirq.Points('t', [0, 0.5, 1]))
+    np.testing.assert_almost_equal(results, [[1, 1, 0],
+                                             [0, 1, 0],
+                                             [-1, 1, 0]], decimal=5)
+
+
+def test_expectation_values_non_terminal_measurement():
+    circuit = cirq.Circuit.from_ops(cirq.measure(Q1), cirq.X(Q1))
+    with pytest.raises(ValueError, match='terminal'):
+        cg.XmonSimulator().expectation_values(
+            circuit, [PauliString({Q1: Pauli.Z})])
+
+
+def test_step_result_expectation_value():
+    circuit = cirq.Circuit.from_ops(cirq.X(Q1), cirq.H(Q2))
+    simulator = cg.XmonSimulator()
+    step = None
+    for step in simulator.simulate_moment_steps(circuit):
+        pass
+    np.testing.assert_almost_equal(
+        step.expectation_value(PauliString({Q1: Pauli.Z, Q2: Pauli.X})),
+        -1, decimal=5)
+
+
+def test_simulate_complex128():
+    circuit = large_circuit()[:-1]
+    expected = cg.XmonSimulator().simulate(circuit).final_state
+    simulator = cg.XmonSimulator(cg.XmonOptions(dtype=np.complex128))
+    result = simulator.simulate(circuit).final_state
+    assert result.dtype == np.complex128
+    np.testing.assert_almost_equal(result, expected, decimal=5)
+
+    # Initial states are safely cast to the simulator's dtype.
+    circuit = cirq.Circuit.from_ops(cg.ExpWGate()(Q1))
+    result = simulator.simulate(
+        circuit, initial_state=np.array([0, 1], dtype=np.complex64))
+    assert result.final_state.dtype == np.complex128
+    np.testing.assert_almost_equal(result.final_state, [-1j, 0])
+    result = simulator.simulate(cirq.Circuit(), initial_state=0)
+    assert result.final_state.dtype == np.complex128
+    with pytest.raises(ValueError, match='cast'):
+        cg.XmonSimulator().simulate(
+            circuit, initial_state=np.array([0, 1], dtype=np.complex128))
+    with pytest.raises(ValueError, match='cast'):
+        cg.XmonSimulator().simulate(
+            cirq.Circuit(), initial_state=np.array([1], dtype=np.complex128))
+    result = cg.XmonSimulator().simulate(
+        cirq.Circuit(), initial_state=np.array([1], dtype=np.float32))
+    assert result.final_state.dtype == np.complex64
 
 
 def compute_gate(circuit, resolver, num_qubits=1):
@@ -615,6 +804,527 @@ def test_run_circuit_sweeps():
         np.testing.assert_equal(result.measurements['m'], [[i % 2 != 0]])
 
 
+def test_run_circuit_sweep_processes():
+    circuit = cirq.Circuit.from_ops(
+        cg.ExpWGate(half_turns=cirq.Symbol('a')).on(Q1),
+        cg.XmonMeasurementGate('m').on(Q1),
+        # A non-terminal measurement, so each repetition is simulated.
+        cg.ExpWGate(half_turns=0.5).on(Q2),
+        cg.XmonMeasurementGate('n').on(Q2),
+        cg.ExpWGate(half_turns=cirq.Symbol('a')).on(Q2),
+    )
+
+    sweep = cirq.Linspace('a', 0, 10, 11)
+    simulator = cg.XmonSimulator(cg.XmonOptions(sweep_processes=2))
+
+    np.random.seed(1234)
+    results = simulator.run_sweep(circuit, sweep, repetitions=10)
+    for i, result in enumerate(results):
+        assert result.params['a'] == i
+        np.testing.assert_equal(result.measurements['m'], [[i % 2 != 0]] * 10)
+
+    # Seeding np.random reproduces the same samples.
+    np.random.seed(1234)
+    again = simulator.run_sweep(circuit, sweep, repetitions=10)
+    for result, result_again in zip(results, again):
+        np.testing.assert_equal(result.measurements['n'],
+                                result_again.measurements['n'])
+
+
+def test_simulate_sweep_processes():
+    circuit = large_circuit()[:-1]
+    circuit.append(cg.ExpWGate(half_turns=cirq.Symbol('a')).on(Q1))
+    sweep = cirq.Linspace('a', 0, 1, 4)
+    expected = cg.XmonSimulator().simulate_sweep(circuit, sweep)
+    results = cg.XmonSimulator(
+        cg.XmonOptions(sweep_processes=2)).simulate_sweep(circuit, sweep)
+    assert len(results) == 4
+    for result, expected_result in zip(results, expected):
+        assert result.params.param_dict == expected_result.params.param_dict
+        np.testing.assert_almost_equal(result.final_state,
+                                       expected_result.final_state)
+
+    empty = cg.XmonSimulator(
+        cg.XmonOptions(sweep_processes=2)).simulate_sweep(
+            cirq.Circuit(), [cirq.ParamResolver({})] * 2, initial_state=0)
+    np.testing.assert_almost_equal(empty[1].final_state, [1])
+
+
+def test_sweep_pool_reused_and_chunked(monkeypatch):
+    pools = []
+
+    class InProcessPool(object):
+        def __init__(self, processes, initializer, initargs):
+            self.processes = processes
+            self.tasks = []
+            self.closed = False
+            pools.append(self)
+            initializer(*initargs)
+
+        def map(self, func, tasks):
+            self.tasks.append(tasks)
+            return [func(task) for task in tasks]
+
+        def close(self):
+            self.closed = True
+
+        def join(self):
+            assert self.closed
+
+    new_steppers = []
+    new_stepper = xmon_simulator._new_stepper
+
+    def counting_new_stepper(num_qubits, options, initial_state):
+        new_steppers.append(num_qubits)
+        return new_stepper(num_qubits, options, initial_state)
+
+    monkeypatch.setattr('multiprocessing.Pool', InProcessPool)
+    monkeypatch.setattr(xmon_simulator, '_new_stepper', counting_new_stepper)
+    monkeypatch.setattr(xmon_simulator, '_sweep_worker_simulator', None)
+    circuit = cirq.Circuit.from_ops(
+        cg.ExpWGate(half_turns=cirq.Symbol('a')).on(Q1),
+        cg.XmonMeasurementGate('m').on(Q1))
+    simulator = cg.XmonSimulator(cg.XmonOptions(sweep_processes=2))
+    for _ in range(2):
+        results = simulator.run_sweep(circuit, cirq.Linspace('a', 0, 5, 6))
+        for i, result in enumerate(results):
+            np.testing.assert_equal(result.measurements['m'], [[i % 2 != 0]])
+
+    # One pool serves both sweeps, with a chunk of points per process, and
+    # the one worker simulator reuses its stepper for all of them.
+    assert len(pools) == 1
+    assert pools[0].processes == 2
+    assert [[len(points) for _, points, _ in tasks]
+            for tasks in pools[0].tasks] == [[3, 3], [3, 3]]
+    assert new_steppers == [1]
+
+    simulator.close()
+    assert pools[0].closed
+    simulator.run_sweep(circuit, cirq.Linspace('a', 0, 1, 2))
+    assert len(pools) == 2
+    simulator.close()
+
+
+def test_run_sweep_sharded_circuit_not_in_sweep_processes(monkeypatch):
+    def no_pool(*args):
+        raise AssertionError('Sharded circuits must not use the sweep pool.')
+    monkeypatch.setattr('multiprocessing.Pool', no_pool)
+
+    circuit = cirq.Circuit.from_ops(
+        cg.ExpWGate(half_turns=cirq.Symbol('a')).on(Q1),
+        cg.ExpWGate(half_turns=cirq.Symbol('a')).on(Q2),
+        cg.XmonMeasurementGate('m').on(Q1, Q2),
+    )
+    simulator = cg.XmonSimulator(cg.XmonOptions(sweep_processes=2,
+                                                min_qubits_before_shard=2))
+    results = simulator.run_sweep(circuit, cirq.Points('a', [0, 1]))
+    np.testing.assert_equal([r.measurements['m'] for r in results],
+                            [[[False, False]], [[True, True]]])
+
+
+def test_stepper_reused_across_repetitions(monkeypatch):
+    new_steppers = []
+    new_stepper = xmon_simulator._new_stepper
+
+    def counting_new_stepper(num_qubits, options, initial_state):
+        new_steppers.append((num_qubits, options, initial_state))
+        return new_stepper(num_qubits, options, initial_state)
+
+    monkeypatch.setattr(xmon_simulator, '_new_stepper', counting_new_stepper)
+    circuit = cirq.Circuit.from_ops(
+        cg.ExpWGate().on(Q1),
+        cg.XmonMeasurementGate('a').on(Q1),
+        cg.ExpWGate().on(Q1),
+        cg.XmonMeasurementGate('b').on(Q1),
+    )
+    simulator = cg.XmonSimulator()
+    result = simulator.run(circuit, repetitions=5)
+    np.testing.assert_equal(result.measurements['a'], [[True]] * 5)
+    np.testing.assert_equal(result.measurements['b'], [[False]] * 5)
+    result = simulator.simulate(circuit)
+    np.testing.assert_almost_equal(result.final_state, [-1, 0])
+    assert len(new_steppers) == 1
+
+    # A different number of qubits or options needs a new stepper.
+    simulator.run(circuit.from_ops(cg.ExpWGate().on(Q1),
+                                   cg.ExpWGate().on(Q2)))
+    simulator.options = cg.XmonOptions(dtype=np.complex128)
+    simulator.run(circuit)
+    assert len(new_steppers) == 3
+
+
+def test_run_branches_on_non_terminal_measurements(monkeypatch):
+    moments = []
+    simulate_moment = cg.sim.xmon_stepper.Stepper.simulate_moment
+
+    def counting_simulate_moment(self, *args, **kwargs):
+        moments.append(args)
+        return simulate_moment(self, *args, **kwargs)
+
+    monkeypatch.setattr(cg.sim.xmon_stepper.Stepper, 'simulate_moment',
+                        counting_simulate_moment)
+    circuit = cirq.Circuit()
+    circuit.append(cirq.H(Q1))
+    circuit.append(cg.XmonMeasurementGate('a').on(Q1))
+    circuit.append(cirq.CNOT(Q1, Q2))
+    circuit.append(cirq.X(Q3))
+    circuit.append(cg.XmonMeasurementGate('b', invert_mask=(False, True))
+                   .on(Q2, Q3))
+    circuit.append(cirq.X(Q3))
+
+    result = cg.XmonSimulator().run(circuit, repetitions=100)
+    a = result.measurements['a']
+    b = result.measurements['b']
+    assert a.shape == (100, 1)
+    assert b.shape == (100, 2)
+    np.testing.assert_equal(a[:, 0], b[:, 0])
+    np.testing.assert_equal(b[:, 1], False)
+    # Both outcomes of the first measurement occur, and are interleaved.
+    assert 0 < np.sum(a) < 100
+    assert np.any(np.diff(a[:, 0].astype(int)) < 0)
+    # The moments before the first measurement are simulated once, and the
+    # rest once for each of its two outcomes.
+    num_moments = len(cg.XmonSimulator()._to_xmon_circuit(
+        circuit, cirq.ParamResolver({}))[0])
+    assert len(moments) < 2 * num_moments
+
+
+def test_run_sweep_reuses_prefix(monkeypatch):
+    moments = []
+    simulate_moment = cg.sim.xmon_stepper.Stepper.simulate_moment
+
+    def counting_simulate_moment(self, *args, **kwargs):
+        moments.append(args)
+        return simulate_moment(self, *args, **kwargs)
+
+    monkeypatch.setattr(cg.sim.xmon_stepper.Stepper, 'simulate_moment',
+                        counting_simulate_moment)
+    circuit = cirq.Circuit.from_ops(
+        cirq.X(Q1), cirq.CNOT(Q1, Q2), cirq.X(Q3), cirq.CNOT(Q3, Q1),
+        cirq.CNOT(Q2, Q3))
+    simulator = cg.XmonSimulator()
+    split = len(circuit)
+    prefix_length = len(simulator._to_xmon_circuit(
+        circuit, cirq.ParamResolver({}))[0])
+    circuit.append([cirq.RotXGate(half_turns=cirq.Symbol('t')).on(Q2),
+                    cirq.measure(Q1, Q2, Q3, key='m')])
+    # The state before the rotation is |010>.
+    points = cirq.Points('t', [0, 1, 0, 1])
+    expected = [[False, True, False], [False, False, False]] * 2
+
+    results = simulator.run_sweep(circuit, points, repetitions=2)
+    for result, bits in zip(results, expected):
+        np.testing.assert_equal(result.measurements['m'], [bits] * 2)
+    # The prefix is simulated once, and the rest once for each point.
+    suffix_lengths = [len(simulator._to_xmon_circuit(circuit[split:],
+                                                     resolver)[0])
+                      for resolver in points]
+    assert len(moments) == prefix_length + sum(suffix_lengths)
+
+    # Non-terminal measurements continue from the prefix as well.
+    circuit.append(cirq.X(Q1))
+    options = cg.XmonOptions(num_shards=2, min_qubits_before_shard=0,
+                             plan_shard_qubits=True)
+    results = cg.XmonSimulator(options).run_sweep(circuit, points,
+                                                  repetitions=2)
+    for result, bits in zip(results, expected):
+        np.testing.assert_equal(result.measurements['m'], [bits] * 2)
+
+
+def test_run_sweep_prefix_with_measurement():
+    circuit = cirq.Circuit([
+        cirq.Moment([cirq.H(Q1)]),
+        cirq.Moment([cirq.measure(Q1, key='a')]),
+        cirq.Moment([cirq.RotXGate(half_turns=cirq.Symbol('t')).on(Q2)]),
+        cirq.Moment([cirq.measure(Q2, key='b')]),
+    ])
+    simulator = cg.XmonSimulator()
+    prefix, rest = simulator._split_sweep_prefix(
+        circuit, list(cirq.Points('t', [0, 1])), cg.xmon_gate_ext)
+    assert not prefix.moments
+    assert rest is circuit
+    results = simulator.run_sweep(circuit, cirq.Points('t', [0, 1]),
+                                  repetitions=100)
+    assert 0 < np.sum(results[0].measurements['a']) < 100
+    assert 0 < np.sum(results[1].measurements['a']) < 100
+    np.testing.assert_equal(results[0].measurements['b'], False)
+    np.testing.assert_equal(results[1].measurements['b'], True)
+
+
+def test_compact_circuit_simulated_moment_by_moment(monkeypatch):
+    def to_circuit(_):
+        raise AssertionError('The compact circuit was converted.')
+
+    body = [cirq.H(Q1), cirq.CNOT(Q1, Q2),
+            cirq.RotXGate(half_turns=cirq.Symbol('t')).on(Q3),
+            cirq.SWAP(Q2, Q3), cirq.X(Q1)**0.25]
+    circuit = cirq.Circuit.from_ops(body)
+    compact = cirq.CompactCircuit.from_circuit(circuit)
+    points = cirq.Points('t', [0, 0.5, 1])
+    observables = [PauliString({Q3: Pauli.Z}),
+                   PauliString({Q1: Pauli.X, Q2: Pauli.Z})]
+    simulator = cg.XmonSimulator()
+    expected_states = [r.final_state
+                       for r in simulator.simulate_sweep(circuit, points)]
+    expected_values = simulator.expectation_values(circuit, observables,
+                                                   points)
+
+    monkeypatch.setattr(cirq.CompactCircuit, 'to_circuit', to_circuit)
+    for result, state in zip(simulator.simulate_sweep(compact, points),
+                             expected_states):
+        cirq.testing.assert_allclose_up_to_global_phase(
+            result.final_state, state, atol=1e-6)
+    np.testing.assert_allclose(
+        simulator.expectation_values(compact, observables, points),
+        expected_values, atol=1e-6)
+
+
+def test_compact_circuit_run_sweep(monkeypatch):
+    def to_circuit(_):
+        raise AssertionError('The compact circuit was converted.')
+
+    monkeypatch.setattr(cirq.CompactCircuit, 'to_circuit', to_circuit)
+    t = cirq.Symbol('t')
+    compact = cirq.CompactCircuit.from_circuit(cirq.Circuit.from_ops(
+        cirq.H(Q1),
+        cirq.measure(Q1, key='a'),
+        cirq.CNOT(Q1, Q2),
+        cirq.SWAP(Q2, Q3),
+        cirq.RotXGate(half_turns=t).on(Q2),
+        cirq.measure(Q2, Q3, key='b')))
+    simulator = cg.XmonSimulator()
+    results = simulator.run_sweep(compact, cirq.Points('t', [0, 1]),
+                                  repetitions=100)
+    for result, flipped in zip(results, [False, True]):
+        a = result.measurements['a'][:, 0]
+        assert 0 < np.sum(a) < 100
+        np.testing.assert_equal(result.measurements['b'][:, 0], flipped)
+        np.testing.assert_equal(result.measurements['b'][:, 1], a)
+
+    # Terminal measurements are sampled from the final state.
+    compact = cirq.CompactCircuit.from_circuit(cirq.Circuit.from_ops(
+        cirq.X(Q1), cirq.SWAP(Q1, Q2), cirq.measure(Q1, Q2, key='m')))
+    result = simulator.run(compact, repetitions=3)
+    np.testing.assert_equal(result.measurements['m'], [[False, True]] * 3)
+
+    with pytest.raises(ValueError, match='Repeated Measurement key'):
+        simulator.run(cirq.CompactCircuit.from_circuit(cirq.Circuit.from_ops(
+            cirq.measure(Q1, key='m'), cirq.measure(Q2, key='m'))))
+
+
+def test_compiled_circuit_cache(monkeypatch):
+    conversions = []
+    optimize_circuit = cg.ConvertToXmonGates.optimize_circuit
+
+    def counting_optimize_circuit(self, circuit):
+        conversions.append(circuit)
+        return optimize_circuit(self, circuit)
+
+    monkeypatch.setattr(cg.ConvertToXmonGates, 'optimize_circuit',
+                        counting_optimize_circuit)
+    circuit = cirq.Circuit.from_ops(
+        cirq.H(Q1), cirq.CNOT(Q1, Q2),
+        cirq.RotXGate(half_turns=cirq.Symbol('t')).on(Q1),
+        cirq.measure(Q1, key='m'))
+    simulator = cg.XmonSimulator()
+    simulator.run(circuit, cirq.ParamResolver({'t': 1}))
+    result = simulator.simulate(cirq.Circuit(circuit.moments),
+                                cirq.ParamResolver({'t': 0}))
+    assert len(conversions) == 1
+    # A sweep compiles the prefix before the parameterized moment and the
+    # rest of the circuit separately, once each.
+    for _ in range(2):
+        results = simulator.run_sweep(circuit, cirq.Points('t', [0, 0.5, 1]))
+        assert len(results) == 3
+    assert len(conversions) == 3
+
+    # The Bell state was collapsed by the measurement.
+    probabilities = np.abs(result.final_state)**2
+    assert (np.allclose(probabilities, [1, 0, 0, 0], atol=1e-5) or
+            np.allclose(probabilities, [0, 0, 0, 1], atol=1e-5))
+
+    # Only the moments with parameterized operations are resolved, the
+    # others are shared with the compiled circuit.
+    compiled = simulator._compile(circuit)
+    bound = compiled.bind(cirq.ParamResolver({'t': 0.25}))
+    assert not any(cirq.is_parameterized(op, cg.xmon_gate_ext)
+                   for op in bound.all_operations())
+    assert any(cirq.is_parameterized(op, cg.xmon_gate_ext)
+               for op in compiled.circuit.all_operations())
+    assert bound.moments[0] is compiled.circuit.moments[0]
+
+    # Changing the circuit or the options compiles again.
+    circuit.append(cirq.X(Q2))
+    simulator.run(circuit, cirq.ParamResolver({'t': 1}))
+    simulator.options = cg.XmonOptions(matrix_gates=True)
+    simulator.run(circuit, cirq.ParamResolver({'t': 1}))
+    assert len(conversions) == 5
+
+
+def test_compile_falls_back_to_resolving_first():
+    circuit = cirq.Circuit.from_ops(
+        cirq.X(Q1),
+        cirq.SwapGate(half_turns=cirq.Symbol('t')).on(Q1, Q2),
+        cirq.measure(Q1, Q2, key='m'))
+    simulator = cg.XmonSimulator()
+    # The unresolved swap has no known matrix, so it cannot be converted,
+    # but it can be synthesized once resolved.
+    assert simulator._compile(circuit) is None
+    results = simulator.run_sweep(circuit, cirq.Points('t', [0, 1]))
+    np.testing.assert_equal(results[0].measurements['m'], [[True, False]])
+    np.testing.assert_equal(results[1].measurements['m'], [[False, True]])
+
+
+def test_compile_unhashable_gate():
+    class UnhashableGate(cirq.Gate, cirq.KnownMatrix):
+        def __eq__(self, other):
+            return isinstance(other, type(self))
+
+        def matrix(self):
+            return np.array([[0, 1], [1, 0]])
+
+    circuit = cirq.Circuit.from_ops(
+        UnhashableGate().on(Q1),
+        cirq.RotXGate(half_turns=cirq.Symbol('t')).on(Q2),
+        cirq.measure(Q1, Q2, key='m'))
+    simulator = cg.XmonSimulator()
+    results = simulator.run_sweep(circuit, cirq.Points('t', [0, 1]))
+    np.testing.assert_equal(results[0].measurements['m'], [[True, False]])
+    np.testing.assert_equal(results[1].measurements['m'], [[True, True]])
+    assert not simulator._compiled_circuits
+
+
+def test_compile_raises_unless_parameters_are_the_cause():
+    class UnsupportedGate(cirq.Gate):
+        pass
+
+    simulator = cg.XmonSimulator()
+    with pytest.raises(TypeError):
+        simulator._compile(cirq.Circuit.from_ops(UnsupportedGate().on(Q1)))
+    with pytest.raises(ValueError, match='Repeated Measurement key'):
+        simulator._compile(cirq.Circuit.from_ops(
+            cirq.RotXGate(half_turns=cirq.Symbol('t')).on(Q1),
+            cirq.measure(Q1, key='m'),
+            cirq.measure(Q2, key='m')))
+
+
+def test_plan_stepper_map():
+    q = [cirq.GridQubit(0, i) for i in range(4)]
+    circuit = cirq.Circuit.from_ops(
+        cg.ExpWGate().on(q[0]), cg.ExpWGate().on(q[0]),
+        cg.ExpWGate().on(q[1]), cg.ExpZGate().on(q[2]),
+        cg.Exp11Gate().on(q[2], q[3]), cg.ExpWGate().on(q[3]))
+    qubit_map = {q[0]: 3, q[1]: 2, q[2]: 1, q[3]: 0}
+    options = cg.XmonOptions(num_shards=4, min_qubits_before_shard=0,
+                             plan_shard_qubits=True)
+    # q[2] has no W gates, and q[1] wins the tie with q[3] by already being
+    # a prefix qubit.
+    assert xmon_simulator._plan_stepper_map(circuit, qubit_map, options) == {
+        q[3]: 0, q[0]: 1, q[2]: 2, q[1]: 3}
+
+    options.plan_shard_qubits = False
+    assert xmon_simulator._plan_stepper_map(
+        circuit, qubit_map, options) is qubit_map
+    options = cg.XmonOptions(num_shards=4, plan_shard_qubits=True)
+    assert xmon_simulator._plan_stepper_map(
+        circuit, qubit_map, options) is qubit_map
+
+
+def test_permute_qubits():
+    q = [cirq.GridQubit(0, i) for i in range(3)]
+    from_map = {q[0]: 0, q[1]: 1, q[2]: 2}
+    to_map = {q[0]: 2, q[1]: 0, q[2]: 1}
+    assert xmon_simulator._permute_qubits(0b001, from_map, to_map) == 0b100
+    assert xmon_simulator._permute_qubits(0b110, from_map, to_map) == 0b011
+    state = np.arange(8)
+    permuted = xmon_simulator._permute_qubits(state, from_map, to_map)
+    for i in range(8):
+        assert permuted[xmon_simulator._permute_qubits(
+            i, from_map, to_map)] == i
+    np.testing.assert_equal(
+        xmon_simulator._permute_qubits(permuted, to_map, from_map), state)
+    with pytest.raises(ValueError):
+        xmon_simulator._permute_qubits(8, from_map, to_map)
+
+
+def test_plan_shard_qubits(monkeypatch):
+    between_shards = []
+    w_between_shards = cg.sim.xmon_stepper._w_between_shards
+
+    def counting_w_between_shards(args):
+        between_shards.append(args['index'])
+        return w_between_shards(args)
+
+    monkeypatch.setattr(cg.sim.xmon_stepper, '_w_between_shards',
+                        counting_w_between_shards)
+    circuit = large_circuit()
+    # Make two of the qubits that would not be sharded over W-free.
+    qubits = sorted(circuit.all_qubits())
+    circuit = cirq.Circuit(
+        cirq.Moment(op for op in moment.operations
+                    if not isinstance(op.gate, cg.ExpWGate) or
+                    op.qubits[0] not in qubits[-2:])
+        for moment in circuit)
+    measureless = circuit[:-1]
+    sharded = cg.XmonOptions(num_shards=4, min_qubits_before_shard=0)
+    planned = cg.XmonOptions(num_shards=4, min_qubits_before_shard=0,
+                             plan_shard_qubits=True)
+    initial_state = np.zeros(2 ** 10, dtype=np.complex64)
+    initial_state[3] = 0.6
+    initial_state[514] = 0.8j
+
+    expected = cg.XmonSimulator(sharded).simulate(
+        measureless, initial_state=initial_state).final_state
+    assert between_shards
+    del between_shards[:]
+    result = cg.XmonSimulator(planned).simulate(
+        measureless, initial_state=initial_state).final_state
+    assert not between_shards
+    np.testing.assert_almost_equal(result, expected, decimal=5)
+
+    result = cg.XmonSimulator(planned).simulate(
+        measureless, initial_state=514).final_state
+    expected = cg.XmonSimulator(sharded).simulate(
+        measureless, initial_state=514).final_state
+    np.testing.assert_almost_equal(result, expected, decimal=5)
+
+    steps = cg.XmonSimulator().simulate_moment_steps(measureless, planned)
+    step = next(steps)
+    step.set_state(initial_state)
+    np.testing.assert_almost_equal(step.state(), initial_state)
+    np.testing.assert_equal(step.sample([qubits[-2]], 3), [[True]] * 3)
+    for first, last in step.sample([qubits[0], qubits[-1]], 10):
+        assert first != last
+
+    np.random.seed(0)
+    result = cg.XmonSimulator(planned).run(circuit, repetitions=5)
+    np.random.seed(0)
+    expected = cg.XmonSimulator(sharded).run(circuit, repetitions=5)
+    np.testing.assert_equal(result.measurements['meas'],
+                            expected.measurements['meas'])
+
+
+def test_stepper_cache():
+    cache = xmon_simulator._StepperCache()
+    options = cg.XmonOptions()
+    with cache.stepper(2, options, 0) as stepper:
+        stepper.simulate_w(0, 1.0, 0.0)
+        # Nested simulations get their own stepper.
+        with cache.stepper(2, options, 0) as nested_stepper:
+            assert nested_stepper is not stepper
+    # Only one stepper is kept, and the other one is closed.
+    assert stepper.memory_usage.count == 0
+    assert nested_stepper.memory_usage.count > 0
+    with cache.stepper(2, options, 1) as reused_stepper:
+        assert reused_stepper in (stepper, nested_stepper)
+        np.testing.assert_almost_equal(reused_stepper.current_state,
+                                       [0, 1, 0, 0])
+    cache.close()
+    assert nested_stepper.memory_usage.count == 0
+    with cache.stepper(2, options, 0) as new_stepper:
+        assert new_stepper not in (stepper, nested_stepper)
+
+
 @pytest.mark.parametrize('scheduler', SCHEDULERS)
 def test_composite_gates(scheduler):
     circuit = cirq.Circuit()
@@ -946,10 +1656,11 @@ def test_circuit_param_and_reps():
             == {(r.params['a'], r.params['b']) for r in all_trials})
 
 
-def assert_simulated_states_match_circuit_matrix_by_basis(circuit):
+def assert_simulated_states_match_circuit_matrix_by_basis(circuit,
+                                                          options=None):
     basis = [Q1, Q2]
     matrix = circuit.to_unitary_matrix(qubit_order=basis)
-    simulator = cg.XmonSimulator()
+    simulator = cg.XmonSimulator(options)
     for i in range(matrix.shape[0]):
         col = matrix[:, i]
         result = list(simulator.simulate_moment_steps(
@@ -962,24 +1673,44 @@ def assert_simulated_states_match_circuit_matrix_by_basis(circuit):
             atol=1e-5)
 
 
-def test_compare_simulator_states_to_gate_matrices():
+@pytest.mark.parametrize('options', (
+    cg.XmonOptions(),
+    cg.XmonOptions(matrix_gates=True),
+    cg.XmonOptions(num_shards=4, min_qubits_before_shard=0,
+                   matrix_gates=True),
+))
+def test_compare_simulator_states_to_gate_matrices(options):
+    assert_simulated_states_match_circuit_matrix_by_basis(
+        cirq.Circuit.from_ops(cirq.CNOT(Q1, Q2)), options)
+
     assert_simulated_states_match_circuit_matrix_by_basis(
-        cirq.Circuit.from_ops(cirq.CNOT(Q1, Q2)))
+        cirq.Circuit.from_ops(cirq.Z(Q1)**0.5, cirq.Z(Q2)), options)
 
     assert_simulated_states_match_circuit_matrix_by_basis(
-        cirq.Circuit.from_ops(cirq.Z(Q1)**0.5, cirq.Z(Q2)))
+        cirq.Circuit.from_ops(cirq.X(Q1)**0.5), options)
 
     assert_simulated_states_match_circuit_matrix_by_basis(
-        cirq.Circuit.from_ops(cirq.X(Q1)**0.5))
+        cirq.Circuit.from_ops(cirq.Y(Q2)**(1 / 3)), options)
 
     assert_simulated_states_match_circuit_matrix_by_basis(
-        cirq.Circuit.from_ops(cirq.Y(Q2)**(1 / 3)))
+        cirq.Circuit.from_ops(cirq.H(Q2)), options)
 
     assert_simulated_states_match_circuit_matrix_by_basis(
-        cirq.Circuit.from_ops(cirq.H(Q2)))
+        cirq.Circuit.from_ops(cirq.CZ(Q1, Q2)**0.5), options)
 
     assert_simulated_states_match_circuit_matrix_by_basis(
-        cirq.Circuit.from_ops(cirq.CZ(Q1, Q2)**0.5))
+        cirq.Circuit.from_ops(cirq.SWAP(Q1, Q2), cirq.H(Q1),
+                              cirq.ISWAP(Q1, Q2)**0.25), options)
+
+
+def test_matrix_gates_kept():
+    circuit = cirq.Circuit.from_ops(cirq.H(Q1), cirq.SWAP(Q1, Q2),
+                                    cirq.CZ(Q1, Q2))
+    simulator = cg.XmonSimulator(cg.XmonOptions(matrix_gates=True))
+    xmon_circuit, _ = simulator._to_xmon_circuit(circuit,
+                                                 cirq.ParamResolver({}))
+    assert [type(op.gate) for op in xmon_circuit.all_operations()] == [
+        cirq.SingleQubitMatrixGate, cirq.TwoQubitMatrixGate, cg.Exp11Gate]
 
 
 def test_simulator_trial_result():
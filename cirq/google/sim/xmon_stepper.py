@@ -18,11 +18,15 @@ This class should not be used directly, see instead XmonSimulator in the
 xmon_simulator class.
 """
 
+import collections
+import itertools
 import math
 import multiprocessing
 import multiprocessing.dummy as dummy
 
-from typing import Any, Dict, List, Union, Tuple
+from typing import (
+    Any, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union,
+)
 
 import numpy as np
 
@@ -31,20 +35,105 @@ from cirq.google.sim import mem_manager
 
 I_PI_OVER_2 = 0.5j * np.pi
 
+# The dtypes supported for the wave function.
+SUPPORTED_DTYPES = (np.complex64, np.complex128)
+
+# Number of amplitudes of a shard whose phases are computed at once.
+_PHASE_CHUNK_SIZE = 2 ** 16
+
+# Number of distinct phase maps whose compiled programs a stepper caches.
+_PHASE_PROGRAM_CACHE_SIZE = 128
+
+# Numbers the steppers, so that each owns its shared memory under a unique
+# owner.
+_stepper_numbers = itertools.count()
+
 
 def ensure_pool(func):
     """Decorator that ensures a pool is available for a stepper."""
     def func_wrapper(*args, **kwargs):
         if len(args) == 0 or not isinstance(args[0], Stepper):
             raise Exception('@ensure_pool can only be used on Stepper methods.')
-        if args[0]._pool is None:
-            with args[0]:
+        stepper = args[0]
+        stepper._check_not_closed()
+        if stepper._pool is None:
+            stepper._open_pool()
+            try:
                 return func(*args, **kwargs)
+            finally:
+                stepper.close_pool()
         else:
             return func(*args, **kwargs)
     return func_wrapper
 
 
+class RenormPolicy(object):
+    """Determines when the stepper renormalizes the wave function.
+
+    Gates are unitary, so renormalizing only corrects for floating point
+    drift, at the cost of a reduction over the wave function plus a full pass
+    over it. A policy can renormalize periodically, once the drift has
+    exceeded a tolerance, and/or just before measurements or sampling.
+
+    Attributes:
+        period: If not None, the wave function is renormalized after every
+            this many steps. A step is a call to simulate_moment or
+            simulate_w.
+        tolerance: If not None, the norm of the wave function is computed
+            after every step, and the wave function is renormalized once its
+            L2 norm differs from 1 by more than this tolerance. The norm of a
+            moment is computed in the same pass that applies the moment, but
+            single gate steps take an extra pass over the wave function.
+        before_measurement: Whether the wave function is renormalized before
+            measurements and sampling, if gates have been applied since the
+            last renormalization.
+    """
+
+    NEVER = None  # type: RenormPolicy
+    BEFORE_MEASUREMENT = None  # type: RenormPolicy
+    EVERY_MOMENT = None  # type: RenormPolicy
+
+    def __init__(self,
+                 period: Optional[int] = None,
+                 tolerance: Optional[float] = None,
+                 before_measurement: bool = True) -> None:
+        if period is not None and period < 1:
+            raise ValueError('Renormalization period must be positive. '
+                             'Was {}'.format(period))
+        if tolerance is not None and tolerance <= 0:
+            raise ValueError('Renormalization tolerance must be positive. '
+                             'Was {}'.format(tolerance))
+        self.period = period
+        self.tolerance = tolerance
+        self.before_measurement = before_measurement
+
+    def __eq__(self, other):
+        if not isinstance(other, type(self)):
+            return NotImplemented
+        return ((self.period, self.tolerance, self.before_measurement) ==
+                (other.period, other.tolerance, other.before_measurement))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((RenormPolicy,
+                     self.period,
+                     self.tolerance,
+                     self.before_measurement))
+
+    def __repr__(self):
+        return ('cirq.google.RenormPolicy(period={!r}, tolerance={!r}, '
+                'before_measurement={!r})'.format(self.period,
+                                                  self.tolerance,
+                                                  self.before_measurement))
+
+
+RenormPolicy.NEVER = RenormPolicy(before_measurement=False)
+RenormPolicy.BEFORE_MEASUREMENT = RenormPolicy()
+RenormPolicy.EVERY_MOMENT = RenormPolicy(period=1)
+
+
 class Stepper(object):
     """A wave function simulator for quantum circuits with the xmon gate set.
 
@@ -63,12 +152,13 @@ class Stepper(object):
             s.simulate_phases((1, 0.25))
             s.simulate_w(2, 0.25, 0.25)
             ...
-    In this case the stepper will shut down the multiprocessing pool upon
-    exiting the with context.
+    In this case the stepper will shut down the multiprocessing pool and free
+    its shared memory upon exiting the with context.
 
     If the  stepper is not used as a context manager, then it is required that
-    __exit__ be called in order to ensure that the multiprocessing pool is
-    properly closed (__enter__ does not need to be called).
+    close be called in order to ensure that the multiprocessing pool is
+    properly closed and the shared memory is freed. Calling __exit__ without
+    __enter__ only closes the pool, like close_pool.
     """
 
     def __init__(self,
@@ -76,7 +166,11 @@ class Stepper(object):
                  num_prefix_qubits: int = None,
                  initial_state: Union[int, np.ndarray] = 0,
                  min_qubits_before_shard: int = 18,
-                 use_processes=False) -> None:
+                 use_processes=False,
+                 renorm_policy: RenormPolicy = RenormPolicy.EVERY_MOMENT,
+                 dtype: type = np.complex64,
+                 state_directory: str = None,
+                 low_memory: bool = False) -> None:
         """Construct a new XmonSimulator.
 
         Args:
@@ -96,7 +190,7 @@ class Stepper(object):
               last.
               Otherwise, if this is a np.ndarray it is the full initial state
               and this must be the correct size, normalized (an L2 norm of 1),
-              and have dtype of np.complex64. An array with zeroes everywhere,
+              and have the given dtype. An array with zeroes everywhere,
               except for a 1 at index k, is equivalent to state prepared when
               the initial state is set to the integer k.
           min_qubits_before_shard: Sharding will be done only for this number
@@ -106,15 +200,40 @@ class Stepper(object):
               but on the order of 10 percent faster).  However this varies
               significantly by architecture, and processes should not be used
               for interactive python use on Windows.
+          renorm_policy: Determines when the wave function is renormalized.
+              The default renormalizes after every call to simulate_moment
+              or simulate_w.
+          dtype: The dtype of the wave function, either np.complex64 (the
+              default, which is faster and uses half the memory) or
+              np.complex128 (for higher precision).
+          state_directory: If not None, the wave function and the equally
+              sized scratch pad are stored in memory-mapped files created in
+              this directory, such as a tmpfs or a local disk, instead of in
+              memory. This allows wave functions larger than physical memory.
+              The files are removed when the stepper is deleted.
+          low_memory: If True, no scratch pad is allocated, halving the
+              memory used by the stepper. W gates between shards are then
+              applied in place, with each worker updating a pair of shards,
+              so that only half of the shards are worked on in parallel.
+
+        Raises:
+            ValueError if the dtype is not supported.
         """
+        # Owns all of the shared memory arrays of this stepper.
+        self._mem_owner = 'Stepper-{}'.format(next(_stepper_numbers))
+        self._closed = False
+        self._entered = False
+        self._pool = None  # type: Union[ThreadlessPool, Any]
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(
+                'Unsupported dtype {}. Expected one of {}.'.format(
+                    dtype, SUPPORTED_DTYPES))
+        self._dtype = dtype
+        self._state_directory = state_directory
+        self._low_memory = low_memory
         self._num_qubits = num_qubits
-        if num_prefix_qubits is None:
-            num_prefix_qubits = int(math.log(multiprocessing.cpu_count(), 2))
-        if num_prefix_qubits > num_qubits:
-            num_prefix_qubits = num_qubits
-        if num_qubits < min_qubits_before_shard:
-            num_prefix_qubits = 0
-        self._num_prefix_qubits = num_prefix_qubits
+        self._num_prefix_qubits = choose_num_prefix_qubits(
+            num_qubits, num_prefix_qubits, min_qubits_before_shard)
         # Each shard is of a dimension equal to 2 ** num_shard_qubits.
         self._num_shard_qubits = self._num_qubits - self._num_prefix_qubits
 
@@ -123,13 +242,27 @@ class Stepper(object):
 
         # TODO(dabacon): This could be parallelized.
         self._init_shared_mem(initial_state)
-        self._pool = None  # type: Union[ThreadlessPool, Any]
         self._pool_fn = multiprocessing.Pool if use_processes else dummy.Pool
-
-    def _init_shared_mem(self, initial_state: int):
-        self._shared_mem_dict = {}  # type: Dict[str, int]
+        self._phase_program_cache = (
+            collections.OrderedDict()
+        )  # type: collections.OrderedDict
+        self._renorm_policy = renorm_policy
+        self._num_steps = 0
+        self._drift_count = 0
+
+    def _init_shared_mem(self, initial_state: Union[int, np.ndarray]):
+        # Validate the initial state before any memory is allocated.
+        if isinstance(initial_state, int):
+            check_basis_state(initial_state, self._num_qubits)
+        elif isinstance(initial_state, np.ndarray):
+            check_state(initial_state, self._num_qubits, self._dtype,
+                        self._num_shards)
+        else:
+            raise TypeError('initial_state was not of type int or ndarray')
+        self._shared_mem_dict = {}  # type: Dict[str, Union[int, str]]
         self.init_z_vects()
-        self._init_scratch()
+        if not self._low_memory:
+            self._init_scratch()
         self._init_state(initial_state)
 
     def init_z_vects(self):
@@ -162,48 +295,90 @@ class Stepper(object):
         a &= 1
         zero_one_vects = np.ascontiguousarray(a.transpose())
         zero_one_vects_handle = mem_manager.SharedMemManager.create_array(
-            zero_one_vects)
+            zero_one_vects, owner=self._mem_owner)
         self._shared_mem_dict['zero_one_vects_handle'] = zero_one_vects_handle
 
         pm_vects = 1 - 2 * zero_one_vects
-        pm_vects_handle = mem_manager.SharedMemManager.create_array(pm_vects)
+        pm_vects_handle = mem_manager.SharedMemManager.create_array(
+            pm_vects, owner=self._mem_owner)
         self._shared_mem_dict['pm_vects_handle'] = pm_vects_handle
 
     def _init_scratch(self):
         """Initializes a scratch pad equal in size to the wavefunction."""
-        scratch = np.zeros((self._num_shards, self._shard_size),
-                           dtype=np.complex64)
-        scratch_handle = mem_manager.SharedMemManager.create_array(
-            scratch.view(dtype=np.float32))
+        scratch_handle = mem_manager.SharedMemManager.create_empty_array(
+            (self._num_shards, 2 * self._shard_size),
+            _real_dtype(self._dtype),
+            self._state_directory,
+            self._mem_owner)
         self._shared_mem_dict['scratch_handle'] = scratch_handle
+        for kwargs in self._shard_num_args():
+            _clear_scratch(kwargs)
 
     def _init_state(self, initial_state: Union[int, np.ndarray]):
-        """Initializes a the shard wavefunction and sets the initial state."""
-        state = np.reshape(
-            decode_initial_state(initial_state, self._num_qubits),
-            (self._num_shards, self._shard_size))
-        state_handle = mem_manager.SharedMemManager.create_array(
-            state.view(dtype=np.float32))
+        """Initializes a the shard wavefunction and sets the initial state.
+
+        The initial state is written one shard at a time, so that no other
+        array of the size of the wave function is allocated.
+        """
+        state_handle = mem_manager.SharedMemManager.create_empty_array(
+            (self._num_shards, 2 * self._shard_size),
+            _real_dtype(self._dtype),
+            self._state_directory,
+            self._mem_owner)
         self._shared_mem_dict['state_handle'] = state_handle
+        for kwargs in self._shard_reset_args(initial_state):
+            _reset_state(kwargs)
+
+    def close(self):
+        """Shuts down the pool and frees the shared memory of the stepper.
+
+        The stepper cannot be used once it is closed. Closing it again does
+        nothing.
+        """
+        self.close_pool()
+        if not self._closed:
+            self._closed = True
+            self._shared_mem_dict = {}
+            mem_manager.SharedMemManager.free_owner(self._mem_owner)
+
+    def _check_not_closed(self):
+        if self._closed:
+            raise ValueError('The stepper is closed.')
 
     def __del__(self):
-        for handle in self._shared_mem_dict.values():
-            mem_manager.SharedMemManager.free_array(handle)
+        if not self._closed:
+            self._closed = True
+            mem_manager.SharedMemManager.free_owner(self._mem_owner,
+                                                    block=False)
 
     def __enter__(self):
+        self._check_not_closed()
+        self._open_pool()
+        self._entered = True
+        return self
+
+    def __exit__(self, *args):
+        if self._entered:
+            self.close()
+        else:
+            self.close_pool()
+
+    def _open_pool(self):
         if self._pool is None:
             self._pool = (self._pool_fn(processes=self._num_shards)
                           if self._num_prefix_qubits > 0 else ThreadlessPool())
-        return self
 
-    def __exit__(self, *args):
+    def close_pool(self):
+        """Shuts down the pool, keeping the wave function.
+
+        The pool is started again when it is needed.
+        """
         # Terminate is safe here since all work should have been completed.
         if self._pool is not None:
             self._pool.terminate()
             self._pool.join()
             self._pool = None
 
-
     def _shard_num_args(self,
                         constant_dict: Dict[str, Any] = None
                         ) -> List[Dict[str, Any]]:
@@ -228,19 +403,63 @@ class Stepper(object):
             append_dict['shard_num'] = shard_num
             append_dict['num_shards'] = self._num_shards
             append_dict['num_shard_qubits'] = self._num_shard_qubits
+            append_dict['dtype'] = self._dtype
             append_dict.update(self._shared_mem_dict)
             args.append(append_dict)
         return args
 
+    def _shard_group_args(self,
+                          args: List[Dict[str, Any]],
+                          indices: Sequence[int]) -> List[Dict[str, Any]]:
+        """Returns the args of the shards with zeros for the prefix qubits.
+
+        Each of these shards is grouped with the shards that differ from it
+        only in the prefix qubits among the given indices.
+        """
+        bits = [index - self._num_shard_qubits for index in indices
+                if index >= self._num_shard_qubits]
+        return [a for a in args
+                if not any(_kth_bit(a['shard_num'], bit) for bit in bits)]
+
+    @property
+    def memory_usage(self) -> mem_manager.MemoryUsage:
+        """The shared memory used by the arrays of this stepper."""
+        return mem_manager.SharedMemManager.usage(self._mem_owner)
+
+    @property
+    def drift_count(self) -> int:
+        """The number of gates applied since the last renormalization."""
+        return self._drift_count
+
     @property
     def current_state(self):
-        """Returns the current wavefunction."""
-        return self._current_state()
+        """Returns a copy of the current wavefunction."""
+        return self.get_state()
 
-    @ensure_pool
-    def _current_state(self):
-        return np.array(
-            self._pool.map(_state_shard, self._shard_num_args())).flatten()
+    def get_state(self, copy: bool = True) -> np.ndarray:
+        """Returns the current wavefunction.
+
+        The wavefunction is read directly from the shared memory that the
+        shards are stored in, without going through the pool.
+
+        Args:
+            copy: If True, a copy of the wavefunction is returned. Otherwise
+                a read-only view of the shared memory is returned. The view
+                avoids the copy, but it changes as the simulation proceeds
+                and its contents are undefined once the stepper is reset or
+                used for another simulation.
+
+        Raises:
+            ValueError: The stepper is closed.
+        """
+        self._check_not_closed()
+        state = mem_manager.SharedMemManager.get_array(
+            self._shared_mem_dict['state_handle']).view(
+            dtype=self._dtype).reshape(-1)
+        if copy:
+            return state.copy()
+        state.flags.writeable = False
+        return state
 
     @ensure_pool
     def reset_state(self, reset_state):
@@ -251,27 +470,36 @@ class Stepper(object):
                 the stepper to, expressed as an integer of the computational
                 basis. Integer to bitwise indices is little endian. Otherwise
                 if this is a np.ndarray this must be the correct size, be
-                normalized (L2 norm of 1), and have dtype of np.complex64.
+                normalized (L2 norm of 1), and have the stepper's dtype.
 
         Raises:
             ValueError if the state is incorrectly sized or not of the correct
             dtype.
         """
         # If the pool has been closed, recreate to calculate state.'
+        self._num_steps = 0
+        self._drift_count = 0
         if isinstance(reset_state, int):
-            self._pool.map(_reset_state,
-                           self._shard_num_args({'reset_state': reset_state}))
+            check_basis_state(reset_state, self._num_qubits)
         elif isinstance(reset_state, np.ndarray):
-            check_state(reset_state, self._num_qubits)
-            args = []
-            for kwargs in self._shard_num_args():
-                shard_num = kwargs['shard_num']
-                shard_size = 1 << kwargs['num_shard_qubits']
-                start = shard_num * shard_size
-                end = start + shard_size
-                kwargs['reset_state'] = reset_state[start:end]
-                args.append(kwargs)
-            self._pool.map(_reset_state, args)
+            check_state(reset_state, self._num_qubits, self._dtype,
+                        self._num_shards)
+        else:
+            return
+        self._pool.map(_reset_state, self._shard_reset_args(reset_state))
+
+    def _shard_reset_args(self, reset_state: Union[int, np.ndarray]
+                          ) -> List[Dict[str, Any]]:
+        """The arguments of _reset_state for each shard."""
+        args = self._shard_num_args()
+        for kwargs in args:
+            if isinstance(reset_state, int):
+                kwargs['reset_state'] = reset_state
+            else:
+                start = kwargs['shard_num'] * self._shard_size
+                kwargs['reset_state'] = reset_state[
+                    start:start + self._shard_size]
+        return args
 
 
     @ensure_pool
@@ -287,17 +515,32 @@ class Stepper(object):
                 at the two indices, and a rotation angle of pi times the value
                 of the map.
         """
-        self._pool.map(_clear_scratch, self._shard_num_args())
-        # Iterate over the map of phase data.
-        for indices, half_turns in phase_map.items():
-            args = self._shard_num_args(
-                {'indices': indices, 'half_turns': half_turns})
-            if len(indices) == 1:
-                self._pool.map(_single_qubit_accumulate_into_scratch, args)
-            elif len(indices) == 2:
-                self._pool.map(_two_qubit_accumulate_into_scratch, args)
-        # Exponentiate the phases and add them into the state.
-        self._pool.map(_apply_scratch_as_phase, self._shard_num_args())
+        args = self._shard_num_args()
+        for shard_args, program in zip(args, self._phase_programs(phase_map)):
+            shard_args['phase_program'] = program
+        self._pool.map(_apply_phase_program, args)
+        self._drift_count += 1
+
+    def _phase_programs(self, phase_map: Dict[Tuple[int, ...], float]
+                        ) -> List['_PhaseProgram']:
+        """Returns the compiled phase program for each shard.
+
+        Compiled programs are cached, since the same phase map often repeats
+        across the moments of a circuit and across the points of a sweep.
+        """
+        key = frozenset(phase_map.items())
+        programs = self._phase_program_cache.get(key)
+        if programs is None:
+            programs = [_compile_phase_map(phase_map,
+                                           shard_num,
+                                           self._num_shard_qubits)
+                        for shard_num in range(self._num_shards)]
+            if len(self._phase_program_cache) >= _PHASE_PROGRAM_CACHE_SIZE:
+                self._phase_program_cache.popitem(last=False)
+        else:
+            self._phase_program_cache.move_to_end(key)
+        self._phase_program_cache[key] = programs
+        return programs
 
     @ensure_pool
     def simulate_w(self,
@@ -321,7 +564,11 @@ class Stepper(object):
             'half_turns': half_turns,
             'axis_half_turns': axis_half_turns
         })
-        if index >= self._num_shard_qubits:
+        if index >= self._num_shard_qubits and self._low_memory:
+            # W gate spans shards, update each pair of shards in place.
+            self._pool.map(_w_between_shard_pair,
+                           self._shard_group_args(args, [index]))
+        elif index >= self._num_shard_qubits:
             # W gate spans shards.
             self._pool.map(_clear_scratch, args)
             self._pool.map(_w_between_shards, args)
@@ -329,13 +576,182 @@ class Stepper(object):
         else:
             # W gate is within a shard.
             self._pool.map(_w_within_shard, args)
+        self._drift_count += 1
+        self._num_steps += 1
+        self._renormalize_after_step()
+
+    @ensure_pool
+    def apply_1q_matrix(self, index: int, matrix: np.ndarray):
+        """Simulate a single qubit gate given by its unitary matrix.
+
+        Args:
+          index: The qubit to act on.
+          matrix: The 2x2 unitary matrix of the gate.
+        """
+        self._apply_matrix((index,), matrix)
+
+    @ensure_pool
+    def apply_2q_matrix(self, index0: int, index1: int, matrix: np.ndarray):
+        """Simulate a two qubit gate given by its unitary matrix.
+
+        Args:
+          index0: The first qubit to act on.
+          index1: The second qubit to act on.
+          matrix: The 4x4 unitary matrix of the gate, in the basis where the
+              first qubit is the most significant bit.
+        """
+        self._apply_matrix((index0, index1), matrix)
 
-        # Normalize after every w.
-        norm_squared = np.sum(self._pool.map(_norm_squared, args))
+    def _apply_matrix(self, indices: Tuple[int, ...], matrix: np.ndarray):
+        self._map_matrix(indices, matrix)
+        self._drift_count += 1
+        self._num_steps += 1
+        self._renormalize_after_step()
+
+    def _map_matrix(self, indices: Tuple[int, ...], matrix: np.ndarray):
+        """Applies a unitary matrix to the qubits at the given indices.
+
+        If some of the qubits are prefix qubits, each worker applies the
+        matrix across the group of shards that differ in these qubits.
+        """
+        size = 2 ** len(indices)
+        if matrix.shape != (size, size):
+            raise ValueError('Expected a {}x{} matrix for indices {} but '
+                             'was {}.'.format(size, size, indices,
+                                              matrix.shape))
         args = self._shard_num_args({
-            'norm_squared': norm_squared
+            'indices': indices,
+            'matrix': np.asarray(matrix, dtype=self._dtype),
         })
-        self._pool.map(_renorm, args)
+        self._pool.map(_matrix_on_shards,
+                       self._shard_group_args(args, indices))
+
+    def _renorm_period_due(self) -> bool:
+        """Whether the period of the renormalization policy has elapsed."""
+        period = self._renorm_policy.period
+        return period is not None and self._num_steps % period == 0
+
+    def _renormalize_after_step(self, norm_squared: Optional[float] = None):
+        """Renormalizes the wave function if the policy calls for it.
+
+        Args:
+            norm_squared: The norm squared of the wave function after the
+                step. If None, this is computed when the policy needs it.
+        """
+        tolerance = self._renorm_policy.tolerance
+        if self._renorm_period_due():
+            self.renormalize(norm_squared)
+        elif tolerance is not None:
+            if norm_squared is None:
+                norm_squared = self._norm_squared()
+            if abs(math.sqrt(norm_squared) - 1) > tolerance:
+                self.renormalize(norm_squared)
+
+    def _norm_squared(self) -> float:
+        return np.sum(self._pool.map(_norm_squared, self._shard_num_args()))
+
+    @ensure_pool
+    def renormalize(self, norm_squared: float = None):
+        """Renormalizes the wave function to have an L2 norm of 1.
+
+        Args:
+            norm_squared: The norm squared of the wave function. If None, this
+                is computed.
+        """
+        if norm_squared is None:
+            norm_squared = self._norm_squared()
+        self._pool.map(_renorm, self._shard_num_args({
+            'norm_squared': norm_squared
+        }))
+        self._drift_count = 0
+
+    def _renormalize_before_measurement(self):
+        if self._renorm_policy.before_measurement and self._drift_count:
+            self.renormalize()
+
+    @ensure_pool
+    def simulate_moment(self,
+                        w_ops: Sequence[Tuple[int, float, float]] = (),
+                        phase_map: Dict[Tuple[int, ...], float] = None,
+                        measurement_indices: Sequence[int] = (),
+                        matrix_ops: Sequence[Tuple[Tuple[int, ...],
+                                                   np.ndarray]] = ()
+                        ) -> List[bool]:
+        """Simulates all of the gates of a moment on the xmon architecture.
+
+        The gates of a moment act on distinct qubits and so commute. This
+        allows all of the W gates acting within a shard and all of the phase
+        gates to be applied in a single dispatch to each shard, with the
+        wave function renormalized at most once at the end of the moment,
+        according to the renormalization policy. W gates acting on prefix
+        qubits still require a dispatch each, since they mix the amplitudes
+        of different shards.
+
+        Args:
+            w_ops: A sequence of (index, half_turns, axis_half_turns) tuples,
+                one for each W gate in the moment. See simulate_w for the
+                meaning of these values.
+            phase_map: A map from a tuple of indices to a value, one for each
+                phase gate in the moment. See simulate_phases for the meaning
+                of this map.
+            measurement_indices: The qubits measured in the moment. These are
+                measured after the W and phase gates have been applied.
+            matrix_ops: A sequence of (indices, matrix) tuples, one for each
+                gate in the moment given by its unitary matrix, on any number
+                of qubits. The first index is the most significant bit of the
+                basis of the matrix, as for apply_2q_matrix. Each of these
+                requires a dispatch.
+
+        Returns:
+            The measurement results, True iff the measurement result
+            corresponds to the |1> state, in the order of measurement_indices.
+        """
+        phase_map = phase_map or {}
+        between_ops = [w for w in w_ops if w[0] >= self._num_shard_qubits]
+        within_ops = [w for w in w_ops if w[0] < self._num_shard_qubits]
+
+        for indices, matrix in matrix_ops:
+            self._map_matrix(tuple(indices), matrix)
+
+        for i, (index, half_turns, axis_half_turns) in enumerate(between_ops):
+            w_args = self._shard_num_args({
+                'index': index,
+                'half_turns': half_turns,
+                'axis_half_turns': axis_half_turns
+            })
+            if self._low_memory:
+                self._pool.map(_w_between_shard_pair,
+                               self._shard_group_args(w_args, [index]))
+                continue
+            if i > 0:
+                self._pool.map(_copy_scratch_to_state, self._shard_num_args())
+            self._pool.map(_w_between_shards, w_args)
+
+        if between_ops or within_ops or phase_map or matrix_ops:
+            num_gates = len(w_ops) + bool(phase_map) + len(matrix_ops)
+            self._num_steps += 1
+            compute_norm = (self._renorm_period_due() or
+                            self._renorm_policy.tolerance is not None)
+            # The last W gate between shards is copied out of the scratch as
+            # part of the same dispatch that applies the rest of the moment.
+            # If the policy needs the norm, the same dispatch computes it.
+            args = self._shard_num_args({
+                'copy_scratch': bool(between_ops) and not self._low_memory,
+                'w_ops': within_ops,
+                'compute_norm': compute_norm,
+            })
+            programs = [None] * len(args)  # type: List[Optional[_PhaseProgram]]
+            if phase_map:
+                programs = list(self._phase_programs(phase_map))
+            for shard_args, program in zip(args, programs):
+                shard_args['phase_program'] = program
+            norm_squared = np.sum(self._pool.map(_moment_within_shard, args))
+            self._drift_count += num_gates
+            self._renormalize_after_step(norm_squared if compute_norm
+                                         else None)
+
+        return [self.simulate_measurement(index)
+                for index in measurement_indices]
 
     @ensure_pool
     def simulate_measurement(self, index: int) -> bool:
@@ -347,33 +763,70 @@ class Stepper(object):
         Returns:
             True iff the measurement result corresponds to the |1> state.
         """
-        args = self._shard_num_args({'index': index})
-        prob_one = np.sum(self._pool.map(_one_prob_per_shard, args))
+        self._renormalize_before_measurement()
+        prob_one = self._prob_one(index)
         result = bool(np.random.random() <= prob_one)
+        self._collapse(index, result, prob_one)
+        return result
 
+    @ensure_pool
+    def project(self, index: int, result: bool):
+        """Projects the state onto a given result of measuring a qubit.
+
+        Unlike simulate_measurement, the result is supplied rather than
+        sampled. This is used to continue a simulation along a branch of
+        measurement results that was sampled earlier.
+
+        Args:
+            index: Which qubit is measured.
+            result: True to project onto the |1> state of the qubit, False to
+                project onto the |0> state.
+
+        Raises:
+            ValueError if the result has zero probability.
+        """
+        self._renormalize_before_measurement()
+        prob_one = self._prob_one(index)
+        if (prob_one if result else 1 - prob_one) <= 0:
+            raise ValueError(
+                'Measurement result {} of qubit {} has zero probability.'
+                .format(result, index))
+        self._collapse(index, result, prob_one)
+
+    def _prob_one(self, index: int) -> float:
+        args = self._shard_num_args({'index': index})
+        return np.sum(self._pool.map(_one_prob_per_shard, args))
+
+    def _collapse(self, index: int, result: bool, prob_one: float):
         args = self._shard_num_args({
             'index': index,
             'result': result,
             'prob_one': prob_one
         })
         self._pool.map(_collapse_state, args)
-        return result
+        # Collapsing the state also normalizes it.
+        self._drift_count = 0
 
+    @ensure_pool
     def sample_measurements(
             self,
             indices: List[int],
-            repetitions: int=1) -> List[List[bool]]:
+            repetitions: int=1) -> np.ndarray:
         """Samples from measurements in the computational basis.
 
         Note that this does not collapse the wave function.
 
+        The marginal probabilities of the measured qubits are reduced on each
+        shard, so the wave function is never gathered.
+
         Args:
             indices: Which qubits are measured.
 
         Returns:
-            Measurement results with True corresponding to the |1> state.
-            The outer list is for repetitions, and the inner corresponds to
-            measurements ordered by the input indices.
+            Measurement results with True corresponding to the |1> state, as
+            a bool array of shape (repetitions, len(indices)). The rows are
+            the repetitions, and the columns correspond to the measurements
+            ordered by the input indices.
 
         Raises:
             ValueError if repetitions is less than one.
@@ -384,42 +837,88 @@ class Stepper(object):
 
                     repetitions))
         if len(indices) == 0:
-            return [[]]
+            return np.zeros((repetitions, 0), dtype=bool)
+        self._renormalize_before_measurement()
+
+        # A tensor with one axis per measured qubit, in the order of indices.
+        probs = np.zeros([2] * len(indices))
+        args = self._shard_num_args({'indices': indices})
+        shard_probs = self._pool.map(_marginal_probs_per_shard, args)
+        for shard_num, shard_prob in enumerate(shard_probs):
+            # Prefix qubits have a fixed value on each shard.
+            shard_slice = tuple(
+                (shard_num >> (index - self._num_shard_qubits)) & 1
+                if index >= self._num_shard_qubits else slice(None)
+                for index in indices)
+            probs[shard_slice] += shard_prob
+        probs = np.reshape(probs, -1)
+        # Account for any drift in the norm not corrected by renormalization.
+        probs /= np.sum(probs)
+
+        # The first index is the most significant bit of each sampled int.
+        result = np.random.choice(2 ** len(indices), size=repetitions, p=probs)
+        shifts = np.arange(len(indices) - 1, -1, -1)
+        return (result[:, np.newaxis] >> shifts) & 1 == 1
 
-        # Calculate probabilities and reshape to tensor of qubits.
-        tensor = np.reshape(np.abs(self.current_state) ** 2,
-                            self._num_qubits * [2])
+    @ensure_pool
+    def pauli_expectation(self, pauli_map: Dict[int, str]) -> float:
+        """Returns the expectation value of a product of Pauli operators.
 
-        # Tensor axis order is reverse of index order, so we transpose here.
-        tensor = np.transpose(tensor)
+        Each shard computes its part of <psi|P|psi> along with its norm, so
+        the wave function is never gathered. Shards are paired with the
+        shard that differs from them in the prefix qubits that P flips.
 
-        # Indices that should be summed over.
-        sum_indices = tuple(
-            x for x in range(self._num_qubits) if x not in indices)
+        Args:
+            pauli_map: A map from the index of a qubit to 'X', 'Y' or 'Z',
+                the Pauli operator acting on it. Qubits not in the map are
+                acted on by the identity.
+
+        Returns:
+            The expectation value, for the wave function normalized.
+
+        Raises:
+            ValueError if an index is out of range or an operator is not one
+            of 'X', 'Y' or 'Z'.
+        """
+        for index, pauli in pauli_map.items():
+            if not 0 <= index < self._num_qubits:
+                raise ValueError('Index {} out of range for {} qubits.'.format(
+                    index, self._num_qubits))
+            if pauli not in ('X', 'Y', 'Z'):
+                raise ValueError('Expected X, Y or Z but was {!r}.'.format(
+                    pauli))
+        self._renormalize_before_measurement()
+
+        # P = i^(number of Ys) times the X and Z parts, since Y = iXZ.
+        args = self._shard_num_args({
+            'x_indices': [i for i, p in pauli_map.items() if p != 'Z'],
+            'z_indices': [i for i, p in pauli_map.items() if p != 'X'],
+        })
+        values, norms = zip(*self._pool.map(_pauli_expectation_per_shard,
+                                            args))
+        num_y = sum(p == 'Y' for p in pauli_map.values())
+        return float(np.real(1j ** num_y * np.sum(values)) / np.sum(norms))
 
-        # Sum over those indices, and reshape into a a tensor of len(indices)
-        # qubits.
-        probs = np.reshape(np.sum(tensor, axis=sum_indices), [2] * len(indices))
 
-        # Calculate how the indices not summed over should be reordered.
-        index_map = {v: k for k,v in enumerate(sorted(indices))}
-        perm = [index_map[x] for x in indices]
-        # Apply this permutation to the probabilities and flatten.,
-        probs = np.reshape(np.transpose(probs, perm), -1)
+def choose_num_prefix_qubits(num_qubits: int,
+                             num_prefix_qubits: int = None,
+                             min_qubits_before_shard: int = 18) -> int:
+    """Returns the number of prefix qubits a Stepper will shard over.
 
-        # We now have the probability vector, correctly ordered, so sample over
-        # it. Note that we us ints here, since numpy's choice does not allow for
-        # choosing from a list of tuples or list of lists.
-        result = np.random.choice(2 ** len(indices), size=repetitions, p=probs)
-        # Convert to bools and note also one final reverse of list to get
-        # ordering correct.
-        return np.transpose(
-            [(1 & (result >> i)).astype(np.bool) for i in range(len(indices))][
-            ::-1]).tolist()
+    The arguments are those of the same name given to the Stepper.
+    """
+    if num_prefix_qubits is None:
+        num_prefix_qubits = int(math.log(multiprocessing.cpu_count(), 2))
+    if num_prefix_qubits > num_qubits:
+        num_prefix_qubits = num_qubits
+    if num_qubits < min_qubits_before_shard:
+        num_prefix_qubits = 0
+    return num_prefix_qubits
 
 
 def decode_initial_state(initial_state: Union[int, np.ndarray],
-                         num_qubits: int) -> np.ndarray:
+                         num_qubits: int,
+                         dtype: type = np.complex64) -> np.ndarray:
     """Verifies the initial_state is valid and converts it to ndarray form."""
     if isinstance(initial_state, np.ndarray):
         if len(initial_state) != 2 ** num_qubits:
@@ -429,46 +928,63 @@ def decode_initial_state(initial_state: Union[int, np.ndarray],
                     len(initial_state), num_qubits))
         state = initial_state
     elif isinstance(initial_state, int):
-        if initial_state < 0:
-            raise ValueError('initial_state must be positive')
-        elif initial_state >= 2 ** num_qubits:
-            raise ValueError(
-                'initial state was {} but expected state for {} qubits'.format(
-                    initial_state, num_qubits))
-        else:
-            state = np.zeros(2 ** num_qubits, dtype=np.complex64)
-            state[initial_state] = 1.0
+        check_basis_state(initial_state, num_qubits)
+        state = np.zeros(2 ** num_qubits, dtype=dtype)
+        state[initial_state] = 1.0
     else:
         raise TypeError('initial_state was not of type int or ndarray')
-    check_state(state, num_qubits)
+    check_state(state, num_qubits, dtype)
     return state
 
 
-def check_state(state: np.ndarray, num_qubits: int):
-    """Validates that the given state is a valid wave function."""
+def check_basis_state(basis_state: int, num_qubits: int):
+    """Validates that the given int is a computational basis state index."""
+    if basis_state < 0:
+        raise ValueError('initial_state must be positive')
+    if basis_state >= 2 ** num_qubits:
+        raise ValueError(
+            'initial state was {} but expected state for {} qubits'.format(
+                basis_state, num_qubits))
+
+
+def check_state(state: np.ndarray,
+                num_qubits: int,
+                dtype: type = np.complex64,
+                num_shards: int = 1):
+    """Validates that the given state is a valid wave function.
+
+    The norm is summed over num_shards equal parts of the state, so that only
+    a temporary array of the size of a part is needed.
+    """
     if state.size != 1 << num_qubits:
         raise ValueError(
             'State has incorrect size. Expected {} but was {}.'.format(
                 1 << num_qubits, state.size))
-    if state.dtype != np.complex64:
+    if state.dtype != dtype:
         raise ValueError(
             'State has invalid dtype. Expected {} but was {}'.format(
-                np.complex64, state.dtype))
-    norm = np.sum(np.abs(state) ** 2)
+                dtype, state.dtype))
+    norm = sum(np.sum(np.abs(shard) ** 2)
+               for shard in np.reshape(state, (num_shards, -1)))
     if not np.isclose(norm, 1):
         raise ValueError('State is not normalized instead had norm %s' % norm)
 
 
+def _real_dtype(dtype: type) -> type:
+    """The dtype of the real and imaginary parts of the given complex dtype."""
+    return np.finfo(dtype).dtype.type
+
+
 def _state_shard(args: Dict[str, Any]) -> np.ndarray:
     state_handle = args['state_handle']
     return mem_manager.SharedMemManager.get_array(state_handle).view(
-        dtype=np.complex64)[args['shard_num']]
+        dtype=args['dtype'])[args['shard_num']]
 
 
 def _scratch_shard(args: Dict[str, Any]) -> np.ndarray:
     scratch_handle = args['scratch_handle']
     return mem_manager.SharedMemManager.get_array(scratch_handle).view(
-        dtype=np.complex64)[args['shard_num']]
+        dtype=args['dtype'])[args['shard_num']]
 
 
 def _pm_vects(args: Dict[str, Any]) -> np.ndarray:
@@ -503,24 +1019,6 @@ def _clear_scratch(args: Dict[str, Any]):
     _scratch_shard(args).fill(0)
 
 
-def _single_qubit_accumulate_into_scratch(args: Dict[str, Any]):
-    """Accumulates single qubit phase gates into the scratch shards."""
-    index = args['indices'][0]
-    shard_num = args['shard_num']
-    half_turns = args['half_turns']
-    num_shard_qubits = args['num_shard_qubits']
-    scratch = _scratch_shard(args)
-
-    # ExpZ = exp(-i pi Z half_turns / 2).
-    if index >= num_shard_qubits:
-        # Acts on prefix qubits.
-        sign = 1 - 2 * _kth_bit(shard_num, index - num_shard_qubits)
-        scratch -= half_turns * sign
-    else:
-        # Acts on shard qubits.
-        scratch -= half_turns * _pm_vects(args)[index]
-
-
 def _one_projector(args: Dict[str, Any], index: int) -> Union[int, np.ndarray]:
     """Returns a projector onto the |1> subspace of the index-th qubit."""
     num_shard_qubits = args['num_shard_qubits']
@@ -530,23 +1028,88 @@ def _one_projector(args: Dict[str, Any], index: int) -> Union[int, np.ndarray]:
     return _zero_one_vects(args)[index]
 
 
-def _two_qubit_accumulate_into_scratch(args: Dict[str, Any]):
-    """Accumulates two qubit phase gates into the scratch shards."""
-    index0, index1 = args['indices']
-    half_turns = args['half_turns']
-    scratch = _scratch_shard(args)
+_PhaseProgram = NamedTuple('_PhaseProgram', [
+    ('constant', float),
+    ('linear', np.ndarray),
+    ('quadratic', List[Tuple[int, int, float]]),
+])
+
 
-    projector = _one_projector(args, index0) * _one_projector(args, index1)
-    # Exp11 = exp(-i pi |11><11| half_turns), but we accumulate phases as
-    # pi / 2.
-    scratch += 2 * half_turns * projector
+def _compile_phase_map(phase_map: Dict[Tuple[int, ...], float],
+                       shard_num: int,
+                       num_shard_qubits: int) -> _PhaseProgram:
+    """Compiles the phase map into the phase program for a shard.
 
+    The phase applied to an amplitude is exp(i pi / 2 p(z)) where z are the
+    bits of the amplitude's index and p is a polynomial that is quadratic in
+    these bits. Within a shard the bits of the prefix qubits are fixed, so
+    terms involving them reduce to constant or linear terms. The compiled
+    program holds the constant term, the coefficients of the linear terms in
+    the shard bits, and a list of (index0, index1, coefficient) for the
+    quadratic terms in the shard bits.
 
-def _apply_scratch_as_phase(args: Dict[str, Any]):
-    """Takes scratch shards and applies them as exponentiated phase to state.
+    Args:
+        phase_map: The phase map, see Stepper.simulate_phases.
+        shard_num: The shard to compile the phase map for.
+        num_shard_qubits: The number of qubits in a shard.
+
+    Returns:
+        The compiled _PhaseProgram.
     """
+    def prefix_bit(index):
+        return _kth_bit(shard_num, index - num_shard_qubits)
+
+    constant = 0.0
+    linear = np.zeros(num_shard_qubits)
+    quadratic = []  # type: List[Tuple[int, int, float]]
+    for indices, half_turns in phase_map.items():
+        if len(indices) == 1:
+            # ExpZ = exp(-i pi Z half_turns / 2) and Z = 1 - 2 z.
+            index = indices[0]
+            constant -= half_turns
+            if index >= num_shard_qubits:
+                constant += 2 * half_turns * prefix_bit(index)
+            else:
+                linear[index] += 2 * half_turns
+        elif len(indices) == 2:
+            # Exp11 = exp(-i pi |11><11| half_turns), but we accumulate phases
+            # as pi / 2.
+            shard_indices = [i for i in indices if i < num_shard_qubits]
+            coefficient = 2 * half_turns
+            for index in indices:
+                if index >= num_shard_qubits:
+                    coefficient *= prefix_bit(index)
+            if not coefficient:
+                continue
+            if len(shard_indices) == 0:
+                constant += coefficient
+            elif len(shard_indices) == 1:
+                linear[shard_indices[0]] += coefficient
+            else:
+                quadratic.append((shard_indices[0],
+                                  shard_indices[1],
+                                  coefficient))
+    return _PhaseProgram(constant, linear, quadratic)
+
+
+def _apply_phase_program(args: Dict[str, Any]):
+    """Applies the compiled phase program of the shard to the state shard.
+
+    The phases are computed and applied chunk by chunk, so the whole phase map
+    takes a single pass over the state shard.
+    """
+    program = args['phase_program']
     state = _state_shard(args)
-    state *= np.exp(I_PI_OVER_2 * _scratch_shard(args))
+    zero_one_vects = _zero_one_vects(args)
+    linear_indices = np.nonzero(program.linear)[0]
+    linear = program.linear[linear_indices]
+    for start in range(0, len(state), _PHASE_CHUNK_SIZE):
+        end = start + _PHASE_CHUNK_SIZE
+        bits = zero_one_vects[:, start:end]
+        phases = np.dot(linear, bits[linear_indices]) + program.constant
+        for index0, index1, coefficient in program.quadratic:
+            phases += coefficient * (bits[index0] & bits[index1])
+        state[start:end] *= np.exp(I_PI_OVER_2 * phases)
 
 
 def _w_within_shard(args: Dict[str, Any]):
@@ -585,7 +1148,7 @@ def _w_between_shards(args: Dict[str, Any]):
 
     perm_index = shard_num ^ (1 << (index - num_shard_qubits))
     perm_state = mem_manager.SharedMemManager.get_array(
-        args['state_handle']).view(np.complex64)[perm_index]
+        args['state_handle']).view(args['dtype'])[perm_index]
 
     cos = np.cos(-0.5 * np.pi * half_turns)
     sin = np.sin(-0.5 * np.pi * half_turns)
@@ -599,11 +1162,104 @@ def _w_between_shards(args: Dict[str, Any]):
               (cos_axis - 1j * sin_axis * z_op))
 
 
+def _w_between_shard_pair(args: Dict[str, Any]):
+    """Applies a W gate between shards in place on a pair of shards.
+
+    The shard given by shard_num must have a zero for the bit of the prefix
+    qubit that the gate acts on, and both it and its partner shard, which has
+    a one for this bit, are updated.
+    """
+    shard_num = args['shard_num']
+    index = args['index']
+    half_turns = args['half_turns']
+    axis_half_turns = args['axis_half_turns']
+
+    states = mem_manager.SharedMemManager.get_array(
+        args['state_handle']).view(args['dtype'])
+    state0 = states[shard_num]
+    state1 = states[shard_num ^ (1 << (index - args['num_shard_qubits']))]
+
+    cos = np.cos(-0.5 * np.pi * half_turns)
+    sin = np.sin(-0.5 * np.pi * half_turns)
+
+    cos_axis = np.cos(np.pi * axis_half_turns)
+    sin_axis = np.sin(np.pi * axis_half_turns)
+
+    new_state0 = state0 * cos + 1j * sin * state1 * (cos_axis - 1j * sin_axis)
+    np.copyto(state1,
+              state1 * cos + 1j * sin * state0 * (cos_axis + 1j * sin_axis))
+    np.copyto(state0, new_state0)
+
+
+def _matrix_on_shards(args: Dict[str, Any]):
+    """Applies a unitary matrix in place to a group of shards.
+
+    The matrix acts on the qubits at args['indices'], with the first index
+    the most significant bit of the matrix basis. If some of these are prefix
+    qubits, the shard given by shard_num must have zeros for them, and the
+    matrix is applied across the group of shards that differ from it only in
+    these qubits.
+    """
+    shard_num = args['shard_num']
+    num_shard_qubits = args['num_shard_qubits']
+    indices = args['indices']
+    states = mem_manager.SharedMemManager.get_array(
+        args['state_handle']).view(args['dtype'])
+
+    prefix_bits = [index - num_shard_qubits for index in indices
+                   if index >= num_shard_qubits]
+    num_group_bits = len(prefix_bits)
+    # The j-th prefix bit is the j-th most significant bit of the position of
+    # a shard in the group.
+    shard_nums = [
+        shard_num | sum(_kth_bit(g, num_group_bits - 1 - j) << bit
+                        for j, bit in enumerate(prefix_bits))
+        for g in range(2 ** num_group_bits)]
+    tensor = np.reshape(states[shard_nums],
+                        [2] * (num_group_bits + num_shard_qubits))
+    # Within a shard, tensor axis order is the reverse of index order.
+    axes = [prefix_bits.index(index - num_shard_qubits)
+            if index >= num_shard_qubits
+            else num_group_bits + num_shard_qubits - 1 - index
+            for index in indices]
+
+    num_indices = len(indices)
+    matrix = np.reshape(args['matrix'], [2] * (2 * num_indices))
+    result = np.tensordot(matrix, tensor,
+                          axes=(list(range(num_indices, 2 * num_indices)),
+                                axes))
+    result = np.moveaxis(result, list(range(num_indices)), axes)
+    states[shard_nums] = np.reshape(result, (len(shard_nums), -1))
+
+
 def _copy_scratch_to_state(args: Dict[str, Any]):
     """Copes scratch shards to state shards."""
     np.copyto(_state_shard(args), _scratch_shard(args))
 
 
+def _moment_within_shard(args: Dict[str, Any]) -> float:
+    """Applies the part of a moment that acts within a shard.
+
+    If copy_scratch is set the scratch shard, holding the result of a W gate
+    between shards, is first copied to the state. Then the W gates acting
+    within the shard and the compiled phase program, if any, is applied.
+
+    Returns:
+        The norm squared of the state shard after applying the moment if
+        compute_norm is set, otherwise zero.
+    """
+    if args['copy_scratch']:
+        _copy_scratch_to_state(args)
+    for index, half_turns, axis_half_turns in args['w_ops']:
+        _w_within_shard(dict(args,
+                             index=index,
+                             half_turns=half_turns,
+                             axis_half_turns=axis_half_turns))
+    if args['phase_program'] is not None:
+        _apply_phase_program(args)
+    return _norm_squared(args) if args['compute_norm'] else 0.0
+
+
 def _one_prob_per_shard(args: Dict[str, Any]) -> float:
     """Returns the probability of getting a one measurement on a state shard.
     """
@@ -614,6 +1270,66 @@ def _one_prob_per_shard(args: Dict[str, Any]) -> float:
     return norm * norm
 
 
+def _marginal_probs_per_shard(args: Dict[str, Any]) -> np.ndarray:
+    """Returns the probabilities of measurement results on a state shard.
+
+    The returned tensor has an axis for each of the measured qubits in
+    args['indices'] that are not prefix qubits, in the same order, and sums
+    over all of the other qubits of the shard.
+    """
+    num_shard_qubits = args['num_shard_qubits']
+    state = _state_shard(args)
+    tensor = np.reshape(state.real ** 2 + state.imag ** 2,
+                        [2] * num_shard_qubits)
+    # Tensor axis order is the reverse of index order.
+    axes = [num_shard_qubits - 1 - index for index in args['indices']
+            if index < num_shard_qubits]
+    tensor = np.sum(tensor, axis=tuple(
+        axis for axis in range(num_shard_qubits) if axis not in axes))
+    # The remaining axes are in increasing order, so permute them into the
+    # order of the indices.
+    remaining = sorted(axes)
+    return np.transpose(tensor, [remaining.index(axis) for axis in axes])
+
+
+def _pauli_expectation_per_shard(args: Dict[str, Any]
+                                  ) -> Tuple[complex, float]:
+    """Returns a state shard's part of the expectation value of a Pauli.
+
+    The Pauli operator is X on the qubits at args['x_indices'] times Z on the
+    qubits at args['z_indices'], and its part is the sum over the amplitudes
+    of the shard of conj(<j|P|psi>) <j|psi>. The norm squared of the shard is
+    also returned.
+    """
+    shard_num = args['shard_num']
+    num_shard_qubits = args['num_shard_qubits']
+    states = mem_manager.SharedMemManager.get_array(
+        args['state_handle']).view(args['dtype'])
+    state = states[shard_num]
+
+    x_prefix = sum(1 << (index - num_shard_qubits)
+                   for index in args['x_indices']
+                   if index >= num_shard_qubits)
+    partner = states[shard_num ^ x_prefix]
+    # Tensor axis order is the reverse of index order.
+    x_axes = [num_shard_qubits - 1 - index for index in args['x_indices']
+              if index < num_shard_qubits]
+    if x_axes:
+        flip = tuple(slice(None, None, -1) if axis in x_axes else slice(None)
+                     for axis in range(num_shard_qubits))
+        partner = np.reshape(
+            np.reshape(partner, [2] * num_shard_qubits)[flip], -1)
+
+    z_indices = [index for index in args['z_indices']
+                 if index < num_shard_qubits]
+    sign = (-1) ** sum(_kth_bit(shard_num, index - num_shard_qubits)
+                       for index in args['z_indices']
+                       if index >= num_shard_qubits)
+    signed_state = (state * np.prod(_pm_vects(args)[z_indices], axis=0)
+                    if z_indices else state)
+    return sign * np.vdot(partner, signed_state), _norm_squared(args)
+
+
 def _norm_squared(args: Dict[str, Any]) -> float:
     """Returns the norm for each state shard."""
     state = _state_shard(args)
@@ -19,7 +19,7 @@ import multiprocessing.pool as pool
 import numpy as np
 import pytest
 
-from cirq.google.sim import xmon_stepper
+from cirq.google.sim import mem_manager, xmon_stepper
 
 
 def test_no_thread_pool():
@@ -170,17 +170,274 @@ def test_reset_state_wrong_dtype(num_prefix_qubits):
 
 
 @pytest.mark.parametrize('num_prefix_qubits', (0, 2))
-def test_reset_state_outside_of_context(num_prefix_qubits):
+def test_reset_state_out_of_range(num_prefix_qubits):
     with xmon_stepper.Stepper(
         num_qubits=3,
         num_prefix_qubits=num_prefix_qubits,
         initial_state=0,
         min_qubits_before_shard=0) as s:
-        pass
+        with pytest.raises(ValueError):
+            s.reset_state(8)
+        with pytest.raises(ValueError):
+            s.reset_state(-1)
+
+
+@pytest.mark.parametrize('num_prefix_qubits', (0, 2))
+def test_reset_state_complex128(num_prefix_qubits):
+    reset_state = np.array([0.5, 0.5, 0.5, 0.5, 0, 0, 0, 0],
+                           dtype=np.complex128)
+    with xmon_stepper.Stepper(
+        num_qubits=3,
+        num_prefix_qubits=num_prefix_qubits,
+        initial_state=0,
+        min_qubits_before_shard=0,
+        dtype=np.complex128) as s:
+        s.reset_state(reset_state)
+        assert s.current_state.dtype == np.complex128
+        np.testing.assert_almost_equal(reset_state, s.current_state)
+        with pytest.raises(ValueError):
+            s.reset_state(reset_state.astype(np.complex64))
+
+
+def test_unsupported_dtype():
+    with pytest.raises(ValueError):
+        xmon_stepper.Stepper(num_qubits=3, dtype=np.float64)
+
+
+@pytest.mark.parametrize('num_prefix_qubits,use_processes',
+                         ((0, False), (2, False), (2, True)))
+def test_get_state(num_prefix_qubits, use_processes):
+    with xmon_stepper.Stepper(
+        num_qubits=3,
+        num_prefix_qubits=num_prefix_qubits,
+        initial_state=0,
+        min_qubits_before_shard=0,
+        use_processes=use_processes) as s:
+        view = s.get_state(copy=False)
+        copy = s.get_state()
+        assert not view.flags.writeable
+        assert copy.flags.writeable
+        s.simulate_w(2, 1.0, 0)
+        expected = np.zeros(8, dtype=np.complex64)
+        expected[4] = -1j
+        np.testing.assert_almost_equal(view, expected)
+        np.testing.assert_almost_equal(copy, np.eye(8)[0])
+
+
+@pytest.mark.parametrize('num_prefix_qubits,use_processes',
+                         ((0, False), (2, False), (2, True)))
+def test_state_directory(num_prefix_qubits, use_processes, tmpdir):
+    with xmon_stepper.Stepper(
+        num_qubits=3,
+        num_prefix_qubits=num_prefix_qubits,
+        initial_state=1,
+        min_qubits_before_shard=0,
+        use_processes=use_processes,
+        state_directory=str(tmpdir)) as s:
+        # One file for the state and one for the scratch pad.
+        assert len(tmpdir.listdir()) == 2
+        s.simulate_moment(w_ops=[(2, 1.0, 0), (0, 0.5, 0)])
+        expected = np.zeros(8, dtype=np.complex64)
+        expected[4] = -1 / np.sqrt(2)
+        expected[5] = -1j / np.sqrt(2)
+        np.testing.assert_almost_equal(s.current_state, expected)
+    del s
+    assert not tmpdir.listdir()
+
+
+@pytest.mark.parametrize('num_prefix_qubits', (0, 2))
+def test_state_directory_initial_state(num_prefix_qubits, tmpdir):
+    initial_state = np.zeros(8, dtype=np.complex64)
+    initial_state[6] = 1j
+    s = xmon_stepper.Stepper(num_qubits=3,
+                             num_prefix_qubits=num_prefix_qubits,
+                             initial_state=initial_state,
+                             min_qubits_before_shard=0,
+                             state_directory=str(tmpdir))
+    np.testing.assert_almost_equal(s.current_state, initial_state)
+    s.__exit__()
+    del s
+
+    # Invalid initial states are rejected before any file is created. The
+    # traceback keeps the stepper alive, so its files would still exist.
+    with pytest.raises(ValueError, match='normalized') as not_normalized:
+        xmon_stepper.Stepper(num_qubits=3,
+                             num_prefix_qubits=num_prefix_qubits,
+                             initial_state=2 * initial_state,
+                             min_qubits_before_shard=0,
+                             state_directory=str(tmpdir))
+    with pytest.raises(ValueError, match='initial state') as too_large:
+        xmon_stepper.Stepper(num_qubits=3,
+                             num_prefix_qubits=num_prefix_qubits,
+                             initial_state=8,
+                             min_qubits_before_shard=0,
+                             state_directory=str(tmpdir))
+    assert not_normalized.traceback and too_large.traceback
+    assert not tmpdir.listdir()
+    # Break the reference cycles through the tracebacks.
+    del not_normalized, too_large
+
+
+@pytest.mark.parametrize('num_prefix_qubits', (0, 2))
+def test_memory_usage(num_prefix_qubits):
+    total = mem_manager.SharedMemManager.total_usage()
+    s = xmon_stepper.Stepper(num_qubits=3,
+                             num_prefix_qubits=num_prefix_qubits,
+                             min_qubits_before_shard=0)
+    usage = s.memory_usage
+    # The state, the scratch pad and the two z vector tables.
+    assert usage.count == 4
+    assert usage.live_bytes >= 2 * 8 * np.dtype(np.complex64).itemsize
+    assert mem_manager.SharedMemManager.total_usage().count == (
+        total.count + 4)
+    del s
+    assert mem_manager.SharedMemManager.total_usage().count == total.count
+
+
+@pytest.mark.parametrize('num_prefix_qubits', (0, 2))
+def test_low_memory(num_prefix_qubits):
+    initial_state = np.arange(1, 17, dtype=np.complex64)
+    initial_state /= np.linalg.norm(initial_state)
+    w_ops = [(3, 0.25, 0.125), (2, 0.5, 0.5), (0, 0.75, 0.25)]
+    states = []
+    for low_memory in (False, True):
+        with xmon_stepper.Stepper(num_qubits=4,
+                                  num_prefix_qubits=num_prefix_qubits,
+                                  initial_state=initial_state,
+                                  min_qubits_before_shard=0,
+                                  low_memory=low_memory) as s:
+            s.simulate_w(3, 0.5, 0.25)
+            s.simulate_w(1, 0.25, 0.5)
+            s.simulate_moment(w_ops=w_ops, phase_map={(0, 3): 0.5})
+            states.append(s.current_state)
+            # The low memory stepper does not have a scratch pad.
+            assert s.memory_usage.count == (3 if low_memory else 4)
+    np.testing.assert_almost_equal(states[1], states[0])
+
+
+def random_unitary(dim):
+    q, _ = np.linalg.qr(np.random.randn(dim, dim) +
+                        1j * np.random.randn(dim, dim))
+    return q
+
+
+@pytest.mark.parametrize('num_prefix_qubits,low_memory',
+                         ((0, False), (2, False), (2, True)))
+def test_apply_matrix(num_prefix_qubits, low_memory):
+    np.random.seed(7)
+    initial_state = random_unitary(16)[:, 0].astype(np.complex128)
+    with xmon_stepper.Stepper(num_qubits=4,
+                              num_prefix_qubits=num_prefix_qubits,
+                              initial_state=initial_state,
+                              min_qubits_before_shard=0,
+                              dtype=np.complex128,
+                              low_memory=low_memory) as s:
+        # The state as a tensor has an axis for each qubit, with the axis of
+        # index 3 first.
+        expected = np.reshape(initial_state, [2] * 4)
+        for index in range(4):
+            matrix = random_unitary(2)
+            s.apply_1q_matrix(index, matrix)
+            expected = np.moveaxis(
+                np.tensordot(matrix, expected, axes=(1, 3 - index)),
+                0, 3 - index)
+        for index0, index1 in itertools.permutations(range(4), 2):
+            matrix = random_unitary(4)
+            s.apply_2q_matrix(index0, index1, matrix)
+            expected = np.moveaxis(
+                np.tensordot(np.reshape(matrix, [2] * 4), expected,
+                             axes=((2, 3), (3 - index0, 3 - index1))),
+                (0, 1), (3 - index0, 3 - index1))
+        np.testing.assert_almost_equal(s.current_state,
+                                       np.reshape(expected, 16))
+
+        matrix = random_unitary(2)
+        before = s.current_state
+        s.simulate_moment(w_ops=[(0, 0.5, 0)], matrix_ops=[((3,), matrix)])
+        s.apply_1q_matrix(3, matrix.conj().T)
+        s.simulate_w(0, -0.5, 0)
+        np.testing.assert_almost_equal(s.current_state, before)
+
+        with pytest.raises(ValueError):
+            s.apply_2q_matrix(0, 1, random_unitary(2))
+
+
+@pytest.mark.parametrize('num_prefix_qubits', (0, 2))
+def test_reset_state_outside_of_context(num_prefix_qubits):
+    s = xmon_stepper.Stepper(
+        num_qubits=3,
+        num_prefix_qubits=num_prefix_qubits,
+        initial_state=0,
+        min_qubits_before_shard=0)
     s.reset_state(3)
     expected = np.zeros(2 ** 3, dtype=np.complex64)
     expected[3] = 1.0
     np.testing.assert_almost_equal(expected, s.current_state)
+    s.close()
+
+    with xmon_stepper.Stepper(
+        num_qubits=3,
+        num_prefix_qubits=num_prefix_qubits,
+        initial_state=0,
+        min_qubits_before_shard=0) as s:
+        pass
+    with pytest.raises(ValueError, match='closed'):
+        s.reset_state(3)
+    with pytest.raises(ValueError, match='closed'):
+        _ = s.current_state
+
+
+@pytest.mark.parametrize('num_prefix_qubits', (0, 2))
+def test_handles_stale_after_context_exits(num_prefix_qubits):
+    with xmon_stepper.Stepper(
+        num_qubits=3,
+        num_prefix_qubits=num_prefix_qubits,
+        initial_state=0,
+        min_qubits_before_shard=0) as s:
+        handles = [h for k, h in s._shared_mem_dict.items()
+                   if k.endswith('_handle')]
+    # A new stepper reuses the freed array indices, but the handles of the
+    # closed stepper do not alias its arrays.
+    with xmon_stepper.Stepper(
+        num_qubits=3,
+        num_prefix_qubits=num_prefix_qubits,
+        initial_state=5,
+        min_qubits_before_shard=0) as other:
+        for handle in handles:
+            with pytest.raises(ValueError, match='freed'):
+                mem_manager.SharedMemManager.get_array(handle)
+        assert other.current_state[5] == 1
+
+
+@pytest.mark.parametrize('num_prefix_qubits', (0, 2))
+def test_close(num_prefix_qubits):
+    with xmon_stepper.Stepper(
+        num_qubits=3,
+        num_prefix_qubits=num_prefix_qubits,
+        initial_state=0,
+        min_qubits_before_shard=0) as s:
+        assert s.memory_usage.count == 4
+    # Exiting the context frees the memory.
+    assert s.memory_usage.count == 0
+    with pytest.raises(ValueError, match='closed'):
+        s.reset_state(3)
+    with pytest.raises(ValueError, match='closed'):
+        _ = s.current_state
+    with pytest.raises(ValueError, match='closed'):
+        s.__enter__()
+
+    # Closing twice, or deleting a closed stepper, frees nothing else.
+    other = xmon_stepper.Stepper(num_qubits=3,
+                                 num_prefix_qubits=num_prefix_qubits,
+                                 initial_state=1,
+                                 min_qubits_before_shard=0)
+    total = mem_manager.SharedMemManager.total_usage().count
+    s.close()
+    del s
+    assert mem_manager.SharedMemManager.total_usage().count == total
+    assert other.current_state[1] == 1
+    other.close()
+    assert other.memory_usage.count == 0
 
 
 @pytest.mark.parametrize('num_prefix_qubits', (0, 2))
@@ -388,6 +645,115 @@ def test_multiple_phases(num_prefix_qubits):
     np.testing.assert_almost_equal(result, expected)
 
 
+@pytest.mark.parametrize('num_prefix_qubits', (0, 2))
+def test_many_phases_chunked(num_prefix_qubits, monkeypatch):
+    phase_map = {
+        (0,): 0.1,
+        (1,): -0.7,
+        (2,): 0.3,
+        (0, 1): 0.25,
+        (1, 2): -0.5,
+        (2, 0): 0.9,
+    }
+    expected = compute_phases_matrix(num_prefix_qubits, phase_map)
+    monkeypatch.setattr(xmon_stepper, '_PHASE_CHUNK_SIZE', 2)
+    result = compute_phases_matrix(num_prefix_qubits, phase_map)
+    np.testing.assert_almost_equal(result, expected)
+
+    zero_one = lambda k, i: (k >> i) & 1
+    phases = [
+        sum(-h * (1 - 2 * zero_one(k, i[0])) for i, h in phase_map.items()
+            if len(i) == 1) +
+        sum(2 * h * zero_one(k, i[0]) * zero_one(k, i[1])
+            for i, h in phase_map.items() if len(i) == 2)
+        for k in range(8)
+    ]
+    np.testing.assert_almost_equal(
+        result, np.diag(np.exp(0.5j * np.pi * np.array(phases))), decimal=6)
+
+
+def test_compile_phase_map():
+    phase_map = {(0,): 0.5, (2,): 0.25, (0, 1): 1.0, (1, 2): 0.5, (2, 3): 1.0}
+    program = xmon_stepper._compile_phase_map(phase_map,
+                                              shard_num=0,
+                                              num_shard_qubits=2)
+    assert program.constant == -0.75
+    np.testing.assert_equal(program.linear, [1.0, 0.0])
+    assert program.quadratic == [(0, 1, 2.0)]
+
+    # Prefix qubit 2 is set in shard 1, prefix qubit 3 in shard 2.
+    program = xmon_stepper._compile_phase_map(phase_map,
+                                              shard_num=3,
+                                              num_shard_qubits=2)
+    assert program.constant == -0.75 + 0.5 + 2.0
+    np.testing.assert_equal(program.linear, [1.0, 1.0])
+    assert program.quadratic == [(0, 1, 2.0)]
+
+
+def test_phase_program_cache(monkeypatch):
+    monkeypatch.setattr(xmon_stepper, '_PHASE_PROGRAM_CACHE_SIZE', 2)
+    with xmon_stepper.Stepper(num_qubits=3,
+                              num_prefix_qubits=1,
+                              min_qubits_before_shard=0) as s:
+        s.simulate_phases({(0,): 0.5, (1, 2): 0.5})
+        s.simulate_phases({(1, 2): 0.5, (0,): 0.5})
+        assert len(s._phase_program_cache) == 1
+        s.simulate_phases({(0,): 0.25})
+        s.simulate_phases({(0,): 0.5, (1, 2): 0.5})
+        s.simulate_phases({(1,): 0.25})
+        assert list(s._phase_program_cache.keys()) == [
+            frozenset({(0,): 0.5, (1, 2): 0.5}.items()),
+            frozenset({(1,): 0.25}.items()),
+        ]
+
+
+@pytest.mark.parametrize('num_prefix_qubits', (0, 2))
+def test_simulate_moment_matches_individual_gates(num_prefix_qubits):
+    w_ops = [(0, 0.3, 0.1), (2, 0.7, 0.4)]
+    phase_map = {(1,): 0.25}
+
+    def individual(s):
+        for index, half_turns, axis_half_turns in w_ops:
+            s.simulate_w(index, half_turns, axis_half_turns)
+        s.simulate_phases(phase_map)
+
+    result = compute_matrix(
+        num_prefix_qubits,
+        fn=lambda s: s.simulate_moment(w_ops=w_ops, phase_map=phase_map))
+    expected = compute_matrix(num_prefix_qubits, fn=individual)
+    np.testing.assert_almost_equal(result, expected)
+
+
+@pytest.mark.parametrize('num_prefix_qubits', (0, 2))
+def test_simulate_moment_multiple_ws_between_shards(num_prefix_qubits):
+    w_ops = [(0, 0.2, 0.0), (1, 0.5, 0.25), (2, 0.9, 0.5)]
+
+    def individual(s):
+        for index, half_turns, axis_half_turns in w_ops:
+            s.simulate_w(index, half_turns, axis_half_turns)
+
+    result = compute_matrix(num_prefix_qubits,
+                            fn=lambda s: s.simulate_moment(w_ops=w_ops))
+    expected = compute_matrix(num_prefix_qubits, fn=individual)
+    np.testing.assert_almost_equal(result, expected)
+
+
+@pytest.mark.parametrize('num_prefix_qubits', (0, 2))
+def test_simulate_moment_measurements(num_prefix_qubits):
+    with xmon_stepper.Stepper(num_qubits=3,
+                              num_prefix_qubits=num_prefix_qubits,
+                              min_qubits_before_shard=0) as s:
+        results = s.simulate_moment(w_ops=[(0, 1.0, 0), (2, 1.0, 0)],
+                                    measurement_indices=[1])
+        assert results == [False]
+        results = s.simulate_moment(measurement_indices=[2, 1, 0])
+        assert results == [True, False, True]
+        assert s.simulate_moment() == []
+        expected = np.zeros(2 ** 3, dtype=np.complex64)
+        expected[5] = -1.0
+        np.testing.assert_almost_equal(s.current_state, expected)
+
+
 def compute_xy_matrix(num_prefix_qubits, index, turns,
                       rotation_axis_turns):
     return compute_matrix(
@@ -469,6 +835,28 @@ def test_measurement_state_update(num_prefix_qubits):
         np.testing.assert_almost_equal(expected, s.current_state)
 
 
+@pytest.mark.parametrize('num_prefix_qubits', (0, 2))
+def test_project(num_prefix_qubits):
+    with xmon_stepper.Stepper(num_qubits=3,
+                              num_prefix_qubits=num_prefix_qubits,
+                              min_qubits_before_shard=0) as s:
+        # 1/sqrt(2)(I+iX) gate.
+        for i in range(3):
+            s.simulate_w(i, -0.5, 0)
+        single_qubit_state = np.array([1, 1j]) / np.sqrt(2)
+        two_qubit_state = np.kron(single_qubit_state, single_qubit_state)
+        s.project(0, True)
+        expected = np.kron(two_qubit_state, np.array([0, 1j])).flatten()
+        np.testing.assert_almost_equal(expected, s.current_state)
+        s.project(2, False)
+        expected = np.kron(np.array([1, 0]),
+                           np.kron(single_qubit_state,
+                                   np.array([0, 1j]))).flatten()
+        np.testing.assert_almost_equal(expected, s.current_state)
+        with pytest.raises(ValueError):
+            s.project(2, True)
+
+
 @pytest.mark.parametrize('num_prefix_qubits', (0, 2))
 def test_measurement_randomness_sanity(num_prefix_qubits):
     np.random.seed(15)
@@ -507,7 +895,7 @@ def test_sample_little_endian(num_prefix_qubits):
             s.reset_state(x)
             # We ask for ordering of most significant bit first. This is
             # easier to test against the natural order of itertools.product.
-            results.append(s.sample_measurements([2, 1, 0]))
+            results.append(s.sample_measurements([2, 1, 0]).tolist())
         expected = [[list(x)] for x in
                     list(itertools.product([False, True], repeat=3))]
         assert results == expected
@@ -521,7 +909,7 @@ def test_sample_partial_indices(num_prefix_qubits):
         for index in range(3):
             for x in range(8):
                 s.reset_state(x)
-                assert s.sample_measurements([index]) == [[
+                assert s.sample_measurements([index]).tolist() == [[
                     bool(1 & (x >> index))]]
 
 
@@ -533,7 +921,7 @@ def test_sample_partial_indices_order(num_prefix_qubits):
         for x in range(8):
             s.reset_state(x)
             expected = [[bool(1 & (x >> 2)), bool(1 & (x >> 1))]]
-            assert s.sample_measurements([2, 1]) == expected
+            assert s.sample_measurements([2, 1]).tolist() == expected
 
 
 
@@ -546,7 +934,7 @@ def test_sample_partial_indices_all_orders(num_prefix_qubits):
             for x in range(8):
                 s.reset_state(x)
                 expected = [[bool(1 & (x >> p)) for p in perm]]
-                assert s.sample_measurements(perm) == expected
+                assert s.sample_measurements(perm).tolist() == expected
 
 
 @pytest.mark.parametrize('num_prefix_qubits', (0, 2))
@@ -560,12 +948,12 @@ def test_sample(num_prefix_qubits):
         s.reset_state(initial_state)
         # Full sample only returns non-zero terms.
         for _ in range(10):
-            assert s.sample_measurements([2, 1, 0]) in [[[False, False, False]],
-                                                        [[False, True, False]]]
+            assert s.sample_measurements([2, 1, 0]).tolist() in [
+                [[False, False, False]], [[False, True, False]]]
         # Partial sample is correct.
         for _ in range(10):
-            assert s.sample_measurements([2]) == [[False]]
-            assert s.sample_measurements([0]) == [[False]]
+            assert s.sample_measurements([2]).tolist() == [[False]]
+            assert s.sample_measurements([0]).tolist() == [[False]]
 
 
 @pytest.mark.parametrize('num_prefix_qubits', (0, 2))
@@ -578,7 +966,63 @@ def test_sample_repetitions(num_prefix_qubits):
                 s.reset_state(x)
                 expected = [[bool(1 & (x >> p)) for p in perm]] * 3
                 result = s.sample_measurements(perm, repetitions=3)
-                assert result == expected
+                assert result.dtype == bool
+                assert result.tolist() == expected
+
+
+@pytest.mark.parametrize('num_prefix_qubits', (0, 1, 2, 3))
+def test_sample_marginal_probabilities(num_prefix_qubits):
+    np.random.seed(5)
+    with xmon_stepper.Stepper(num_qubits=3,
+                              num_prefix_qubits=num_prefix_qubits,
+                              min_qubits_before_shard=0) as s:
+        # Probabilities of 1/10, 2/10, 3/10 and 4/10 for qubits 2 and 0 being
+        # in 00, 01, 10 and 11, with qubit 1 in the |1> state.
+        initial_state = np.zeros(8, dtype=np.complex64)
+        initial_state[0b010] = np.sqrt(0.1)
+        initial_state[0b011] = np.sqrt(0.2) * 1j
+        initial_state[0b110] = np.sqrt(0.3)
+        initial_state[0b111] = -np.sqrt(0.4)
+        s.reset_state(initial_state)
+        result = s.sample_measurements([2, 1, 0], repetitions=10000)
+        assert result.shape == (10000, 3)
+        assert np.all(result[:, 1])
+        counts = np.bincount(2 * result[:, 0] + result[:, 2], minlength=4)
+        np.testing.assert_allclose(counts / 10000, [0.1, 0.2, 0.3, 0.4],
+                                   atol=0.02)
+
+
+@pytest.mark.parametrize('num_prefix_qubits', (0, 1, 2, 3))
+def test_pauli_expectation(num_prefix_qubits):
+    np.random.seed(7)
+    paulis = {'I': np.eye(2),
+              'X': np.array([[0, 1], [1, 0]]),
+              'Y': np.array([[0, -1j], [1j, 0]]),
+              'Z': np.diag([1, -1])}
+    state = np.random.randn(8) + 1j * np.random.randn(8)
+    state = (state / np.linalg.norm(state)).astype(np.complex128)
+    with xmon_stepper.Stepper(num_qubits=3,
+                              num_prefix_qubits=num_prefix_qubits,
+                              min_qubits_before_shard=0,
+                              dtype=np.complex128) as s:
+        s.reset_state(state)
+        for labels in itertools.product('IXYZ', repeat=3):
+            pauli_map = {i: label for i, label in enumerate(labels)
+                         if label != 'I'}
+            # The first qubit of the kron product is the most significant bit.
+            matrix = np.kron(np.kron(paulis[labels[2]], paulis[labels[1]]),
+                             paulis[labels[0]])
+            expected = np.real(np.vdot(state, matrix.dot(state)))
+            np.testing.assert_almost_equal(s.pauli_expectation(pauli_map),
+                                           expected)
+
+
+def test_pauli_expectation_invalid():
+    with xmon_stepper.Stepper(num_qubits=3) as s:
+        with pytest.raises(ValueError, match='out of range'):
+            s.pauli_expectation({3: 'X'})
+        with pytest.raises(ValueError, match='W'):
+            s.pauli_expectation({0: 'W'})
 
 
 @pytest.mark.parametrize('num_prefix_qubits', (0, 2))
@@ -595,7 +1039,8 @@ def test_no_indices(num_prefix_qubits):
     with xmon_stepper.Stepper(num_qubits=3,
                               num_prefix_qubits=num_prefix_qubits,
                               min_qubits_before_shard=0) as s:
-        np.testing.assert_equal(s.sample_measurements([]), [[]])
+        assert s.sample_measurements([]).shape == (1, 0)
+        assert s.sample_measurements([], repetitions=3).shape == (3, 0)
 
 
 @pytest.mark.parametrize('num_prefix_qubits', (0, 2))
@@ -759,6 +1204,44 @@ def test_precision(num_prefix_qubits):
                                        decimal=7)
 
 
+@pytest.mark.parametrize('num_prefix_qubits', (0, 2))
+def test_precision_complex128(num_prefix_qubits):
+    # Same as test_precision, but with a floating point epsilon of about 2e-16.
+    with xmon_stepper.Stepper(num_qubits=5,
+                              num_prefix_qubits=num_prefix_qubits,
+                              min_qubits_before_shard=0,
+                              dtype=np.complex128) as s:
+        half_turns_list = [np.random.rand() for _ in range(25)]
+        axis_half_turns_list = [np.random.rand() for _ in range(25)]
+
+        for half_turns, axis_half_turns in zip(half_turns_list,
+                                               axis_half_turns_list):
+            s.simulate_moment(
+                w_ops=[(index, half_turns, axis_half_turns)
+                       for index in range(5)],
+                phase_map={(0, 1): half_turns})
+        for half_turns, axis_half_turns in zip(half_turns_list[::-1],
+                                               axis_half_turns_list[::-1]):
+            s.simulate_phases({(0, 1): -half_turns})
+            for index in range(5):
+                s.simulate_w(index=index, axis_half_turns=axis_half_turns,
+                             half_turns=-half_turns)
+        expected = np.zeros(2 ** 5, dtype=np.complex128)
+        expected[0] = 1.0
+        assert s.current_state.dtype == np.complex128
+        np.testing.assert_almost_equal(expected, s.current_state, decimal=12)
+
+
+def test_decode_initial_state_dtype():
+    state = xmon_stepper.decode_initial_state(1, 2, np.complex128)
+    assert state.dtype == np.complex128
+    np.testing.assert_almost_equal(state, np.array([0.0, 1.0, 0.0, 0.0]))
+    with pytest.raises(ValueError):
+        xmon_stepper.decode_initial_state(
+            np.array([1.0, 0.0, 0.0, 0.0], dtype=np.complex64), 2,
+            np.complex128)
+
+
 def test_decode_initial_state():
     np.testing.assert_almost_equal(xmon_stepper.decode_initial_state(
         np.array([1.0, 0.0, 0.0, 0.0], dtype=np.complex64), 2),
@@ -804,4 +1287,131 @@ def test_ensure_pool_on_non_stepper():
             """Trick to not have an uncovered line."""
 
     with pytest.raises(Exception):
-        BadClass().method()
\ No newline at end of file
+        BadClass().method()
+
+def test_renorm_policy():
+    assert xmon_stepper.RenormPolicy.EVERY_MOMENT.period == 1
+    assert not xmon_stepper.RenormPolicy.NEVER.before_measurement
+    assert xmon_stepper.RenormPolicy.BEFORE_MEASUREMENT.before_measurement
+    assert (xmon_stepper.RenormPolicy(period=1) ==
+            xmon_stepper.RenormPolicy.EVERY_MOMENT)
+    assert (xmon_stepper.RenormPolicy(tolerance=1e-3) !=
+            xmon_stepper.RenormPolicy(tolerance=1e-4))
+    assert (hash(xmon_stepper.RenormPolicy(period=3)) ==
+            hash(xmon_stepper.RenormPolicy(period=3)))
+    assert xmon_stepper.RenormPolicy() != 'RenormPolicy'
+    assert repr(xmon_stepper.RenormPolicy.NEVER) == (
+        'cirq.google.RenormPolicy(period=None, tolerance=None, '
+        'before_measurement=False)')
+    with pytest.raises(ValueError, match='period'):
+        xmon_stepper.RenormPolicy(period=0)
+    with pytest.raises(ValueError, match='tolerance'):
+        xmon_stepper.RenormPolicy(tolerance=-1)
+
+
+def renorm_stepper(policy, num_prefix_qubits, monkeypatch):
+    stepper = xmon_stepper.Stepper(num_qubits=3,
+                                   num_prefix_qubits=num_prefix_qubits,
+                                   min_qubits_before_shard=0,
+                                   renorm_policy=policy)
+    stepper.renorm_calls = 0
+    renormalize = stepper.renormalize
+
+    def counting_renormalize(*args):
+        stepper.renorm_calls += 1
+        renormalize(*args)
+
+    monkeypatch.setattr(stepper, 'renormalize', counting_renormalize)
+    return stepper
+
+
+@pytest.mark.parametrize('num_prefix_qubits', (0, 2))
+def test_renorm_every_moment(num_prefix_qubits, monkeypatch):
+    with renorm_stepper(xmon_stepper.RenormPolicy.EVERY_MOMENT,
+                        num_prefix_qubits, monkeypatch) as s:
+        s.simulate_moment(w_ops=[(0, 0.5, 0), (2, 0.5, 0)],
+                          phase_map={(1,): 0.5})
+        assert s.renorm_calls == 1
+        assert s.drift_count == 0
+        s.simulate_w(0, 0.5, 0)
+        assert s.renorm_calls == 2
+        s.simulate_phases({(1,): 0.5})
+        assert s.renorm_calls == 2
+        assert s.drift_count == 1
+        # Measurements already happen after renormalization.
+        s.simulate_moment(measurement_indices=[1])
+        assert s.renorm_calls == 3
+        assert s.drift_count == 0
+
+
+@pytest.mark.parametrize('num_prefix_qubits', (0, 2))
+def test_renorm_period(num_prefix_qubits, monkeypatch):
+    with renorm_stepper(xmon_stepper.RenormPolicy(period=2),
+                        num_prefix_qubits, monkeypatch) as s:
+        s.simulate_moment(w_ops=[(0, 0.5, 0), (2, 0.5, 0)])
+        assert s.renorm_calls == 0
+        assert s.drift_count == 2
+        s.simulate_moment(w_ops=[(1, 0.5, 0)], phase_map={(0,): 0.25})
+        assert s.renorm_calls == 1
+        assert s.drift_count == 0
+        s.simulate_moment(w_ops=[(1, 0.5, 0)])
+        assert s.drift_count == 1
+        np.testing.assert_almost_equal(np.linalg.norm(s.current_state), 1)
+
+
+@pytest.mark.parametrize('num_prefix_qubits', (0, 2))
+def test_renorm_tolerance(num_prefix_qubits, monkeypatch):
+    with renorm_stepper(xmon_stepper.RenormPolicy(tolerance=1e-3),
+                        num_prefix_qubits, monkeypatch) as s:
+        # Unitary gates only drift the norm by floating point error.
+        s.simulate_w(0, 0.5, 0)
+        s.simulate_moment(w_ops=[(1, 0.5, 0), (2, 0.5, 0)])
+        assert s.renorm_calls == 0
+        assert s.drift_count == 3
+
+        # Scaled identities drift the norm by a known amount.
+        s.apply_1q_matrix(0, 1.01 * np.eye(2))
+        assert s.renorm_calls == 1
+        assert s.drift_count == 0
+        s.simulate_moment(matrix_ops=[((1,), 1.0005 * np.eye(2))])
+        assert s.renorm_calls == 1
+        s.simulate_moment(matrix_ops=[((2,), 1.0009 * np.eye(2))])
+        assert s.renorm_calls == 2
+        assert s.drift_count == 0
+        np.testing.assert_almost_equal(np.linalg.norm(s.current_state), 1)
+
+
+@pytest.mark.parametrize('num_prefix_qubits', (0, 2))
+def test_renorm_before_measurement(num_prefix_qubits, monkeypatch):
+    with renorm_stepper(xmon_stepper.RenormPolicy.BEFORE_MEASUREMENT,
+                        num_prefix_qubits, monkeypatch) as s:
+        for i in range(3):
+            s.simulate_w(i, 1.0, 0)
+        assert s.renorm_calls == 0
+        assert s.drift_count == 3
+        assert s.sample_measurements([0, 1]).tolist() == [[True, True]]
+        assert s.renorm_calls == 1
+        assert s.drift_count == 0
+        s.simulate_moment(w_ops=[(0, 1.0, 0)])
+        assert s.drift_count == 1
+        assert not s.simulate_measurement(0)
+        assert s.renorm_calls == 2
+        assert s.drift_count == 0
+
+
+@pytest.mark.parametrize('num_prefix_qubits', (0, 2))
+def test_renorm_never(num_prefix_qubits, monkeypatch):
+    with renorm_stepper(xmon_stepper.RenormPolicy.NEVER,
+                        num_prefix_qubits, monkeypatch) as s:
+        s.simulate_moment(w_ops=[(0, 1.0, 0), (2, 1.0, 0)])
+        assert s.sample_measurements([0, 1, 2]).tolist() == [
+            [True, False, True]]
+        assert s.drift_count == 2
+        assert s.simulate_moment(measurement_indices=[2]) == [True]
+        assert s.renorm_calls == 0
+        # Collapsing the state normalizes it.
+        assert s.drift_count == 0
+        s.simulate_phases({(0,): 0.5})
+        assert s.drift_count == 1
+        s.reset_state(0)
+        assert s.drift_count == 0
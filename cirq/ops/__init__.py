@@ -86,6 +86,13 @@ from cirq.ops.raw_types import (
     Operation,
     QubitId,
 )
+from cirq.ops.resolve import (
+    is_parameterized,
+    measurement_invert_mask,
+    measurement_keys,
+    resolve_and_decompose,
+    resolve_operation,
+)
 from cirq.ops.reversible_composite_gate import (
     inverse,
     ReversibleCompositeGate,
@@ -0,0 +1,114 @@
+# Copyright 2018 The Cirq Developers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Utility methods for preparing operations to be simulated."""
+
+from typing import Callable, Iterable, List, Set, Tuple, cast
+
+from cirq import extension
+from cirq.ops import (
+    common_gates, gate_features, gate_operation, op_tree, raw_types,
+)
+from cirq.study import ParamResolver
+
+
+def is_parameterized(op: raw_types.Operation,
+                     extensions: extension.Extensions) -> bool:
+    """Returns whether the operation has unresolved Symbols."""
+    parameterizable = extensions.try_cast(gate_features.ParameterizableEffect,
+                                          op)
+    return parameterizable is not None and parameterizable.is_parameterized()
+
+
+def resolve_operation(op: raw_types.Operation,
+                      param_resolver: ParamResolver,
+                      extensions: extension.Extensions
+                      ) -> raw_types.Operation:
+    """Returns the operation with its parameters resolved.
+
+    Operations that can not be parameterized are returned unchanged.
+    """
+    parameterizable = extensions.try_cast(gate_features.ParameterizableEffect,
+                                          op)
+    if parameterizable is None:
+        return op
+    return cast(raw_types.Operation,
+                parameterizable.with_parameters_resolved_by(param_resolver))
+
+
+def resolve_and_decompose(
+        operations: Iterable[raw_types.Operation],
+        param_resolver: ParamResolver,
+        extensions: extension.Extensions,
+        keep: Callable[[raw_types.Operation], bool]
+) -> List[raw_types.Operation]:
+    """Resolves the operations and decomposes them until they are kept.
+
+    Each operation is resolved, and then kept if keep returns True for it,
+    and otherwise replaced by its resolved and decomposed decomposition.
+
+    Args:
+        operations: The operations to resolve and decompose.
+        param_resolver: The resolver of the parameters of the operations.
+        extensions: The extensions used to cast the operations to
+            ParameterizableEffect and CompositeOperation.
+        keep: Whether a resolved operation is kept rather than decomposed.
+
+    Returns:
+        The resolved operations for which keep returns True, in order.
+
+    Raises:
+        TypeError: An operation is not kept and has no decomposition.
+    """
+    result = []  # type: List[raw_types.Operation]
+    for op in operations:
+        resolved_op = resolve_operation(op, param_resolver, extensions)
+        if keep(resolved_op):
+            result.append(resolved_op)
+            continue
+        composite = extensions.try_cast(gate_features.CompositeOperation,
+                                        resolved_op)
+        if composite is None:
+            raise TypeError('Unsupported operation without a decomposition: '
+                            '{!r}'.format(resolved_op))
+        result.extend(resolve_and_decompose(
+            op_tree.flatten_op_tree(composite.default_decompose()),
+            param_resolver,
+            extensions,
+            keep))
+    return result
+
+
+def measurement_keys(operations: Iterable[gate_operation.GateOperation]
+                     ) -> Set[str]:
+    """Returns the keys of the given measurement operations.
+
+    Raises:
+        ValueError: Two of the operations have the same key.
+    """
+    keys = set()  # type: Set[str]
+    for op in operations:
+        key = cast(common_gates.MeasurementGate, op.gate).key
+        if key in keys:
+            raise ValueError('Repeated Measurement key {}'.format(key))
+        keys.add(key)
+    return keys
+
+
+def measurement_invert_mask(op: gate_operation.GateOperation
+                            ) -> Tuple[bool, ...]:
+    """Returns the invert mask of a measurement, padded to its qubits."""
+    gate = cast(common_gates.MeasurementGate, op.gate)
+    invert_mask = tuple(gate.invert_mask or ())
+    return invert_mask + (False,) * (len(op.qubits) - len(invert_mask))
@@ -0,0 +1,75 @@
+# Copyright 2018 The Cirq Developers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+import cirq
+
+a, b = cirq.LineQubit.range(2)
+
+
+def test_is_parameterized():
+    ext = cirq.Extensions()
+    assert cirq.is_parameterized(
+        cirq.RotXGate(half_turns=cirq.Symbol('t')).on(a), ext)
+    assert not cirq.is_parameterized(cirq.X(a), ext)
+    assert not cirq.is_parameterized(cirq.measure(a), ext)
+
+
+def test_resolve_operation():
+    ext = cirq.Extensions()
+    resolver = cirq.ParamResolver({'t': 0.5})
+    assert cirq.resolve_operation(
+        cirq.RotXGate(half_turns=cirq.Symbol('t')).on(a), resolver,
+        ext) == cirq.RotXGate(half_turns=0.5).on(a)
+    op = cirq.measure(a)
+    assert cirq.resolve_operation(op, resolver, ext) is op
+
+
+def test_resolve_and_decompose():
+    ext = cirq.Extensions()
+    resolver = cirq.ParamResolver({'t': 0.5})
+    operations = [cirq.RotZGate(half_turns=cirq.Symbol('t')).on(a),
+                  cirq.SWAP(a, b)]
+
+    def is_single_qubit(op):
+        return len(op.qubits) == 1
+
+    def is_not_swap(op):
+        return op.gate != cirq.SWAP
+
+    decomposed = cirq.resolve_and_decompose(operations, resolver, ext,
+                                            is_not_swap)
+    assert decomposed == [cirq.RotZGate(half_turns=0.5).on(a)] + list(
+        cirq.flatten_op_tree(cirq.SWAP.default_decompose([a, b])))
+    with pytest.raises(TypeError, match='Unsupported operation'):
+        cirq.resolve_and_decompose(operations, resolver, ext,
+                                   is_single_qubit)
+
+
+def test_measurement_keys():
+    assert cirq.measurement_keys([]) == set()
+    assert cirq.measurement_keys([cirq.measure(a, key='x'),
+                                  cirq.measure(b, key='y')]) == {'x', 'y'}
+    with pytest.raises(ValueError, match='Repeated'):
+        cirq.measurement_keys([cirq.measure(a, key='x'),
+                               cirq.measure(b, key='x')])
+
+
+def test_measurement_invert_mask():
+    assert cirq.measurement_invert_mask(cirq.measure(a, b)) == (False, False)
+    assert cirq.measurement_invert_mask(
+        cirq.measure(a, b, invert_mask=(True,))) == (True, False)
+    assert cirq.measurement_invert_mask(
+        cirq.measure(a, b, invert_mask=(False, True))) == (False, True)
@@ -14,14 +14,17 @@
 
 "General methods for creating Schedules from Circuits."
 
-from cirq.circuits import  Circuit
+from typing import Union
+
+from cirq.circuits import Circuit, CompactCircuit
 from cirq.devices import Device
 from cirq.schedules import Schedule
 from cirq.schedules import ScheduledOperation
 from cirq.value import Timestamp
 
 
-def moment_by_moment_schedule(device: Device, circuit: Circuit):
+def moment_by_moment_schedule(device: Device,
+                              circuit: Union[Circuit, CompactCircuit]):
     """Returns a schedule aligned with the moment structure of the Circuit.
 
     This method attempts to create a schedule in which each moment of a circuit
@@ -33,6 +36,9 @@ def moment_by_moment_schedule(device: Device, circuit: Circuit):
     operations in this moment in a time slice of length equal to the maximum
     time of an operation in the moment.
 
+    The moments of a CompactCircuit are scheduled one at a time, without
+    converting the whole circuit to a Circuit first.
+
     Returns:
         A Schedule for the circuit.
 
@@ -41,7 +47,9 @@ def moment_by_moment_schedule(device: Device, circuit: Circuit):
     """
     schedule = Schedule(device)
     t = Timestamp()
-    for moment in circuit.moments:
+    moments = (circuit.iter_moments() if isinstance(circuit, CompactCircuit)
+               else circuit.moments)
+    for moment in moments:
         if not moment.operations:
             continue
         for op in moment.operations:
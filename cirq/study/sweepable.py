@@ -14,7 +14,8 @@
 
 """Defines which types are Sweepable."""
 
-from typing import Iterable, Union
+import collections
+from typing import Iterable, List, Union, cast
 
 from cirq.study.resolver import ParamResolver
 from cirq.study.sweeps import Sweep
@@ -22,3 +23,26 @@ from cirq.study.sweeps import Sweep
 
 Sweepable = Union[
     ParamResolver, Iterable[ParamResolver], Sweep, Iterable[Sweep]]
+
+
+def to_resolvers(sweepable: Sweepable) -> List[ParamResolver]:
+    """Returns the ParamResolvers of all of the points of a Sweepable.
+
+    Raises:
+        TypeError: The sweepable is not a Sweepable.
+    """
+    if isinstance(sweepable, ParamResolver):
+        return [sweepable]
+    if isinstance(sweepable, Sweep):
+        return list(sweepable)
+    if isinstance(sweepable, collections.Iterable):
+        resolvers = []  # type: List[ParamResolver]
+        for item in cast(collections.Iterable, sweepable):
+            if isinstance(item, ParamResolver):
+                resolvers.append(item)
+            elif isinstance(item, Sweep):
+                resolvers.extend(item)
+            else:
+                raise TypeError('Unexpected Sweepable type.')
+        return resolvers
+    raise TypeError('Unexpected Sweepable type.')
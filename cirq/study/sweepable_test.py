@@ -0,0 +1,53 @@
+# Copyright 2018 The Cirq Developers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+import cirq
+
+
+def param_dicts(resolvers):
+    return [r.param_dict for r in resolvers]
+
+
+def test_to_resolvers_resolver():
+    resolver = cirq.ParamResolver({'a': 1})
+    assert cirq.to_resolvers(resolver) == [resolver]
+
+
+def test_to_resolvers_sweep():
+    sweep = cirq.Points('a', [1, 2])
+    assert param_dicts(cirq.to_resolvers(sweep)) == [{'a': 1}, {'a': 2}]
+
+
+def test_to_resolvers_iterable():
+    resolvers = [cirq.ParamResolver({'a': 1}), cirq.ParamResolver({'a': 2})]
+    assert cirq.to_resolvers(resolvers) == resolvers
+    assert cirq.to_resolvers(iter(resolvers)) == resolvers
+    assert cirq.to_resolvers([]) == []
+
+
+def test_to_resolvers_iterable_sweeps():
+    sweeps = [cirq.Points('a', [1, 2]), cirq.Points('b', [3])]
+    assert param_dicts(cirq.to_resolvers(sweeps)) == [
+        {'a': 1}, {'a': 2}, {'b': 3}]
+
+
+def test_to_resolvers_bad_type():
+    with pytest.raises(TypeError):
+        cirq.to_resolvers('a')
+    with pytest.raises(TypeError):
+        cirq.to_resolvers(1)
+    with pytest.raises(TypeError):
+        cirq.to_resolvers([cirq.Points('a', [1]), 1])